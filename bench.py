@@ -0,0 +1,471 @@
+#! /usr/bin/env python3
+"""Performance benchmarks
+
+Run "python3 bench.py" for all benchmarks, or name particular benchmarks as
+arguments. The synthetic test data comes from "test.py"."""
+
+import sys
+import os
+from time import perf_counter
+
+from test import HdsServer
+
+benchmarks = dict()
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+@benchmark
+def workers():
+    """HDS download from a local server with 20 ms latency per request"""
+    frags = 40
+    with HdsServer(frags=frags, frag_size=0x10000, latency=0.02) as server:
+        reference = None
+        for workers in (None, 2, 4, 8):
+            start = perf_counter()
+            flv = server.fetch(workers=workers)
+            elapsed = perf_counter() - start
+            
+            if reference is None:
+                reference = flv
+            assert flv == reference, "Output differs from sequential download"
+            
+            print("  workers={}: {:.2f} s, {:.1f} MB/s, {:.1f} frag/s".format(
+                workers, elapsed, len(flv) / elapsed / 1e6, frags / elapsed))
+
+@benchmark
+def streamcopy():
+    """Copying fragments from a socket, compared with a chunk per read"""
+    import tracemalloc
+    import socket
+    import threading
+    from tempfile import TemporaryFile
+    from iview import utils
+    
+    def chunked(input, output, length):
+        """The copy loop before reusing a buffer"""
+        while length:
+            chunk = input.read(min(length, 0x10000))
+            output.write(chunk)
+            length -= len(chunk)
+    
+    frags = 200
+    frag = os.urandom(0x100000)
+    
+    def send(sock):
+        with sock:
+            for _ in range(1 + frags):
+                sock.sendall(frag)
+    
+    with open(os.devnull, "wb") as output:
+        for (name, copy) in (
+            ("read()", chunked),
+            ("readinto()", utils.streamcopy),
+        ):
+            (sender, receiver) = socket.socketpair()
+            thread = threading.Thread(target=send, args=(sender,))
+            thread.start()
+            with receiver, receiver.makefile("rb") as input:
+                # First fragment allocates any reusable buffer
+                tracemalloc.start()
+                copy(input, output, len(frag))
+                (baseline, _) = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                copy(input, output, len(frag))
+                (_, peak) = tracemalloc.get_traced_memory()
+                peak -= baseline
+                tracemalloc.stop()
+                
+                start = perf_counter()
+                for _ in range(frags - 1):
+                    copy(input, output, len(frag))
+                elapsed = perf_counter() - start
+            thread.join()
+            
+            print("  {}: {:.0F} MB/s, {:.1F} kB peak allocation per fragment".
+                format(name, (frags - 1) * len(frag) / elapsed / 1e6,
+                peak / 1e3))
+        
+        with TemporaryFile() as input:
+            input.write(frag)
+            start = perf_counter()
+            for _ in range(frags):
+                input.seek(0)
+                utils.streamcopy(input, output, len(frag))
+            elapsed = perf_counter() - start
+            print("  sendfile() from file: {:.0F} MB/s".format(
+                frags * len(frag) / elapsed / 1e6))
+
+@benchmark
+def series():
+    """Parsing a large series API response, whole and streamed"""
+    import json
+    import tracemalloc
+    from iview import parser
+    
+    episode = dict(a="123456", b="Episode title", d="Description " * 20,
+        f="2014-02-07 21:00:00", g="2014-03-07 21:00:00", i="100.5",
+        j="1800", n="programme/episode_123456.mp4", s="thumb.jpg")
+    catalogue = [dict(a=str(id), b="Series {}".format(id),
+        f=[dict(episode, a=str(id * 10 + n)) for n in range(10)])
+        for id in range(2000)]
+    data = json.dumps(catalogue).encode("utf-8")
+    del catalogue
+    
+    def whole():
+        for series in parser.parse_series_api(data):
+            series["title"]
+    def streamed(size=0x10000):
+        chunks = (data[i:i + size] for i in range(0, len(data), size))
+        for series in parser.iter_series_api(chunks):
+            series["title"]
+    def episodes():
+        for series in parser.parse_series_api(data):
+            for episode in series["items"]:
+                episode["title"]
+    
+    print("  {:.1F} MB response".format(len(data) / 1e6))
+    for (name, parse) in (
+        ("parse_series_api(), titles only", whole),
+        ("iter_series_api(), titles only", streamed),
+        ("iter_series_api(), 1 kB chunks", lambda: streamed(0x400)),
+        ("parse_series_api(), all episodes", episodes),
+    ):
+        tracemalloc.start()
+        start = perf_counter()
+        parse()
+        elapsed = perf_counter() - start
+        (_, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("  {}: {:.2F} s, {:.1F} MB peak allocation".format(
+            name, elapsed, peak / 1e6))
+
+@benchmark
+def captions():
+    """Converting the captions of a long programme to SRT"""
+    import re
+    import tracemalloc
+    from io import StringIO
+    from xml.etree.ElementTree import XML
+    from iview import parser
+    
+    def concatenate(soup):
+        """The conversion before SRT entries were written incrementally"""
+        if b"<![CDATA[" not in soup:
+            soup = re.sub(b"&(?![#\\w]+;)", b"&amp;", soup)
+        xml = XML(soup)
+        output = ''
+        i = 1
+        for title in xml.iter('title'):
+            start = title.get('start')
+            (start, startfract) = start.rsplit(':', 1)
+            end = title.get('end')
+            (end, endfract) = end.rsplit(':', 1)
+            output = output + '{}\n'.format(i)
+            output = output + '{},{:0<3.3} --> {},{:0<3.3}\n'.format(
+                start, startfract, end, endfract)
+            output = output + title.text.replace('|','\n') + '\n\n'
+            i += 1
+        return output
+    
+    def write(soup):
+        chunks = (soup[i:i + 0x10000] for i in range(0, len(soup), 0x10000))
+        parser.write_captions(chunks, StringIO())
+    
+    titles = 20000
+    xml = [b'<?xml version="1.0"?><xml><reel>']
+    for i in range(titles):
+        xml.append('<title start="00:{:02}:{:02}:0" end="00:{:02}:{:02}:5">'
+            'Caption number {} & more|Second line</title>'.format(
+            i // 60 % 60, i % 60, i // 60 % 60, i % 60, i).encode("ascii"))
+    xml.append(b'</reel></xml>')
+    xml = b"".join(xml)
+    
+    for (name, convert) in (
+        ("concatenation", concatenate),
+        ("parse_captions()", parser.parse_captions),
+        ("write_captions() in 64 KiB chunks", write),
+    ):
+        tracemalloc.start()
+        start = perf_counter()
+        convert(xml)
+        elapsed = perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("  {} titles, {}: {:.0F} ms, peak {:.0F} KiB".format(
+            titles, name, elapsed * 1e3, peak / 1024))
+
+@benchmark
+def records():
+    """Memory used by 10,000 parsed episodes"""
+    import tracemalloc
+    from iview import parser
+    
+    items = list()
+    for id in range(10000):
+        items.append(dict(a=str(id), b="Episode {}".format(id),
+            d="Description", e="Category", f="2014-01-01 00:00:00",
+            g="2014-03-01 00:00:00", h="0000-00-00 00:00:00", i="123.4",
+            j="1800", k="", l="", n="programme/{}.mp4".format(id), m="G",
+            r="", s="thumb.jpg", u="1", v="2"))
+    
+    for (name, record) in (("dict", dict), ("Episode", parser.Episode)):
+        def api_attributes(input, attributes, _=None):
+            return orig(input, attributes, record)
+        orig = parser.api_attributes
+        parser.api_attributes = api_attributes
+        tracemalloc.start()
+        try:
+            parsed = parser.parse_series_items([dict(item) for item in items])
+            # Only count the records, not the copies of the input
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+            parser.api_attributes = orig
+        size = sum(stat.size for stat in snapshot.statistics("filename")
+            if stat.traceback[0].filename == parser.__file__)
+        print("  {} items, {}: {:.0F} KiB".format(len(parsed), name,
+            size / 1024))
+
+@benchmark
+def dates():
+    """Parsing the episodes of a synthetic 50,000 item index"""
+    import random
+    from datetime import datetime, timedelta
+    from iview import parser
+    
+    def strptime(date):
+        """The date parsing before the fixed-width parser"""
+        if date in {"0000-00-00 00:00:00", "0000-00-00"}:
+            return None
+        for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
+            try:
+                return datetime.strptime(date, fmt)
+            except ValueError:
+                continue
+        raise ValueError("Unknown format {!r}".format(date))
+    
+    # Items are published in batches, so dates are often repeated
+    random.seed(0)
+    start = datetime(2014, 1, 1)
+    def date():
+        time = start + timedelta(hours=random.randrange(24 * 90))
+        return time.strftime("%Y-%m-%d %H:%M:%S")
+    items = list()
+    for id in range(50000):
+        items.append(dict(a=str(id), b="Episode", f=date(), g=date(),
+            h=random.choice((date(), "0000-00-00 00:00:00")),
+            n="programme/{}.mp4".format(id)))
+    
+    for (name, parse_date) in (
+        ("strptime()", strptime),
+        ("fixed-width, no memo", parser.parse_date.__wrapped__),
+        ("fixed-width with memo", parser.parse_date),
+    ):
+        parser.parse_date.cache_clear()
+        orig = parser.parse_date
+        parser.parse_date = parse_date
+        try:
+            start_time = perf_counter()
+            parser.parse_series_items(items)
+            elapsed = perf_counter() - start_time
+        finally:
+            parser.parse_date = orig
+        print("  {}: {:.2F} s".format(name, elapsed))
+
+@benchmark
+def runs():
+    """Listing the fragments of a bootstrap with many fragment runs"""
+    from iview import hds
+    
+    def listed(frag_runs):
+        """The iteration before the run boundaries were precalculated"""
+        for (i, run) in enumerate(frag_runs):
+            start = run["first"]
+            time = run["timestamp"]
+            for next in frag_runs[i + 1:]:
+                if next.get("discontinuity") is None:
+                    end = next["first"]
+                    break
+            else:
+                end = start + 1
+            for frag in range(start, end):
+                time += run["duration"]
+                yield (frag, time)
+    
+    for runs in (1000, 10000):
+        frag_runs = list()
+        table = hds.FragRunTable()
+        for run in range(runs):
+            # Alternate fragment durations so that each run is distinct
+            duration = 1000 + run % 2
+            frag_runs.append(dict(first=1 + run * 2,
+                timestamp=run * 2001, duration=duration))
+            table.append(1 + run * 2, run * 2001, duration)
+        table.finish()
+        
+        for (name, frags) in (
+            ("list of dicts", lambda: listed(frag_runs)),
+            ("array columns", lambda: hds.iter_frags(table)),
+        ):
+            start = perf_counter()
+            count = sum(1 for _ in frags())
+            elapsed = perf_counter() - start
+            print("  {} runs, {}: {} fragments in {:.1F} ms".format(
+                runs, name, count, elapsed * 1e3))
+        
+        start = perf_counter()
+        for time in range(0, runs * 2001, 997):
+            table.find(time)
+        elapsed = perf_counter() - start
+        print("  {} runs, find(): {:.2F} us per lookup".format(
+            runs, elapsed / len(range(0, runs * 2001, 997)) * 1e6))
+
+@benchmark
+def parsing():
+    """Parsing a large bootstrap, and FLV tag headers from a socket"""
+    import socket
+    import threading
+    from io import BytesIO
+    from test import hds_box
+    from iview import hds, flvlib, utils
+    
+    runs = 20000
+    afrt = b"".join(hds.FRAG_RUN.pack(1 + run, run * 1000, 1000)
+        for run in range(runs))
+    afrt = hds_box(b"afrt", bytes(4), (1000).to_bytes(4, "big"), b"\x00",
+        runs.to_bytes(4, "big"), afrt)
+    
+    def unbuffered(stream):
+        """The table parsing before buffering and unpacking each run"""
+        (_, size) = hds.read_box_header(stream)
+        utils.fastforward(stream, 1 + 3 + 4 + 1)
+        count = utils.read_int(stream, 4)
+        runs = list()
+        for _ in range(count):
+            run = dict()
+            run["first"] = utils.read_int(stream, 4)
+            run["timestamp"] = utils.read_int(stream, 8)
+            run["duration"] = utils.read_int(stream, 4)
+            runs.append(run)
+    
+    for (name, parse) in (
+        ("read_int()", lambda: unbuffered(BytesIO(afrt))),
+        ("BinaryReader", lambda: hds.read_afrt(
+            utils.BinaryReader(BytesIO(afrt)))),
+    ):
+        start = perf_counter()
+        parse()
+        elapsed = perf_counter() - start
+        print("  {} runs, {}: {:.1F} ms".format(runs, name, elapsed * 1e3))
+    
+    def old_header(flv):
+        """The tag header parsing before reading it all at once"""
+        flags = flv.read(1)
+        if not flags:
+            return None
+        utils.read_int(flv, 3)
+        utils.read_int(flv, 3)
+        flv.read(1)
+        utils.read_int(flv, 3)
+        return flags
+    
+    tags = 20000
+    tag = flvlib.TAG_HEADER.pack(9 << 24 | 5, 0, 0, 0) + bytes(5 + 4)
+    
+    def send(sock):
+        with sock:
+            sock.sendall(tag * tags)
+    
+    for (name, wrap, read) in (
+        ("unbuffered, five reads", lambda sock: sock.makefile("rb", 0),
+            old_header),
+        ("BinaryReader", lambda sock: utils.BinaryReader(
+            sock.makefile("rb", 0)), flvlib.read_tag_header),
+    ):
+        (sender, receiver) = socket.socketpair()
+        thread = threading.Thread(target=send, args=(sender,))
+        thread.start()
+        with receiver:
+            stream = wrap(receiver)
+            start = perf_counter()
+            while read(stream) is not None:
+                utils.fastforward(stream, 5 + 4)
+            elapsed = perf_counter() - start
+            stream.close()
+        thread.join()
+        print("  {} tags, {}: {:.1F} ms".format(tags, name, elapsed * 1e3))
+
+@benchmark
+def rtmpdump():
+    """Parsing "rtmpdump" progress output from a pipe"""
+    import re
+    import threading
+    from iview import fetch
+    
+    lines = 100000
+    output = b"".join("{:.3F} kB / {:.2F} sec ({:.1F}%)\r".format(
+        i * 10, i / 10, i * 100 / lines).encode("ascii")
+        for i in range(lines))
+    
+    class Frontend:
+        def set_fraction(fraction):
+            pass
+        def set_size(size):
+            pass
+    
+    def byte_at_a_time(pipe):
+        """The parsing before reading in large chunks"""
+        progress_pattern = re.compile(br'\d+\.\d%')
+        size_pattern = re.compile(br'\d+\.\d+ kB', re.IGNORECASE)
+        while True:
+            result = bytearray()
+            while True:
+                char = pipe.read(1)
+                if not char or char == b'\r':
+                    break
+                result.extend(char)
+            if not result:
+                break
+            progress_search = progress_pattern.search(result)
+            size_search = size_pattern.search(result)
+            if progress_search is not None:
+                Frontend.set_fraction(
+                    float(progress_search.group()[:-1]) / 100.)
+            if size_search is not None:
+                Frontend.set_size(float(size_search.group()[:-3]) * 1024)
+    
+    def chunked(pipe):
+        progress = fetch.Progress()
+        for chunk in fetch.read_lines(pipe):
+            for line in chunk:
+                progress.update(line)
+            progress.send(Frontend)
+    
+    for (name, parse) in (
+        ("byte at a time", byte_at_a_time),
+        ("read_lines()", chunked),
+    ):
+        (read, write) = os.pipe()
+        def send():
+            with open(write, "wb") as pipe:
+                pipe.write(output)
+        thread = threading.Thread(target=send)
+        thread.start()
+        with open(read, "rb") as pipe:
+            start = perf_counter()
+            parse(pipe)
+            elapsed = perf_counter() - start
+        thread.join()
+        print("  {} lines, {}: {:.1F} ms".format(lines, name, elapsed * 1e3))
+
+def main():
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        func = benchmarks[name]
+        print("{}: {}".format(name, func.__doc__))
+        func()
+
+if __name__ == "__main__":
+    main()
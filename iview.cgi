@@ -17,6 +17,9 @@
 	iview module is installed to the system (preferred), or the iview/
 	directory is also under cgi-bin.
 
+	For more than a couple of viewers, the "iview.server" module runs a
+	standalone HTTP server that is much lighter on the machine.
+
 	Also, if there's the slightest chance somebody will be able to access this
 	script from a public address, it's probably a good idea to configure
 	your web server to restrict access to this script by IP address. Unless,
@@ -0,0 +1,298 @@
+"""Asynchronous iView client for "asyncio" programs
+
+The Client class offers the same operations as the "comm" module, as
+coroutines. Each client keeps its own copy of the iView configuration,
+so several clients can be used at once. Requests go through a small
+HTTP/1.1 client built on "asyncio" streams, which keeps connections open
+for reuse. SOCKS proxies are not supported.
+"""
+
+import asyncio
+import ssl
+import time
+from functools import partial
+from urllib.parse import urljoin, urlsplit
+from urllib.error import HTTPError
+from email.parser import BytesParser
+from http.client import HTTPMessage
+from . import config
+from . import parser
+from . import cache
+from . import comm
+
+try:  # Python 3.7
+    get_running_loop = asyncio.get_running_loop
+except AttributeError:  # Python < 3.7, where this is the running loop
+    get_running_loop = asyncio.get_event_loop
+
+class Client:
+    """Asynchronous equivalent of the "comm" module functions
+    
+    Call get_config() before anything else. If "cache_dir" is given,
+    responses are cached there like "config.cache" does for "comm".
+    "timeout" is passed to HttpSession."""
+    
+    def __init__(self, *, headers=(), max_per_host=8, cache_dir=None,
+    cache_size=None, timeout=30):
+        self.iview_config = dict(headers=comm.config_headers(headers))
+        self.session = HttpSession(max_per_host, timeout=timeout)
+        if cache_dir is None:
+            self.cache = None
+        else:
+            self.cache = cache.HttpCache(cache_dir, cache_size)
+    
+    async def get_config(self):
+        parsed = parser.parse_config(await self.maybe_fetch(config.config_url))
+        self.iview_config.update(parsed)
+    
+    async def get_auth(self):
+        auth = await self.fetch_url(comm.auth_url(self.iview_config))
+        return parser.parse_auth(auth, self.iview_config)
+    
+    async def get_categories(self):
+        url = self.iview_config["categories_url"]
+        return parser.parse_categories(await self.maybe_fetch(url))
+    
+    async def get_index(self):
+        return await self.series_api("seriesIndex")
+    
+    async def get_series_items(self, series_id, get_meta=False):
+        series = await self.series_api("series", series_id)
+        return comm.find_series_items(series, series_id, get_meta)
+    
+    async def get_keyword(self, keyword):
+        return await self.series_api("keyword", keyword)
+    
+    async def series_api(self, key, value=""):
+        url = comm.series_api_url(self.iview_config, key, value)
+        return parser.parse_series_api(await self.maybe_fetch(url))
+    
+    async def get_highlights(self):
+        url = self.iview_config["highlights"]
+        return parser.parse_highlights(await self.maybe_fetch(url))
+    
+    async def get_captions(self, url):
+        url = comm.captions_url(self.iview_config, url)
+        return parser.parse_captions(await self.maybe_fetch(url))
+    
+    async def fetch_url(self, url, headers=()):
+        """Fetches a URL relative to the iView base URL"""
+        (response_headers, body) = await self._open(url, headers)
+        return cache.decode_body(response_headers.get("Content-Encoding"),
+            body)
+    
+    async def maybe_fetch(self, url):
+        """Fetches a URL, going through the cache if there is one"""
+        if self.cache is None:
+            return await self.fetch_url(url)
+        
+        # The cache works with files, so use a thread to avoid blocking
+        loop = get_running_loop()
+        def run(func, *pos):
+            return loop.run_in_executor(None, partial(func, *pos))
+        
+        url = urljoin(config.base_url, url)
+        entry = await run(self.cache.lookup, url)
+        if entry is None:
+            validators = ()
+        elif entry.fresh():
+            return await run(entry.read)
+        else:
+            validators = entry.validators()
+        
+        try:
+            (headers, data) = await self._open(url, validators)
+        except HTTPError as error:
+            if entry is None or error.code != 304:
+                raise
+            data = await run(entry.read)
+            await run(self.cache.revalidate, entry, error.headers)
+            return data
+        
+        await run(self.cache.store, url, headers, data)
+        return cache.decode_body(headers.get("Content-Encoding"), data)
+    
+    def _open(self, url, headers):
+        url = urljoin(config.base_url, url)
+        headers = dict(self.iview_config["headers"], **dict(headers))
+        return self.session.get(url, headers)
+    
+    async def close(self):
+        await self.session.close()
+    
+    async def __aenter__(self):
+        return self
+    async def __aexit__(self, *exc):
+        await self.close()
+
+class HttpSession:
+    """Minimal HTTP/1.1 client that reuses connections
+    
+    At most "max_per_host" requests are made to any one host at once.
+    Idle connections are closed after "idle_timeout" seconds. Connecting,
+    and each read or write, raises "asyncio.TimeoutError" if it takes
+    longer than "timeout" seconds; None means no limit."""
+    
+    def __init__(self, max_per_host=8, idle_timeout=15, *, timeout=30):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.opened = 0
+        self.reused = 0
+        self._idle = dict()  # (scheme, host, port) -> [(reader, writer, time)]
+        self._slots = dict()
+    
+    async def get(self, url, headers=(), redirects=5):
+        """Returns the (headers, body) of a response
+        
+        The headers are an "http.client.HTTPMessage" object and the body
+        is not decoded. Redirections are followed. Raises
+        "urllib.error.HTTPError" for any other status except 200, such as
+        304 (Not Modified)."""
+        
+        while True:
+            (status, reason, response_headers, body) = await self._request(
+                url, headers)
+            location = response_headers.get("Location")
+            if status in REDIRECTS and location is not None and redirects:
+                url = urljoin(url, location)
+                redirects -= 1
+                continue
+            if status != 200:
+                raise HTTPError(url, status, reason, response_headers, None)
+            return (response_headers, body)
+    
+    async def _request(self, url, headers):
+        split = urlsplit(url)
+        if split.scheme not in DEFAULT_PORTS:
+            raise ValueError("Unsupported URL scheme: {!r}".format(url))
+        key = (split.scheme, split.hostname,
+            split.port or DEFAULT_PORTS[split.scheme])
+        
+        target = split.path or "/"
+        if split.query:
+            target += "?" + split.query
+        request = ["GET {} HTTP/1.1".format(target)]
+        request.append("Host: {}".format(split.netloc.rpartition("@")[2]))
+        for (name, value) in dict(headers).items():
+            request.append("{}: {}".format(name, value))
+        request = "\r\n".join(request + ["", ""]).encode("latin-1")
+        
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = asyncio.Semaphore(self.max_per_host)
+            self._slots[key] = slots
+        async with slots:
+            while True:
+                (reader, writer, reused) = await self._acquire(key)
+                try:
+                    writer.write(request)
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                    response = await read_response(reader, self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        # Probably closed by the server while idle
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                
+                (reusable, response) = response
+                if reusable:
+                    self._idle.setdefault(key, list()).append(
+                        (reader, writer, time.monotonic()))
+                else:
+                    writer.close()
+                return response
+    
+    async def _acquire(self, key):
+        idle = self._idle.get(key, ())
+        expiry = time.monotonic() - self.idle_timeout
+        while idle:
+            (reader, writer, released) = idle.pop()
+            if released < expiry or reader.at_eof():
+                writer.close()
+                continue
+            self.reused += 1
+            return (reader, writer, True)
+        
+        (scheme, host, port) = key
+        if scheme == "https":
+            context = ssl.create_default_context()
+        else:
+            context = None
+        (reader, writer) = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=context), self.timeout)
+        self.opened += 1
+        return (reader, writer, False)
+    
+    async def close(self):
+        writers = list()
+        for idle in self._idle.values():
+            writers.extend(writer for (_, writer, _) in idle)
+        self._idle.clear()
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            if not hasattr(writer, "wait_closed"):  # Python < 3.7
+                continue
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+DEFAULT_PORTS = dict(http=80, https=443)
+REDIRECTS = {301, 302, 303, 307, 308}
+
+async def read_response(reader, timeout=None):
+    """Reads an HTTP response
+    
+    Returns (reusable, (status, reason, headers, body)), where "reusable"
+    is true if the connection can be used for another request. Each read
+    is limited to "timeout" seconds."""
+    
+    def wait(read):
+        return asyncio.wait_for(read, timeout)
+    
+    line = await wait(reader.readline())
+    if not line:
+        raise ConnectionResetError("Connection closed without a response")
+    (version, status, reason) = (line.decode("latin-1").rstrip("\r\n").
+        split(" ", 2) + [""])[:3]
+    status = int(status)
+    
+    lines = list()
+    while True:
+        line = await wait(reader.readline())
+        if not line:
+            raise asyncio.IncompleteReadError(b"".join(lines), None)
+        if line in (b"\r\n", b"\n"):
+            break
+        lines.append(line)
+    headers = BytesParser(_class=HTTPMessage).parsebytes(b"".join(lines))
+    
+    reusable = (version == "HTTP/1.1" and
+        headers.get("Connection", "").lower() != "close")
+    length = headers.get("Content-Length")
+    if status in (204, 304) or 100 <= status < 200:
+        body = b""
+    elif headers.get("Transfer-Encoding", "").lower() == "chunked":
+        chunks = list()
+        while True:
+            size = await wait(reader.readline())
+            size = int(size.split(b";", 1)[0], 16)
+            if not size:
+                break
+            chunks.append(await wait(reader.readexactly(size)))
+            await wait(reader.readline())
+        while (await wait(reader.readline())) not in (b"\r\n", b"\n", b""):
+            pass  # Trailer
+        body = b"".join(chunks)
+    elif length is not None:
+        body = await wait(reader.readexactly(int(length)))
+    else:
+        body = await wait(reader.read())
+        reusable = False
+    return (reusable, (status, reason, headers, body))
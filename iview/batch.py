@@ -0,0 +1,202 @@
+"""Support for downloading many programmes unattended"""
+
+import sys
+import os
+import threading
+import time
+import dbm
+import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from . import fetch
+
+class Scheduler:
+    """Runs download jobs concurrently
+    
+    Jobs start as soon as they are submitted. At most "max_parallel" jobs
+    run at once, and at most "max_per_host" of them download from any one
+    streaming host. A failed job is tried again up to "retries" times,
+    waiting "backoff" seconds before the first retry and twice as long
+    before each subsequent retry.
+    """
+    
+    def __init__(self, max_parallel=1, max_per_host=None, retries=0,
+    backoff=30):
+        self.max_per_host = max_per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.results = list()
+        self._executor = ThreadPoolExecutor(max_parallel)
+        self._lock = threading.Lock()
+        self._hosts = dict()
+    
+    def submit(self, job):
+        """Schedules a job
+        
+        The job object should have a "name" attribute, a host() method
+        returning the name of the host it downloads from, and a run()
+        method doing the download. The run() method signals failure by
+        raising an exception or returning False."""
+        self._executor.submit(self._run, job)
+    
+    def wait(self):
+        """Waits for all submitted jobs and returns the list of results"""
+        self._executor.shutdown()
+        return self.results
+    
+    def _run(self, job):
+        start = time.time()
+        for attempt in range(1 + self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with self._host_slot(job.host()):
+                    if job.run() is False:
+                        raise RuntimeError("Download backend failed")
+            except Exception as err:
+                error = err
+                msg = "{} failed (attempt {} of {}): {}"
+                msg = msg.format(job.name, 1 + attempt, 1 + self.retries, err)
+                print(msg, file=sys.stderr)
+            else:
+                error = None
+                break
+        
+        result = JobResult(job, error, 1 + attempt, time.time() - start)
+        with self._lock:
+            self.results.append(result)
+    
+    @contextmanager
+    def _host_slot(self, host):
+        if self.max_per_host is None:
+            yield
+            return
+        with self._lock:
+            slots = self._hosts.get(host)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.max_per_host)
+                self._hosts[host] = slots
+        with slots:
+            yield
+
+class DownloadJob:
+    """Job for the Scheduler that downloads a programme"""
+    
+    def __init__(self, name, url, dest_file, index=None, episode=dict()):
+        """If an EpisodeIndex is given, the episode is added to it once the
+        download is complete"""
+        self.name = name
+        self.url = url
+        self.dest_file = dest_file
+        self.index = index
+        self.episode = episode
+        self._fetcher = None
+        self._refresh_auth = False
+    
+    def host(self):
+        if self._fetcher is None:
+            self._fetcher = fetch.get_fetcher(self.url,
+                refresh_auth=self._refresh_auth)
+        return self._fetcher.host
+    
+    def run(self):
+        # Get a new fetcher for any retry, with fresh authentication if
+        # the saved auth token was rejected
+        (fetcher, self._fetcher) = (self._fetcher, None)
+        try:
+            result = fetcher.fetch(execvp=False, dest_file=self.dest_file,
+                quiet=True, frontend=None)
+        except Exception as error:
+            if fetch.auth_rejected(fetcher, error):
+                self._refresh_auth = True
+            raise
+        if result is not False and self.index is not None:
+            id = self.episode.get("id")
+            if id is not None:
+                self.index.add(id, size=os.path.getsize(self.dest_file),
+                    duration=self.episode.get("duration"))
+        return result
+
+class EpisodeIndex:
+    """Persistent record of downloaded episodes
+    
+    Episodes are keyed by their "id" from the iView API, and the size,
+    duration and completion time of each download are recorded.
+    Downloaded subtitles are recorded separately. The record is a "dbm"
+    database, so looking up an episode does not load
+    the whole record. Safe to use from multiple threads."""
+    
+    def __init__(self, filename):
+        self._db = dbm.open(filename, "c")
+        self._lock = threading.Lock()
+    
+    def __contains__(self, id):
+        with self._lock:
+            return id.encode("utf-8") in self._db
+    
+    def get(self, id):
+        """Returns a dict() with "size", "duration" and "completed" keys,
+        or None if the episode has not been downloaded"""
+        with self._lock:
+            record = self._db.get(id.encode("utf-8"))
+        if record is None:
+            return None
+        return json.loads(record.decode("ascii"))
+    
+    def add(self, id, *, size=None, duration=None, completed=None):
+        if completed is None:
+            completed = time.time()
+        record = dict(size=size, duration=duration, completed=completed)
+        self._put(id, record)
+    
+    def has_captions(self, id):
+        """True if subtitles for the episode have been downloaded"""
+        return CAPTIONS_PREFIX + id in self
+    
+    def add_captions(self, id, *, completed=None):
+        if completed is None:
+            completed = time.time()
+        self._put(CAPTIONS_PREFIX + id, dict(completed=completed))
+    
+    def _put(self, key, record):
+        record = json.dumps(record).encode("ascii")
+        with self._lock:
+            self._db[key.encode("utf-8")] = record
+            sync = getattr(self._db, "sync", None)
+            if sync:
+                sync()
+    
+    def close(self):
+        self._db.close()
+    
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        self.close()
+
+CAPTIONS_PREFIX = "captions:"
+
+class JobResult:
+    def __init__(self, job, error, attempts, elapsed):
+        self.job = job
+        self.error = error
+        self.attempts = attempts
+        self.elapsed = elapsed
+    
+    @property
+    def failed(self):
+        return self.error is not None
+
+def summary(results):
+    """Yields lines of text reporting the results of a batch of jobs"""
+    failed = sum(result.failed for result in results)
+    yield "{} downloaded, {} failed".format(len(results) - failed, failed)
+    for result in results:
+        if result.failed:
+            status = "failed: {}".format(result.error)
+        else:
+            status = "done"
+        msg = "\t{}: {} ({} attempt{}, {:.0F} s)".format(
+            result.job.name, status, result.attempts,
+            "" if result.attempts == 1 else "s", result.elapsed)
+        yield msg
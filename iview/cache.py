@@ -0,0 +1,271 @@
+"""On-disk cache of HTTP responses
+
+Entries are keyed by the full URL, and their freshness follows the
+"Cache-Control", "Expires", "Date" and "Age" response headers. Stale
+entries with an "ETag" or "Last-Modified" validator can be revalidated
+with a conditional request. Bodies are stored as received, so gzip-encoded
+responses stay compressed on disk. When the total size of the cache
+exceeds a limit, the least recently used entries are removed.
+
+Parsed responses that are expensive to get again, such as the iView
+config, can also be kept in the same directory for a fixed time.
+"""
+
+import os
+import json
+import gzip
+import zlib
+import time
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from email.utils import parsedate_tz, mktime_tz
+
+class HttpCache:
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+    
+    def lookup(self, url):
+        """Returns the CacheEntry for a URL, or None if not cached"""
+        path = self._path(url)
+        try:
+            with open(path, "rb") as file:
+                metadata = json.loads(file.readline().decode("utf-8"))
+                offset = file.tell()
+            os.utime(path)  # Most recently used
+        except (EnvironmentError, ValueError):
+            return None
+        if metadata.get("url") != url:
+            return None
+        return CacheEntry(path, offset, metadata)
+    
+    def store(self, url, headers, body):
+        """Stores a 200 response, unless it is not cacheable
+        
+        The "headers" parameter is an "email.message.Message" object, as
+        returned by "http.client.HTTPResponse.info()", and "body" is the
+        undecoded response body."""
+        
+        now = time.time()
+        expires = freshness(headers, now)
+        if expires is None:  # "no-store"
+            self.remove(url)
+            return
+        metadata = dict(
+            url=url,
+            expires=int(expires),
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+            encoding=headers.get("Content-Encoding"),
+        )
+        if (expires <= now and metadata["etag"] is None and
+        metadata["last_modified"] is None):
+            return  # Would never be used
+        self._write(url, metadata, body)
+        self.evict()
+    
+    def revalidate(self, entry, headers):
+        """Updates an entry from the headers of a 304 response"""
+        metadata = dict(entry.metadata)
+        expires = freshness(headers, time.time())
+        if expires is None:
+            self.remove(metadata["url"])
+            return
+        metadata["expires"] = int(expires)
+        for (key, header) in (
+            ("etag", "ETag"),
+            ("last_modified", "Last-Modified"),
+        ):
+            value = headers.get(header)
+            if value is not None:
+                metadata[key] = value
+        self._write(metadata["url"], metadata, entry.raw())
+        self.evict()
+    
+    def remove(self, url):
+        try:
+            os.remove(self._path(url))
+        except EnvironmentError:
+            pass
+    
+    def evict(self):
+        """Removes least recently used entries to fit the size limit"""
+        if self.max_size is None:
+            return
+        entries = list()
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except EnvironmentError:
+                continue  # Removed by another thread or process
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        
+        entries.sort()
+        for (_, size, path) in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except EnvironmentError:
+                continue
+            total -= size
+    
+    def _path(self, url):
+        name = sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + SUFFIX)
+    
+    def _write(self, url, metadata, body):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        
+        # Write to a temporary file and rename it, so that concurrent
+        # readers never see an incomplete entry
+        with NamedTemporaryFile("wb", dir=self.directory, prefix=".",
+        delete=False) as file:
+            file.write(json.dumps(metadata).encode("utf-8"))
+            file.write(b"\n")
+            file.write(body)
+        os.replace(file.name, self._path(url))
+
+SUFFIX = ".http"
+
+class CacheEntry:
+    def __init__(self, path, offset, metadata):
+        self.path = path
+        self.offset = offset
+        self.metadata = metadata
+    
+    def fresh(self):
+        return time.time() < self.metadata["expires"]
+    
+    def validators(self):
+        """Returns headers for a conditional request"""
+        headers = dict()
+        if self.metadata["etag"] is not None:
+            headers["If-None-Match"] = self.metadata["etag"]
+        if self.metadata["last_modified"] is not None:
+            headers["If-Modified-Since"] = self.metadata["last_modified"]
+        return headers
+    
+    def raw(self):
+        """Returns the body as received"""
+        with open(self.path, "rb") as file:
+            file.seek(self.offset)
+            return file.read()
+    
+    def read(self):
+        """Returns the body with any content encoding removed"""
+        return decode_body(self.metadata["encoding"], self.raw())
+
+class SessionCache:
+    """Values kept between runs for a fixed time
+    
+    Each value is stored with a key, such as the URL it was parsed from,
+    and is only used while the key matches. Values must be serializable
+    as JSON."""
+    
+    def __init__(self, directory):
+        self.directory = directory
+    
+    def get(self, name, key, ttl):
+        """Returns a value saved less than "ttl" seconds ago, or None"""
+        try:
+            with open(self._path(name), "rb") as file:
+                saved = json.loads(file.read().decode("utf-8"))
+        except (EnvironmentError, ValueError):
+            return None
+        if saved.get("key") != key:
+            return None
+        if not 0 <= time.time() - saved.get("time", 0) < ttl:
+            return None
+        return saved.get("value")
+    
+    def set(self, name, key, value):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        saved = dict(key=key, time=time.time(), value=value)
+        with NamedTemporaryFile("wb", dir=self.directory, prefix=".",
+        delete=False) as file:
+            file.write(json.dumps(saved).encode("utf-8"))
+        os.replace(file.name, self._path(name))
+    
+    def remove(self, name):
+        try:
+            os.remove(self._path(name))
+        except EnvironmentError:
+            pass
+    
+    def _path(self, name):
+        return os.path.join(self.directory, name + SESSION_SUFFIX)
+
+SESSION_SUFFIX = ".session"
+
+def decode_body(encoding, body):
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    return body
+
+def body_decoder(encoding):
+    """Returns a function that decodes successive chunks of a body"""
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+    return bytes
+
+def freshness(headers, now):
+    """Returns the time until which a response is fresh
+    
+    Returns None if the response must not be stored."""
+    
+    directives = dict()
+    for header in headers.get_all("Cache-Control") or ():
+        for directive in header.split(","):
+            (name, _, value) = directive.partition("=")
+            directives[name.strip().lower()] = value.strip().strip('"')
+    
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return now
+    
+    try:
+        age = int(headers.get("Age", 0))
+    except ValueError:
+        age = 0
+    
+    max_age = directives.get("max-age")
+    if max_age is not None:
+        try:
+            return now + int(max_age) - age
+        except ValueError:
+            return now
+    
+    date = http_date(headers.get("Date"))
+    if date is None:
+        date = now
+    expires = headers.get("Expires")
+    if expires is not None:
+        expires = http_date(expires)
+        if expires is None:  # Invalid dates mean already expired
+            return now
+        return now + expires - date - age
+    
+    # Heuristic freshness of 10% of the time since last modification
+    last_modified = http_date(headers.get("Last-Modified"))
+    if last_modified is not None:
+        return now + max(date - last_modified, 0) / 10 - age
+    
+    return now
+
+def http_date(value):
+    """Parses an HTTP date into a timestamp, or returns None"""
+    if value is None:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return mktime_tz(parsed)
@@ -1,11 +1,14 @@
-import os
 import urllib.request
 import sys
+import os
 from . import config
 from . import parser
-import gzip
+from . import cache
 from urllib.parse import urljoin, urlsplit
 from urllib.parse import urlencode
+from urllib.error import HTTPError
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 iview_config = None
@@ -14,7 +17,17 @@ def fetch_url(url):
 	"""	Simple function that fetches a URL using urllib.
 		An exception is raised if an error (e.g. 404) occurs.
 	"""
+	with open_url(url) as http:
+		return cache.decode_body(http.info().get('content-encoding'),
+			http.read())
+
+@contextmanager
+def open_url(url, headers=()):
+	"""	Opens a URL relative to the iView base URL, including the
+		headers set up by get_config(), and yields the response.
+	"""
 	url = urljoin(config.base_url, url)
+	headers = dict(iview_config['headers'], **dict(headers))
 	
 	# Not using plain urlopen() because the combination of
 	# urlopen()'s "Connection: close" header and
@@ -23,39 +36,72 @@ def fetch_url(url):
 	from .utils import PersistentConnectionHandler
 	with PersistentConnectionHandler() as connection:
 		session = urllib.request.build_opener(connection)
-		req = urllib.request.Request(url,
-			headers=iview_config['headers'])
+		req = urllib.request.Request(url, headers=headers)
 		with session.open(req) as http:
-			headers = http.info()
-			if headers.get('content-encoding') == 'gzip':
-				return gzip.GzipFile(fileobj=http).read()
-			else:
-				return http.read()
+			yield http
 
 def maybe_fetch(url):
-	"""	Only fetches a URL if it is not in the cache directory.
-		In practice, this is really bad, and only useful for saving
-		bandwidth when debugging. For one, it doesn't respect
-		HTTP's wishes. Also, iView, by its very nature, changes daily.
+	"""	Fetches a URL, going through the cache directory if one is
+		configured. Cached responses are used for as long as the HTTP
+		headers allow, and then revalidated with a conditional request
+		if possible.
+	"""
+	return b''.join(iter_url(url))
+
+def iter_url(url):
+	"""	Like maybe_fetch(), but yields the response body in chunks as
+		it arrives.
 	"""
 
 	if not config.cache:
-		return fetch_url(url)
+		with open_url(url) as http:
+			yield from iter_body(http)
+		return
 
-	if not os.path.isdir(config.cache):
-		os.mkdir(config.cache)
+	url = urljoin(config.base_url, url)
+	http_cache = cache.HttpCache(config.cache, config.cache_size)
+	entry = http_cache.lookup(url)
+	if entry is None:
+		validators = ()
+	elif entry.fresh():
+		yield entry.read()
+		return
+	else:
+		validators = entry.validators()
 
-	filename = os.path.join(config.cache, url.rsplit('/', 1)[-1])
+	try:
+		with open_url(url, validators) as http:
+			headers = http.info()
+			data = list()
+			
+			# Keep the undecoded body for the cache
+			decode = cache.body_decoder(headers.get('content-encoding'))
+			for chunk in iter_body(http, decode=False):
+				data.append(chunk)
+				yield decode(chunk)
+	except HTTPError as error:
+		if entry is None or error.code != 304:
+			raise
+		data = entry.read()
+		http_cache.revalidate(entry, error.headers)
+		yield data
+		return
 
-	if os.path.isfile(filename):
-		with open(filename, 'rb') as f:
-			data = f.read()
-	else:
-		data = fetch_url(url)
-		with open(filename, 'wb') as f:
-			f.write(data)
+	http_cache.store(url, headers, b''.join(data))
 
-	return data
+def iter_body(http, decode=True):
+	"""	Yields the body of an HTTP response in chunks as it arrives,
+		with any content encoding removed unless "decode" is false.
+	"""
+	if decode:
+		decode = cache.body_decoder(http.info().get('content-encoding'))
+	while True:
+		chunk = http.read1(0x10000)
+		if not chunk:
+			break
+		if decode:
+			chunk = decode(chunk)
+		yield chunk
 
 def get_config(headers=()):
 	"""	This function fetches the iView "config". Among other things,
@@ -64,6 +110,22 @@ def get_config(headers=()):
 	"""
 	global iview_config
 
+	iview_config = dict(headers=config_headers(headers))
+	url = urljoin(config.base_url, config.config_url)
+	session = session_cache()
+	parsed = None
+	if session is not None:
+		parsed = session.get('config', url, config.config_ttl)
+	if parsed is None:
+		parsed = parser.parse_config(maybe_fetch(url))
+		if session is not None:
+			session.set('config', url, parsed)
+	iview_config.update(parsed)
+
+def config_headers(headers=()):
+	"""	Returns the HTTP headers to send with each request, given
+		any extra headers from the caller.
+	"""
 	headers = dict(headers)
 	try:
 		headers['User-Agent'] = headers['User-Agent'] + ' '
@@ -71,25 +133,46 @@ def get_config(headers=()):
 		headers['User-Agent'] = ''
 	headers['User-Agent'] += config.user_agent
 	headers['Accept-Encoding'] = 'gzip'
-	iview_config = dict(headers=headers)
-	
-	parsed = parser.parse_config(maybe_fetch(config.config_url))
-	iview_config.update(parsed)
+	return headers
 
-def get_auth():
+def get_auth(refresh=False):
 	""" This function performs an authentication handshake with iView.
 		Among other things, it tells us if the connection is unmetered,
 		and gives us a one-time token we need to use to speak RTSP with
 		ABC's servers, and tells us what the RTMP URL is.
+		
+		The response is saved in the cache directory, if configured,
+		and used again for "config.auth_ttl" seconds unless "refresh" is
+		set. The "saved" item of the result indicates if a saved
+		response was used.
 	"""
+	url = urljoin(config.base_url, auth_url(iview_config))
+	session = session_cache()
+	auth = None
+	if session is not None and not refresh:
+		auth = session.get('auth', url, config.auth_ttl)
+	saved = auth is not None
+	if not saved:
+		auth = fetch_url(url).decode('utf-8')
+		if session is not None:
+			session.set('auth', url, auth)
+	auth = parser.parse_auth(auth, iview_config)
+	auth['saved'] = saved
+	return auth
+
+def session_cache():
+	if not config.cache:
+		return None
+	return cache.SessionCache(config.cache)
+
+def auth_url(iview_config):
 	auth = iview_config['auth_url']
 	if config.ip:
 		query = urlsplit(auth).query
 		query = query and query + "&"
 		query += urlencode((("ip", config.ip),))
 		auth = urljoin(auth, "?" + query)
-	auth = fetch_url(auth)
-	return parser.parse_auth(auth, iview_config)
+	return auth
 
 def get_categories():
 	"""Returns the list of categories
@@ -116,7 +199,12 @@ def get_series_items(series_id, get_meta=False):
 	"""
 
 	series = series_api('series', series_id)
+	return find_series_items(series, series_id, get_meta)
 
+def find_series_items(series, series_id, get_meta=False):
+	"""	Finds a series in the result of series_api() and returns
+		the same as get_series_items().
+	"""
 	for meta in series:
 		if meta['id'] == series_id:
 			break
@@ -131,15 +219,45 @@ def get_series_items(series_id, get_meta=False):
 	else:
 		return items
 
+def get_series_items_many(series_ids, concurrency=4, get_meta=False):
+	"""	Fetches several series like get_series_items(), making up to
+		"concurrency" API calls at once. Yields a (series_id, result)
+		tuple for each series as soon as it is ready, where "result" is
+		what get_series_items() returns.
+	"""
+	with ThreadPoolExecutor(concurrency) as executor:
+		futures = dict()
+		for series_id in series_ids:
+			future = executor.submit(get_series_items, series_id, get_meta)
+			futures[future] = series_id
+		try:
+			for future in as_completed(futures):
+				yield (futures[future], future.result())
+		finally:
+			for future in futures:
+				future.cancel()
+
 def get_keyword(keyword):
 	return series_api('keyword', keyword)
 
+def iter_keyword(keyword):
+	"""	Like get_keyword(), but yields each series as soon as it is
+		received, in the order of the response rather than by title.
+	"""
+	return iter_series_api('keyword', keyword)
+
 def series_api(key, value=""):
-	query = urlencode(((key, value),))
-	url = urljoin(iview_config['api_url'], '?' + query)
-	index_data = maybe_fetch(url)
+	index_data = maybe_fetch(series_api_url(iview_config, key, value))
 	return parser.parse_series_api(index_data)
 
+def iter_series_api(key, value=""):
+	url = series_api_url(iview_config, key, value)
+	return parser.iter_series_api(iter_url(url))
+
+def series_api_url(iview_config, key, value=""):
+	query = urlencode(((key, value),))
+	return urljoin(iview_config['api_url'], '?' + query)
+
 def get_highlights():
 
 	highlightXML = maybe_fetch(iview_config['highlights'])
@@ -151,11 +269,53 @@ def get_captions(url):
 		parse_subtitle(), which converts it to SRT format.
 	"""
 
-	captions_url = iview_config['captions_url'] + '%s.xml'
-
-	xml = maybe_fetch(captions_url % url)
+	xml = maybe_fetch(captions_url(iview_config, url))
 	return parser.parse_captions(xml)
 
+def write_captions(url, output):
+	"""	Like get_captions(), but writes the SRT captions to the "output"
+		text file while the captions file is being downloaded.
+	"""
+	xml = iter_url(captions_url(iview_config, url))
+	parser.write_captions(xml, output)
+
+def write_captions_many(captions, concurrency=4):
+	"""	Downloads several captions files to SRT files, up to
+		"concurrency" at once, given (url, filename) pairs. Connections
+		are shared through the connection pool. Each file is written
+		under a temporary name, and renamed once it is complete. Yields
+		a (url, filename, error) tuple for each file as soon as it is
+		done, where "error" is the exception raised, or None.
+	"""
+	with ThreadPoolExecutor(concurrency) as executor:
+		futures = dict()
+		for (url, filename) in captions:
+			future = executor.submit(write_captions_file, url, filename)
+			futures[future] = (url, filename)
+		try:
+			for future in as_completed(futures):
+				(url, filename) = futures[future]
+				yield (url, filename, future.exception())
+		finally:
+			for future in futures:
+				future.cancel()
+
+def write_captions_file(url, filename):
+	partial = filename + '.part'
+	try:
+		with open(partial, 'w', encoding='utf-8', newline='') as output:
+			write_captions(url, output)
+	except BaseException:
+		try:
+			os.remove(partial)
+		except FileNotFoundError:
+			pass # Not even opened
+		raise
+	os.replace(partial, filename)
+
+def captions_url(iview_config, url):
+	return iview_config['captions_url'] + '%s.xml' % url
+
 def configure_socks_proxy():
 	"""	Import the modules necessary to support usage of a SOCKS proxy
 		and configure it using the current settings in iview.config
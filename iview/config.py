@@ -37,9 +37,34 @@ akamaihd_player = "7ob1gDzeD6B33Q6WHsCoIlv6HQhCmcM4WGc36Y6bD+Q="
 socks_proxy_host = None
 socks_proxy_port = 1080
 
-# Cache directory to use for debugging
+# Directory for caching responses from iView, or 'None' to disable caching.
+# Responses are cached for as long as their HTTP headers allow.
 cache = None
 
+# Maximum total size of the cache directory, in bytes
+cache_size = 50 * 10**6
+
+# Seconds to keep using the parsed iView config and auth response saved in
+# the cache directory by a previous run, saving two requests at start-up.
+# A saved auth token rejected by the streaming host is replaced
+# automatically.  Use 0 to always fetch them again.
+config_ttl = 24 * 60 * 60
+auth_ttl = 10 * 60
+
+# Number of HDS fragments to download concurrently, or 'None' to download
+# them one at a time
+hds_workers = None
+
+# HDS media rendition: 'None' for the first one listed, 'highest', 'lowest',
+# a maximum bitrate in kb/s, or 'adaptive' to switch between them depending
+# on the download speed
+hds_bitrate = None
+
+# How to download RTMP live streams: 'rtmpdump' runs the "rtmpdump" or
+# "flvstreamer" program for each stream, while 'builtin' downloads plain
+# "rtmp:" streams in-process, without SWF verification
+live_rtmp_backend = 'rtmpdump'
+
 # Name of streaming host to override, or 'None' to use the host from the auth
 # response.  The host name should be one of the keys in 'stream_hosts', or
 # the special value 'default', which invokes a default server from the config
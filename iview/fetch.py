@@ -6,8 +6,12 @@ import threading
 import re
 from locale import getpreferredencoding
 from . import hds
+from . import rtmp
 from urllib.parse import urlsplit, urljoin
+from urllib.error import HTTPError
 import sys
+from functools import partial
+from time import monotonic
 
 def get_filename(url):
 	return url.rsplit('/', 1)[-1].rsplit('.', 1)[0] + '.flv'
@@ -19,7 +23,7 @@ frontend=None, **kw):
 	Accepts the following extra keyword arguments, which map to the
 	corresponding "rtmpdump" options:
 	
-	rtmp, host, app, playpath, flv, swfVfy, resume, live"""
+	rtmp, host, app, playpath, flv, swfVfy, start, stop, resume, live"""
 	
 	executables = (
 			'rtmpdump',
@@ -33,11 +37,12 @@ frontend=None, **kw):
 		#	'-V', # verbose
 		]
 	
-	for param in ("flv", "rtmp", "host", "app", "playpath", "swfVfy"):
+	for param in ("flv", "rtmp", "host", "app", "playpath", "swfVfy",
+	"start", "stop"):
 		arg = kw.pop(param, None)
 		if arg is None:
 			continue
-		args.extend(("--" + param, arg))
+		args.extend(("--" + param, str(arg)))
 
 	if live:
 		args.append("--live")
@@ -71,6 +76,7 @@ frontend=None, **kw):
 				os.execvp(args[0], args)
 			else:
 				subprocess.check_call(args)
+				return True
 		except OSError:
 			print('Could not execute %s, trying another...' % exec_attempt, file=sys.stderr)
 			continue
@@ -81,19 +87,63 @@ See the README.md file for more information about setting this up properly.""",
 		file=sys.stderr)
 	return False
 
-def readupto(fh, upto):
-	"""	Reads up to (and not including) the character
-		specified by arg 'upto'.
+def read_lines(fh, size=0x10000):
+	"""	Yields a list of the lines completed by each read from a pipe,
+		ending at either a carriage return or a line feed. Each read
+		takes whatever is available, up to "size" bytes, rather than
+		waiting for a full line.
 	"""
-	result = bytearray()
+	pending = b''
 	while True:
-		char = fh.read(1)
-		if not char or char == upto:
-			return bytes(result)
-		else:
-			result.extend(char)
+		chunk = fh.read1(size)
+		if not chunk: # i.e. EOF, the process has quit
+			break
+		lines = LINE_BREAK.split(pending + chunk)
+		pending = lines.pop()
+		yield [line for line in lines if line]
+	if pending:
+		yield [pending]
+
+LINE_BREAK = re.compile(br'[\r\n]')
+
+class Progress:
+	"""	Download progress parsed from "rtmpdump" output. Either
+		attribute is None until it has been reported.
+	"""
+	__slots__ = ('fraction', 'size')
+	
+	def __init__(self, fraction=None, size=None):
+		self.fraction = fraction
+		self.size = size
+	
+	def update(self, line):
+		"""	Updates from a line of output, returning False if it is
+			not a progress line
+		"""
+		progress_search = PROGRESS_PATTERN.search(line)
+		size_search = SIZE_PATTERN.search(line)
+		if progress_search is not None:
+			# [:-1] shaves the % off the end
+			self.fraction = float(progress_search.group()[:-1]) / 100.
+		if size_search is not None:
+			self.size = float(size_search.group()[:-3]) * 1024
+		return progress_search is not None or size_search is not None
+	
+	def send(self, frontend):
+		if self.fraction is not None:
+			frontend.set_fraction(self.fraction)
+		if self.size is not None:
+			frontend.set_size(self.size)
+
+PROGRESS_PATTERN = re.compile(br'\d+\.\d%')
+SIZE_PATTERN = re.compile(br'\d+\.\d+ kB', re.IGNORECASE)
 
 class RtmpWorker(threading.Thread):
+	"""	Runs "rtmpdump", passing its progress on to a frontend at most
+		every "update_interval" seconds
+	"""
+	update_interval = 0.2
+	
 	def __init__(self, args, frontend):
 		threading.Thread.__init__(self)
 		self.frontend = frontend
@@ -108,26 +158,25 @@ class RtmpWorker(threading.Thread):
 	def run(self):
 		with self.job:
 			encoding = getpreferredencoding()
-			progress_pattern = re.compile(br'\d+\.\d%')
-			size_pattern = re.compile(br'\d+\.\d+ kB',
-				re.IGNORECASE)
-
-			while True:
-				r = readupto(self.job.stderr, b'\r')
-				if not r: # i.e. EOF, the process has quit
-					break
-				progress_search = progress_pattern.search(r)
-				size_search = size_pattern.search(r)
-				if progress_search is not None:
-					p = float(progress_search.group()[:-1]) / 100. # [:-1] shaves the % off the end
-					self.frontend.set_fraction(p)
-				if size_search is not None:
-					self.frontend.set_size(float(size_search.group()[:-3]) * 1024)
-				if (progress_search is None and
-				size_search is None):
-					msg = 'Backend debug:\t'
-					msg += r.decode(encoding)
-					print(msg, file=sys.stderr)
+			progress = Progress()
+			changed = False
+			sent = None
+			for lines in read_lines(self.job.stderr):
+				for line in lines:
+					if progress.update(line):
+						changed = True
+					else:
+						msg = 'Backend debug:\t'
+						msg += line.decode(encoding)
+						print(msg, file=sys.stderr)
+				now = monotonic()
+				if changed and (sent is None or
+				now - sent >= self.update_interval):
+					progress.send(self.frontend)
+					changed = False
+					sent = now
+			if changed:
+				progress.send(self.frontend)
 
 		returncode = self.job.returncode
 		if returncode == 0: # EXIT_SUCCESS
@@ -140,22 +189,39 @@ class RtmpWorker(threading.Thread):
 				self.frontend.done(stopped=True)
 
 def fetch_program(url=None, *, item=dict(),
-execvp=False, dest_file=None, quiet=False, frontend=None):
+execvp=False, dest_file=None, quiet=False, frontend=None,
+start=None, end=None):
+	"""Downloads a programme
+	
+	The "start" and "end" parameters limit the download to part of the
+	programme, given in seconds from the beginning."""
 	if dest_file is None:
 		dest_file = get_filename(item.get("url", url))
 	
+	kw = dict(execvp=execvp, dest_file=dest_file, quiet=quiet,
+		frontend=frontend, start=start, end=end)
 	fetcher = get_fetcher(url, item=item)
-	return fetcher.fetch(execvp=execvp, dest_file=dest_file,
-		quiet=quiet, frontend=frontend)
+	try:
+		return fetcher.fetch(**kw)
+	except HTTPError as error:
+		if not auth_rejected(fetcher, error):
+			raise
+	fetcher = get_fetcher(url, item=item, refresh_auth=True)
+	return fetcher.fetch(**kw)
 
-def get_fetcher(url=None, *, item=dict()):
+def get_fetcher(url=None, *, item=dict(), refresh_auth=False, auth=None):
+	"""	Returns an object for downloading a programme, with a "host"
+		attribute and a fetch() method. The response from get_auth() is
+		used unless "auth" is given.
+	"""
 	RTMP_PROTOCOLS = {'rtmp', 'rtmpt', 'rtmpe', 'rtmpte'}
 	
 	url = item.get("url", url)
 	if urlsplit(url).scheme in RTMP_PROTOCOLS:
 		return RtmpFetcher(url, live=True)
 	
-	auth = comm.get_auth()
+	if auth is None:
+		auth = comm.get_auth(refresh=refresh_auth)
 	protocol = urlsplit(auth['server']).scheme
 	if protocol in RTMP_PROTOCOLS:
 		(url, ext) = url.rsplit('.', 1) # strip the extension (.flv or .mp4)
@@ -175,13 +241,28 @@ def get_fetcher(url=None, *, item=dict()):
 	else:
 		return HdsFetcher(url, auth)
 
+def auth_rejected(fetcher, error):
+	"""	True if an error was probably caused by a saved auth token that
+		is no longer accepted, so that it is worth trying again with
+		get_fetcher(refresh_auth=True)
+	"""
+	return (isinstance(error, HTTPError) and error.code == 403 and
+		fetcher.saved_auth)
+
 class RtmpFetcher:
+	saved_auth = False
+	
 	def __init__(self, url, **params):
 		params["rtmp"] = url
 		params["swfVfy"] = urljoin(config.base_url, config.swf_url)
 		self.params = params
+		self.host = urlsplit(url).hostname
 	
-	def fetch(self, *, dest_file, **kw):
+	def fetch(self, *, dest_file, start=None, end=None, **kw):
+		if self.builtin():
+			return self.fetch_builtin(dest_file=dest_file,
+				start=start, end=end, **kw)
+		
 		resume = (not self.params.get("live", False) and
 			dest_file != '-')
 		if resume:
@@ -196,27 +277,74 @@ class RtmpFetcher:
 				# itself fail later on
 				pass
 		kw.update(self.params)
-		return rtmpdump(flv=dest_file, resume=resume, **kw)
+		return rtmpdump(flv=dest_file, resume=resume,
+			start=start, stop=end, **kw)
+	
+	def builtin(self):
+		"""	True if the stream is downloaded in-process rather than by
+			"rtmpdump"; see "config.live_rtmp_backend"
+		"""
+		return (self.params.get("live", False) and
+			config.live_rtmp_backend == 'builtin' and
+			urlsplit(self.params["rtmp"]).scheme == 'rtmp')
+	
+	def fetch_builtin(self, *, frontend, execvp, quiet=False, **kw):
+		params = dict(
+			playpath=self.params.get("playpath"),
+			live=self.params.get("live", False),
+			swf_url=self.params["swfVfy"],
+		)
+		if frontend is None:
+			call = rtmp_open_file
+		else:
+			frontend.resumable = False
+			call = partial(FetchThread, rtmp_open_file)
+		return call(self.params["rtmp"], frontend=frontend, quiet=quiet,
+			**params, **kw)
 
 class HdsFetcher:
 	def __init__(self, file, auth):
 		self.url = urljoin(auth['server'], auth['path'])
+		self.host = urlsplit(self.url).hostname
 		self.file = file
 		self.tokenhd = auth.get('tokenhd')
+		self.saved_auth = auth.get('saved', False)
 	
-	def fetch(self, *, frontend, execvp, quiet, **kw):
+	def fetch(self, *, frontend, execvp, **kw):
 		if frontend is None:
 			call = hds_open_file
 		else:
-			call = HdsThread
-		return call(self.url, self.file, self.tokenhd,
-			frontend=frontend,
+			frontend.resumable = kw["dest_file"] != "-"
+			call = partial(FetchThread, hds_open_file)
+		return call(*self.args(), frontend=frontend, **self.params(), **kw)
+	
+	def stream(self, output, *, frontend=None, **kw):
+		"""Downloads the programme to a file object, such as a socket
+		
+		No journal is kept, and progress is only reported to any
+		frontend."""
+		return hds.fetch(*self.args(), dest_file=output,
+			frontend=frontend, quiet=frontend is None,
+			**self.params(), **kw)
+	
+	def args(self):
+		return (self.url, self.file, self.tokenhd)
+	
+	def params(self):
+		return dict(
 			player=config.akamaihd_player,
-			key=config.akamaihd_key, **kw)
+			key=config.akamaihd_key,
+			workers=config.hds_workers,
+			bitrate=config.hds_bitrate,
+		)
 
-class HdsThread(threading.Thread):
-	def __init__(self, *pos, frontend, **kw):
+class FetchThread(threading.Thread):
+	"""	Runs a download function, such as hds_open_file(), reporting
+		the outcome to a frontend
+	"""
+	def __init__(self, func, *pos, frontend, **kw):
 		threading.Thread.__init__(self)
+		self.func = func
 		self.frontend = frontend
 		self.pos = pos
 		self.kw = kw
@@ -227,7 +355,7 @@ class HdsThread(threading.Thread):
 	
 	def run(self):
 		try:
-			hds_open_file(*self.pos, frontend=self.frontend,
+			self.func(*self.pos, frontend=self.frontend,
 				abort=self.abort, **self.kw)
 		except Exception:
 			self.frontend.done(failed=True)
@@ -239,9 +367,42 @@ class HdsThread(threading.Thread):
 			self.frontend.done()
 
 def hds_open_file(*pos, dest_file, **kw):
-	'''Handle special file name "-" representing "stdout"'''
+	'''Handle special file name "-" representing "stdout"
+	
+	Otherwise a journal file is kept alongside the destination file while
+	downloading, so that an interrupted download can be resumed.'''
 	if dest_file == "-":
 		return hds.fetch(*pos, dest_file=sys.stdout.buffer, **kw)
+	
+	journal = hds.Journal(journal_file(dest_file))
+	file = None
+	if journal.load():
+		try:
+			file = open(dest_file, "r+b")
+		except EnvironmentError:
+			pass
+		else:
+			if os.fstat(file.fileno()).st_size < journal.size:
+				journal.media = None  # Start again
+	if file is None:
+		file = open(dest_file, "wb")
+		journal.media = None
+	
+	with file:
+		result = hds.fetch(*pos, dest_file=file, journal=journal, **kw)
+	journal.remove()
+	return result
+
+def rtmp_open_file(*pos, dest_file, **kw):
+	'''Handle special file name "-" representing "stdout"'''
+	if dest_file == "-":
+		rtmp.fetch(*pos, dest_file=sys.stdout.buffer, **kw)
 	else:
-		with open(dest_file, "wb") as dest_file:
-			return hds.fetch(*pos, dest_file=dest_file, **kw)
+		with open(dest_file, "wb") as file:
+			rtmp.fetch(*pos, dest_file=file, **kw)
+	return True
+
+def journal_file(dest_file):
+	'''Name of the file recording progress of an HDS download'''
+	return dest_file + '.journal'
+
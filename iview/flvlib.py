@@ -1,11 +1,11 @@
-from .utils import fastforward, CounterWriter
+from .utils import fastforward, CounterWriter, BinaryReader
 from struct import Struct
 from .utils import read_int
 from .utils import setitem
 
 def main():
     from sys import stdin
-    flv = stdin.buffer
+    flv = BinaryReader(stdin.buffer)
     print("signature", flv.read(3))
     (version, flags) = flv.read(2)
     audio = bool(flags & 1 << 2)
@@ -37,32 +37,47 @@ def write_file_header(flv, audio=True, video=True):
     flv.write((0).to_bytes(4, "big"))  # Previous tag size
 
 def write_scriptdata(flv, metadata):
+    write_tag(flv, TAG_SCRIPTDATA, 0, metadata)
+
+def write_tag(flv, type, timestamp, data):
+    """Writes a tag and its "previous tag size" field"""
     counter = CounterWriter(flv)
-    counter.write(bytes((TAG_SCRIPTDATA,)))
-    counter.write(len(metadata).to_bytes(3, "big"))
-    counter.write((0).to_bytes(3, "big"))  # Timestamp
-    counter.write(bytes((0,)))  # Timestamp extension
+    counter.write(bytes((type,)))
+    counter.write(len(data).to_bytes(3, "big"))
+    counter.write((timestamp & 0xFFFFFF).to_bytes(3, "big"))
+    counter.write(bytes((timestamp >> 24 & 0xFF,)))  # Timestamp extension
     counter.write((0).to_bytes(3, "big"))  # Stream id
-    counter.write(metadata)
+    counter.write(data)
     flv.write(counter.tell().to_bytes(4, "big"))
 
 def read_tag_header(flv):
-    flags = flv.read(1)
-    if not flags:
+    header = flv.read(TAG_HEADER.size)
+    if not header:
         return None
-    (flags,) = flags
-    length = read_int(flv, 3)
-    timestamp = read_int(flv, 3)
-    (extension,) = SBYTE.unpack(flv.read(1))
-    streamid = read_int(flv, 3)
+    assert len(header) == TAG_HEADER.size
+    return parse_tag_header(header)
+
+def parse_tag_header(header):
+    """Parses the 11-byte header at the start of a byte string"""
+    (first, second, streamhigh, streamlow) = TAG_HEADER.unpack_from(header)
+    flags = first >> 24
+    extension = second & 0xFF
+    if extension >= 0x80:
+        extension -= 0x100  # Signed
     return dict(
         filter=bool(flags >> 5 & 1),
         type=flags >> 0 & 0x1F,
-        length=length,
-        timestamp=timestamp | extension << 24,
-        streamid=streamid,
+        length=first & 0xFFFFFF,
+        timestamp=second >> 8 | extension << 24,
+        streamid=streamhigh << 8 | streamlow,
     )
-SBYTE = Struct("=b")
+TAG_HEADER = Struct(">LLHB")
+
+def format_tag_header(header, *, timestamp):
+    """Returns a copy of an 11-byte tag header with a new timestamp"""
+    stamp = (timestamp & 0xFFFFFF) << 8 | timestamp >> 24 & 0xFF
+    return b"".join((header[:4], stamp.to_bytes(4, "big"),
+        header[8:TAG_HEADER.size]))
 
 tag_parsers = dict()
 
@@ -144,6 +159,11 @@ def parse_object(stream):
             return array
         array[name.decode("ascii")] = value
 
+@setitem(scriptdatavalue_parsers, 5)  # Null
+@setitem(scriptdatavalue_parsers, 6)  # Undefined
+def parse_null(stream):
+    return None
+
 @setitem(scriptdatavalue_parsers, 8)
 def parse_ecma_array(stream):
     fastforward(stream, 4)  # Approximate length
@@ -158,5 +178,39 @@ def parse_array(stream):
     length = read_int(stream, 4)
     return tuple(parse_scriptdatavalue(stream) for _ in range(length))
 
+def format_scriptdata(name, value):
+    """Returns the body of a script data tag, such as the "onMetaData" tag"""
+    return b"".join(format_scriptdatavalue(item) for item in (name, value))
+
+def format_scriptdatavalue(value):
+    """Encodes a value as returned by parse_scriptdatavalue()
+    
+    A dict() is encoded as an ECMA array, a sequence as a strict array, and
+    None as null.
+    """
+    if value is None:
+        return bytes((5,))
+    if isinstance(value, bool):
+        return bytes((1, value))
+    if isinstance(value, (int, float)):
+        return bytes((0,)) + DOUBLE_BE.pack(value)
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if isinstance(value, bytes):
+        return bytes((2,)) + format_string(value)
+    if isinstance(value, dict):
+        items = [len(value).to_bytes(4, "big")]  # Approximate length
+        for (name, item) in value.items():
+            items.append(format_string(name.encode("ascii")))
+            items.append(format_scriptdatavalue(item))
+        items.append(format_string(b"") + bytes((9,)))  # End marker
+        return bytes((8,)) + b"".join(items)
+    items = [format_scriptdatavalue(item) for item in value]
+    return (bytes((10,)) + len(items).to_bytes(4, "big") +
+        b"".join(items))
+
+def format_string(string):
+    return len(string).to_bytes(2, "big") + string
+
 if __name__ == "__main__":
     main()
@@ -26,18 +26,61 @@ from urllib.parse import urljoin
 from io import BytesIO
 from .utils import xml_text_elements
 from . import flvlib
-from .utils import read_int, read_string
-from .utils import WritingReader
+from .utils import read_int, BinaryReader
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import closing
+import json
+import os
+from struct import Struct, error as StructError
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from math import ceil
+from time import perf_counter
 
 def fetch(*pos, dest_file, frontend=None, abort=None, player=None, key=None,
-**kw):
+workers=None, journal=None, quiet=False, start=None, end=None, bitrate=None,
+tags_only=False, **kw):
+    """Downloads a programme and writes it to "dest_file" in FLV format
+    
+    The "bitrate" parameter chooses between the media renditions listed in
+    the manifest; see select_media(). If it is "adaptive", each fragment
+    is downloaded from the highest bitrate rendition that the measured
+    throughput can sustain, switching renditions between fragments.
+    
+    If "workers" is given, up to that many fragments are downloaded
+    concurrently, over persistent connections from the pool. The fragments
+    are still written out in order, so the output is the same as for a
+    sequential download.
+    
+    If "start" or "end" is given, in seconds, only the fragments covering
+    that part of the programme are downloaded. The tag timestamps are then
+    shifted so that the output starts at zero, and the duration in the
+    metadata is updated to match.
+    
+    If "tags_only" is set, the FLV file header and metadata are not
+    written, and the tag timestamps are not shifted, so that the output
+    can continue an existing file from the "start" time.
+    
+    If a "Journal" object is given, its progress is updated after each
+    fragment. If the journal records an earlier download of the same
+    media, "dest_file" is truncated to the last complete fragment and the
+    download continues from there. Otherwise "dest_file" is truncated and
+    written from the start.
+    
+    Progress is written to "stderr" unless a frontend is given or "quiet"
+    is set."""
+    
+    if end is not None and end <= (start or 0):
+        raise ValueError("End time {} is not after start time {}".format(
+            end, start or 0))
     url = manifest_url(*pos, **kw)
     
     with PersistentConnectionHandler() as connection:
         session = urllib.request.build_opener(connection)
         
         manifest = get_manifest(url, session)
-        url = manifest["baseURL"]
         player = player_verification(manifest, player, key)
         
         duration = manifest.get("duration")
@@ -46,107 +89,358 @@ def fetch(*pos, dest_file, frontend=None, abort=None, player=None, key=None,
         else:
             duration = None
         
-        # TODO: determine preferred bitrate, max bitrate, etc
-        media = manifest["media"][0]  # Just pick the first one!
-        href = media.get("href")
-        if href is not None:
-            href = urljoin(url, href)
-            bitrate = media.get("bitrate")  # Save this in case the child manifest does not specify a bitrate
-            raise NotImplementedError("/manifest/media/@href -> child manifest")
-        
-        bootstrap = get_bootstrap(media,
-            session=session, url=url, player=player)
-        
-        media_url = media["url"] + bootstrap["movie_identifier"]
-        if "highest_quality" in bootstrap:
-            media_url += bootstrap["highest_quality"]
-        if "server_base_url" in bootstrap:
-            media_url = urljoin(bootstrap["server_base_url"], media_url)
-        media_url = urljoin(url, media_url)
+        renditions = expand_media(manifest, session)
+        if bitrate == "adaptive":
+            renditions.sort(key=media_bitrate)
+            adaptive = AdaptiveBitrate(list(map(media_bitrate, renditions)))
+        else:
+            renditions = [select_media(renditions, bitrate)]
+            adaptive = None
         
+        # Fragment numbering and timing are taken from the first rendition,
+        # and are assumed to be the same for any others
+        media_urls = list()
+        for media in reversed(renditions):
+            bootstrap = get_bootstrap(media,
+                session=session, url=media["baseURL"], player=player)
+            media_urls.insert(0, get_media_url(media, bootstrap))
+        media_url = media_urls[0]
         metadata = media.get("metadata")
         
         if not duration:
             if bootstrap["time"]:
                 duration = bootstrap["time"] / bootstrap["timescale"]
             elif metadata:
-                scriptdata = flvlib.parse_scriptdata(BytesIO(metadata))
-                assert scriptdata["name"] == b"onMetaData"
-                duration = scriptdata["value"].get("duration")
+                value = parse_metadata(metadata)
+                if isinstance(value, dict):
+                    duration = value.get("duration")
         
-        flv = CounterWriter(dest_file)  # Track size even if piping to stdout
+        frag_runs = bootstrap["frag_runs"]
+        timescale = bootstrap["frag_timescale"]
+        index = 0
+        count = None
+        offset = None  # Tag timestamp offset, in milliseconds
+        begin = 0  # Start of the first fragment, in seconds
+        if start is not None or end is not None:
+            if start is not None:
+                found = frag_runs.find(int(start * timescale))
+                if found:
+                    (_, index) = found
+            (begin, _) = frag_runs.span(index)
+            if not tags_only:
+                offset = begin * 1000 // timescale
+            begin /= timescale
+            if end is not None:
+                found = frag_runs.find(max(ceil(end * timescale) - 1, 0))
+                if found:
+                    (_, last) = found
+                    count = max(last + 1 - index, 0)
+                    (_, finish) = frag_runs.span(last)
+                    duration = finish / timescale
+            if duration:
+                duration -= begin
+                if metadata:
+                    metadata = set_duration(metadata, duration)
         
-        # Assume audio and video tags will be present
-        flvlib.write_file_header(flv, audio=True, video=True)
+        if adaptive:
+            frags = adaptive.iter_frag_urls(media_urls, bootstrap, player,
+                index)
+        else:
+            frags = iter_frag_urls(media_url, bootstrap, player, index)
+        if count is not None:
+            frags = islice(frags, count)
+        if (journal and journal.media == media_url and
+        journal.offset == offset):
+            dest_file.seek(journal.size)
+            dest_file.truncate()
+            flv = CounterWriter(dest_file, journal.size)
+            
+            # The previous fragment may have come from another rendition
+            first = journal.first or bool(adaptive)
+            frags = ((frag, frag_url, endtime)
+                for (frag, frag_url, endtime) in frags if frag > journal.frag)
+        else:
+            if journal:
+                dest_file.seek(0)
+                dest_file.truncate()
+                journal.media = media_url
+                journal.offset = offset
+            
+            # Track size even if piping to stdout
+            flv = CounterWriter(dest_file)
+            first = True
+            
+            if not tags_only:
+                # Assume audio and video tags will be present
+                flvlib.write_file_header(flv, audio=True, video=True)
+                
+                if metadata:
+                    flvlib.write_scriptdata(flv, metadata)
         
-        if metadata:
-            flvlib.write_scriptdata(flv, metadata)
+        if not quiet:
+            progress_update(frontend, flv, 0, duration)
         
-        progress_update(frontend, flv, 0, duration)
+        if workers:
+            # The workers open their own connections
+            connection.close()
+            responses = prefetch(frags, workers)
+        else:
+            responses = ((frag, session.open(frag_url), endtime)
+                for (frag, frag_url, endtime) in frags)
         
-        segs = iter_segs(bootstrap["seg_runs"])
-        first = True
-        for (frag, endtime) in iter_frags(bootstrap["frag_runs"]):
-            seg = next(segs)
-            frag_url = "{}Seg{}-Frag{}".format(media_url, seg, frag)
-            if player:
-                frag_url = urljoin(frag_url, "?" + player)
-            response = session.open(frag_url)
-            
-            while True:
-                if abort and abort.is_set():
-                    raise SystemExit()
-                (boxtype, boxsize) = read_box_header(response)
-                if not boxtype:
-                    break
-                
-                if boxtype == b"mdat":
-                    # Strip AAC and AVC sequence headers from fragments other
-                    # than the first fragment. This assumes that the header
-                    # tags only appear as the first tag of their type in each
-                    # fragment. This way the code avoids unnecessarily
-                    # scanning for them, which is much slower than simply
-                    # copying the stream.
-                    if not first:
-                        audio_found = False
-                        video_found = False
-                        while boxsize and not (audio_found and video_found):
-                            cache = BytesIO()
-                            proxy = WritingReader(response, cache)
-                            tag = flvlib.read_tag_header(proxy)
-                            
-                            if tag["type"] == flvlib.TAG_AUDIO:
-                                audio_found = True
-                                parsed = flvlib.parse_audio_tag(proxy, tag)
-                                skip = (parsed.get("aac_type") ==
-                                    flvlib.AAC_HEADER)
-                            elif tag["type"] == flvlib.TAG_VIDEO:
-                                video_found = True
-                                parsed = flvlib.parse_video_tag(proxy, tag)
-                                skip = (parsed.get("avc_type") ==
-                                    flvlib.AVC_HEADER)
-                            else:
-                                skip = False
-                            
-                            boxsize -= cache.tell()
-                            tag["length"] += 4  # Trailing tag size field
-                            if skip:
-                                fastforward(response, tag["length"])
-                            else:
-                                flv.write(cache.getvalue())
-                                streamcopy(response, flv, tag["length"])
-                            boxsize -= tag["length"]
-                            assert boxsize >= 0
-                    
-                    streamcopy(response, flv, boxsize)
+        with closing(responses):
+            received = perf_counter()
+            for (frag, response, endtime) in responses:
+                if adaptive and adaptive.switched(frag):
+                    first = True  # Keep the new rendition's sequence headers
+                size = flv.tell()
+                if copy_frag(response, flv, first=first, abort=abort,
+                offset=offset):
                     first = False
+                if adaptive:
+                    # Measure the rate that fragments arrive, which
+                    # accounts for concurrent workers
+                    now = perf_counter()
+                    adaptive.record(flv.tell() - size, now - received)
+                    received = now
+                if journal:
+                    dest_file.flush()
+                    journal.update(frag, flv.tell(), first)
+                endtime = endtime / timescale - begin
+                if not quiet:
+                    progress_update(frontend, flv, endtime, duration)
+        if not frontend and not quiet:
+            print(file=stderr)
+
+def iter_frag_urls(media_url, bootstrap, player=None, index=0):
+    """Yields (frag, url, endtime) tuples for each fragment
+    
+    The "index" parameter skips that many fragments from the start."""
+    for (seg, frag, endtime) in iter_seg_frags(bootstrap, index):
+        yield (frag, frag_url(media_url, seg, frag, player), endtime)
+
+def iter_seg_frags(bootstrap, index=0):
+    """Yields (seg, frag, endtime) tuples for each fragment"""
+    segs = iter_segs(bootstrap["seg_runs"], index)
+    for (frag, endtime) in iter_frags(bootstrap["frag_runs"], index):
+        yield (next(segs), frag, endtime)
+
+def frag_url(media_url, seg, frag, player=None):
+    url = "{}Seg{}-Frag{}".format(media_url, seg, frag)
+    if player:
+        url = urljoin(url, "?" + player)
+    return url
+
+def get_media_url(media, bootstrap):
+    """Returns the URL prefix for the fragments of a media rendition"""
+    media_url = media["url"] + bootstrap["movie_identifier"]
+    if "highest_quality" in bootstrap:
+        media_url += bootstrap["highest_quality"]
+    if "server_base_url" in bootstrap:
+        media_url = urljoin(bootstrap["server_base_url"], media_url)
+    return urljoin(media["baseURL"], media_url)
+
+def expand_media(manifest, session):
+    """Returns a list of all the media renditions of a manifest
+    
+    Media entries referring to a child manifest with an "href" attribute
+    are replaced by the renditions in the child manifest. Each item has a
+    "baseURL" entry for resolving its relative URLs."""
+    
+    renditions = list()
+    for media in manifest["media"]:
+        href = media.get("href")
+        if href is None:
+            renditions.append(dict(media, baseURL=manifest["baseURL"]))
+            continue
+        
+        child = get_manifest(urljoin(manifest["baseURL"], href), session)
+        for item in expand_media(child, session):
+            # The child manifest may not specify a bitrate
+            if item.get("bitrate") is None and "bitrate" in media:
+                item["bitrate"] = media["bitrate"]
+            renditions.append(item)
+    return renditions
+
+def select_media(renditions, bitrate=None):
+    """Chooses a media rendition
+    
+    The "bitrate" parameter may be "highest", "lowest", or a number of
+    kb/s, which chooses the highest bitrate up to that number, or the
+    lowest bitrate if all are higher. If it is None, the first rendition
+    listed is chosen."""
+    
+    if bitrate is None:
+        return renditions[0]
+    if bitrate == "highest":
+        return max(renditions, key=media_bitrate)
+    
+    lowest = min(renditions, key=media_bitrate)
+    if bitrate == "lowest":
+        return lowest
+    allowed = [media for media in renditions
+        if media_bitrate(media) <= bitrate]
+    if not allowed:
+        return lowest
+    return max(allowed, key=media_bitrate)
+
+def media_bitrate(media):
+    """Returns the bitrate of a rendition in kb/s, or zero if unknown"""
+    try:
+        return float(media.get("bitrate", 0))
+    except ValueError:
+        return 0
+
+class AdaptiveBitrate:
+    """Switches between renditions depending on the measured throughput
+    
+    Downloading starts with the lowest bitrate rendition. Afterwards, each
+    fragment comes from the highest bitrate rendition that the average
+    throughput exceeds by the "margin" factor."""
+    
+    def __init__(self, bitrates, margin=1.5, weight=0.3):
+        """The "bitrates" parameter lists the bitrate in kb/s of each
+        rendition, in increasing order. The "weight" parameter is for the
+        latest measurement in the exponential moving average."""
+        self.bitrates = bitrates
+        self.margin = margin
+        self.weight = weight
+        self.throughput = None  # kb/s
+        self.current = 0
+        self._chosen = dict()
+        self._last = None
+    
+    def record(self, size, elapsed):
+        """Records the number of bytes received over a period of time"""
+        if elapsed <= 0:
+            return
+        rate = size * 8 / 1000 / elapsed
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput += (rate - self.throughput) * self.weight
+    
+    def choose(self):
+        """Returns the index of the rendition for the next fragment"""
+        if self.throughput is not None:
+            self.current = 0
+            for (i, bitrate) in enumerate(self.bitrates):
+                if bitrate * self.margin <= self.throughput:
+                    self.current = i
+        return self.current
+    
+    def iter_frag_urls(self, media_urls, bootstrap, player=None, index=0):
+        """Like iter_frag_urls(), but for a list of renditions"""
+        for (seg, frag, endtime) in iter_seg_frags(bootstrap, index):
+            rendition = self.choose()
+            self._chosen[frag] = rendition
+            url = frag_url(media_urls[rendition], seg, frag, player)
+            yield (frag, url, endtime)
+    
+    def switched(self, frag):
+        """Returns True if a fragment is from a different rendition than
+        the previous fragment. Call for each fragment in order."""
+        rendition = self._chosen.pop(frag)
+        switched = self._last is not None and rendition != self._last
+        self._last = rendition
+        return switched
+
+def prefetch(frags, workers):
+    """Downloads fragments concurrently, yielding them in the original order
+    
+    The "frags" parameter is an iterator of (frag, url, endtime) tuples, and
+    (frag, stream, endtime) tuples are yielded, where "stream" holds the fragment
+    contents in memory. Connections are reused from the connection pool. No
+    more than twice "workers" fragments are downloaded ahead of the
+    fragment being consumed."""
+    
+    def download(url):
+        with PersistentConnectionHandler() as handler:
+            session = urllib.request.build_opener(handler)
+            with session.open(url) as response:
+                return response.read()
+    
+    pending = deque()
+    executor = ThreadPoolExecutor(workers)
+    try:
+        for (frag, url, endtime) in frags:
+            pending.append((frag, executor.submit(download, url), endtime))
+            if len(pending) < workers * 2:
+                continue
+            (frag, future, endtime) = pending.popleft()
+            yield (frag, BytesIO(future.result()), endtime)
+        while pending:
+            (frag, future, endtime) = pending.popleft()
+            yield (frag, BytesIO(future.result()), endtime)
+    finally:
+        for (_, future, _) in pending:
+            future.cancel()
+        executor.shutdown()
+
+def copy_frag(response, flv, *, first, abort=None, offset=None):
+    """Copies the media data from a fragment to an FLV stream
+    
+    If "offset" is given, it is subtracted from the timestamp of each tag.
+    Returns True if any media data was found."""
+    
+    response = BinaryReader(response)
+    found = False
+    while True:
+        if abort and abort.is_set():
+            raise SystemExit()
+        (boxtype, boxsize) = read_box_header(response)
+        if not boxtype:
+            break
+        
+        if boxtype == b"mdat":
+            # Strip AAC and AVC sequence headers from fragments other
+            # than the first fragment. This assumes that the header
+            # tags only appear as the first tag of their type in each
+            # fragment. This way the code avoids unnecessarily
+            # scanning for them, which is much slower than simply
+            # copying the stream.
+            audio_found = first
+            video_found = first
+            while boxsize and (offset is not None or
+            not (audio_found and video_found)):
+                # The tag header plus the codec flags and packet type
+                header = response.peek(flvlib.TAG_HEADER.size + 2)
+                tag = flvlib.parse_tag_header(header)
+                size = flvlib.TAG_HEADER.size + tag["length"] + 4
+                body = BytesIO(header[flvlib.TAG_HEADER.size:])
+                
+                skip = False
+                if first:
+                    pass
+                elif tag["type"] == flvlib.TAG_AUDIO:
+                    audio_found = True
+                    parsed = flvlib.parse_audio_tag(body, tag)
+                    skip = parsed.get("aac_type") == flvlib.AAC_HEADER
+                elif tag["type"] == flvlib.TAG_VIDEO:
+                    video_found = True
+                    parsed = flvlib.parse_video_tag(body, tag)
+                    skip = parsed.get("avc_type") == flvlib.AVC_HEADER
+                
+                # Including the trailing tag size field
+                if skip:
+                    response.skip(size)
+                elif offset is None:
+                    streamcopy(response, flv, size)
                 else:
-                    fastforward(response, boxsize)
+                    timestamp = max(tag["timestamp"] - offset, 0)
+                    flv.write(flvlib.format_tag_header(header,
+                        timestamp=timestamp))
+                    response.skip(flvlib.TAG_HEADER.size)
+                    streamcopy(response, flv,
+                        size - flvlib.TAG_HEADER.size)
+                boxsize -= size
+                assert boxsize >= 0
             
-            endtime /= bootstrap["frag_timescale"]
-            progress_update(frontend, flv, endtime, duration)
-        if not frontend:
-            print(file=stderr)
+            streamcopy(response, flv, boxsize)
+            found = True
+        else:
+            response.skip(boxsize)
+    return found
 
 def get_bootstrap(media, *, session, url, player=None):
     bootstrap = media["bootstrapInfo"]
@@ -158,44 +452,45 @@ def get_bootstrap(media, *, session, url, player=None):
         with session.open(bsurl) as response:
             bootstrap = response.read()
     else:
-        bootstrap = BytesIO(bootstrap["data"])
+        bootstrap = bootstrap["data"]
+    bootstrap = BinaryReader(BytesIO(bootstrap))
     
     (type, _) = read_box_header(bootstrap)
     assert type == b"abst"
     
     result = dict()
     
-    fastforward(bootstrap, 1 + 3 + 4)  # Version, flags, bootstrap version
+    bootstrap.skip(1 + 3 + 4)  # Version, flags, bootstrap version
     
-    flags = read_int(bootstrap, 1)
+    flags = bootstrap.read_int(1)
     flags >> 6  # Profile
     bool(flags & 0x20)  # Live flag
     bool(flags & 0x10)  # Update flag
     
-    result["timescale"] = read_int(bootstrap, 4)  # Time scale
-    result["time"] = read_int(bootstrap, 8)  # Media time at end of bootstrap
-    fastforward(bootstrap, 8)  # SMPTE timecode offset
+    result["timescale"] = bootstrap.read_int(4)  # Time scale
+    result["time"] = bootstrap.read_int(8)  # Media time at end of bootstrap
+    bootstrap.skip(8)  # SMPTE timecode offset
     
-    result["movie_identifier"] = read_string(bootstrap).decode("utf-8")
+    result["movie_identifier"] = bootstrap.read_string().decode("utf-8")
     
-    count = read_int(bootstrap, 1)  # Server table
+    count = bootstrap.read_int(1)  # Server table
     for _ in range(count):
-        entry = read_string(bootstrap)
+        entry = bootstrap.read_string()
         if "server_base_url" not in result:
             result["server_base_url"] = entry.decode("utf-8")
     
-    count = read_int(bootstrap, 1)  # Quality table
+    count = bootstrap.read_int(1)  # Quality table
     for _ in range(count):
-        quality = read_string(bootstrap)
+        quality = bootstrap.read_string()
         if "highest_quality" not in result:
             result["highest_quality"] = quality.decode("utf-8")
     
-    read_string(bootstrap)  # DRM data
-    read_string(bootstrap)  # Metadata
+    bootstrap.read_string()  # DRM data
+    bootstrap.read_string()  # Metadata
     
     # Read segment and fragment run tables. Read the first table of each type
     # that is understood, and skip any subsequent ones.
-    count = read_int(bootstrap, 1)
+    count = bootstrap.read_int(1)
     for _ in range(count):
         if "seg_runs" not in result:
             (qualities, runs) = read_asrt(bootstrap)
@@ -207,7 +502,7 @@ def get_bootstrap(media, *, session, url, player=None):
         fmt = "Segment run table not found (quality = {!r})"
         raise LookupError(fmt.format(result.get("highest_quality")))
     
-    count = read_int(bootstrap, 1)
+    count = bootstrap.read_int(1)
     for _ in range(count):
         if "frag_runs" not in result:
             (qualities, runs, timescale) = read_afrt(bootstrap)
@@ -222,51 +517,266 @@ def get_bootstrap(media, *, session, url, player=None):
     
     return result
 
-def iter_segs(seg_runs):
+def iter_segs(seg_runs, index=0):
+    """Yields the segment number of each fragment
+    
+    The "index" parameter skips that many fragments from the start."""
+    if not len(seg_runs):
+        return
     # For each run of segments
-    for (i, run) in enumerate(seg_runs):
-        # For each segment in the run
-        seg = run["first"]
-        if i + 1 < len(seg_runs):
-            end = seg_runs[i + 1]["first"]
+    run = seg_runs.find(index)
+    while run < len(seg_runs):
+        frags = seg_runs.frags[run]
+        if not frags:
+            run += 1
+            continue
+        seg = seg_runs.seg(run, index)
+        if run + 1 < len(seg_runs):
+            end = seg_runs.index[run + 1]
         else:
             end = None
-        while end is None or seg < end:
-            # For each fragment in the segment
-            for _ in range(run["frags"]):
-                yield seg
-            seg += 1
+        # For each fragment in the run
+        while end is None or index < end:
+            yield seg
+            index += 1
+            if not (index - seg_runs.index[run]) % frags:
+                seg += 1
+        run += 1
 
-def iter_frags(frag_runs):
+def iter_frags(frag_runs, index=0):
+    """Yields (frag, endtime) tuples for each fragment
+    
+    The "index" parameter skips that many fragments from the start."""
     # For each run of fragments
-    for (i, run) in enumerate(frag_runs):
-        discontinuity = run.get("discontinuity")
-        if discontinuity is not None:
+    for run in range(frag_runs.find_index(index), len(frag_runs)):
+        if frag_runs.discontinuity[run] == DISCONT_END:
+            break
+        start = frag_runs.first[run]
+        end = frag_runs.end[run]
+        duration = frag_runs.duration[run]
+        frag = start + max(index - frag_runs.index[run], 0)
+        time = frag_runs.timestamp[run] + (frag - start) * duration
+        for frag in range(frag, end):
+            time += duration
+            yield (frag, time)
+
+class SegRunTable:
+    """Segment run table from an "asrt" box
+    
+    Each column is an array with an entry per run. The "index" column is
+    the number of fragments before the start of each run. The last run
+    continues indefinitely."""
+    
+    def __init__(self):
+        self.first = array("L")  # First segment number in run
+        self.frags = array("L")  # Fragments per segment
+        self.index = array("Q")
+    
+    def append(self, first, frags):
+        self.first.append(first)
+        self.frags.append(frags)
+    
+    def finish(self):
+        """Calculates the "index" column after all runs are appended"""
+        index = 0
+        for run in range(len(self.first)):
+            self.index.append(index)
+            if run + 1 < len(self.first):
+                segs = self.first[run + 1] - self.first[run]
+                index += segs * self.frags[run]
+    
+    def __len__(self):
+        return len(self.first)
+    
+    def find(self, index):
+        """Returns the run containing the fragment at "index"
+        
+        A binary search, so it takes O(log n) time for n runs."""
+        return max(bisect_right(self.index, index) - 1, 0)
+    
+    def seg(self, run, index):
+        """Returns the segment number of the fragment at an index"""
+        return self.first[run] + (index - self.index[run]) // self.frags[run]
+
+class FragRunTable:
+    """Fragment run table from an "afrt" box
+    
+    Each column is an array with an entry per run. Discontinuity entries
+    are kept in the table, but "discontinuity" is -1 for ordinary runs.
+    The "end" column is one more than the last fragment number of each
+    run, and the "index" column is the number of fragments before the
+    start of each run."""
+    
+    def __init__(self):
+        self.first = array("L")  # First fragment number in run
+        self.timestamp = array("Q")  # Timestamp at start
+        self.duration = array("L")  # Duration of each fragment
+        self.discontinuity = array("h")
+        self.end = array("L")
+        self.index = array("Q")
+        
+        # Ordinary runs only, for searching
+        self._runs = array("L")
+        self._times = array("Q")
+    
+    def append(self, first, timestamp, duration, discontinuity=None):
+        self.first.append(first)
+        self.timestamp.append(timestamp)
+        self.duration.append(duration)
+        if discontinuity is None:
+            discontinuity = -1
+        self.discontinuity.append(discontinuity)
+    
+    def finish(self):
+        """Calculates the "end" and "index" columns
+        
+        Call after all runs are appended."""
+        
+        # Find the next run to determine how many fragments in each run,
+        # working backwards through the table. Assume a single fragment if
+        # end of table, end of stream or fragment numbering discontinuity
+        # found. Skip over other kinds of discontinuities.
+        count = len(self.first)
+        self.end = array("L", bytes(self.end.itemsize * count))
+        next = None
+        for run in reversed(range(count)):
+            discontinuity = self.discontinuity[run]
+            if discontinuity < 0:
+                if next is None:
+                    self.end[run] = self.first[run] + 1
+                else:
+                    self.end[run] = next
+                next = self.first[run]
+            elif discontinuity == DISCONT_END or discontinuity & DISCONT_FRAG:
+                next = None
+        
+        index = 0
+        for run in range(count):
+            self.index.append(index)
+            discontinuity = self.discontinuity[run]
             if discontinuity == DISCONT_END:
                 break
-            continue
+            if discontinuity < 0:
+                index += self.end[run] - self.first[run]
+                self._runs.append(run)
+                self._times.append(self.timestamp[run])
+        self.index.extend(index for _ in range(count - len(self.index)))
+    
+    def __len__(self):
+        return len(self.first)
+    
+    def find_index(self, index):
+        """Returns the first run containing or after the fragment at an
+        index"""
+        run = bisect_right(self.index, index) - 1
+        if run < 0:
+            return 0
+        # Runs without fragments share the index of the following run
+        while run and self.index[run - 1] == self.index[run]:
+            run -= 1
+        return run
+    
+    def span(self, index):
+        """Returns the (start, end) timestamps of the fragment at an index"""
+        run = max(bisect_right(self.index, index) - 1, 0)
+        duration = self.duration[run]
+        start = self.timestamp[run] + (index - self.index[run]) * duration
+        return (start, start + duration)
+    
+    def find(self, timestamp):
+        """Returns (frag, index) for the fragment covering a timestamp
         
-        start = run["first"]
-        time = run["timestamp"]
+        The index is the number of fragments before it. Timestamps before
+        the first fragment give the first fragment, and timestamps after
+        the last fragment give the last fragment. Returns None if there
+        are no fragments. A binary search over the runs, so it takes
+        O(log n) time for n runs."""
         
-        # Find the next run to determine how many fragments in this run.
-        # Assume a single fragment if end of table, end of stream or fragment
-        # numbering discontinuity found. Skip over other kinds of
-        # discontinuities.
-        for next in frag_runs[i + 1:]:
-            discontinuity = next.get("discontinuity")
-            if discontinuity is None:
-                end = next["first"]
-                break
-            if discontinuity == DISCONT_END or discontinuity & DISCONT_FRAG:
-                end = start + 1
-                break
+        if not self._runs:
+            return None
+        search = max(bisect_right(self._times, timestamp) - 1, 0)
+        run = self._runs[search]
+        start = self.first[run]
+        offset = timestamp - self.timestamp[run]
+        if offset > 0 and self.duration[run]:
+            offset //= self.duration[run]
         else:
-            end = start + 1
+            offset = 0
+        frag = min(start + offset, self.end[run] - 1)
+        return (frag, self.index[run] + frag - start)
+
+class Journal:
+    """Sidecar file recording the progress of an HDS download
+    
+    Records the media URL, the tag timestamp offset for a partial
+    download, the number of the last fragment completely written, the
+    size of the output file at that point, and whether the first
+    fragment's sequence headers are still to be written. A download can
+    then continue from the next fragment."""
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.media = None
+        self.offset = None
+        self.frag = None
+        self.size = 0
+        self.first = True
+    
+    def load(self):
+        """Reads an existing journal file. Returns False if none found."""
+        try:
+            with open(self.filename, "r", encoding="ascii") as file:
+                state = json.load(file)
+        except (EnvironmentError, ValueError):
+            return False
+        self.media = state["media"]
+        self.offset = state.get("offset")
+        self.frag = state["frag"]
+        self.size = state["size"]
+        self.first = state["first"]
+        return True
+    
+    def update(self, frag, size, first):
+        self.frag = frag
+        self.size = size
+        self.first = first
+        state = dict(media=self.media, offset=self.offset,
+            frag=frag, size=size, first=first)
         
-        for frag in range(start, end):
-            time += run["duration"]
-            yield (frag, time)
+        # Replace the file atomically so that it is never left incomplete
+        temp = self.filename + ".new"
+        with open(temp, "w", encoding="ascii") as file:
+            json.dump(state, file)
+        os.replace(temp, self.filename)
+    
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+def set_duration(metadata, duration):
+    """Returns "onMetaData" script data with a new duration
+    
+    If the metadata cannot be parsed, it is returned unchanged."""
+    value = parse_metadata(metadata)
+    if not isinstance(value, dict):
+        return metadata
+    value["duration"] = duration
+    return flvlib.format_scriptdata(b"onMetaData", value)
+
+def parse_metadata(metadata):
+    """Returns the value of "onMetaData" script data, or None
+    
+    None is returned if the data uses an unsupported AMF type or is
+    otherwise invalid."""
+    try:
+        scriptdata = flvlib.parse_scriptdata(BytesIO(metadata))
+    except (KeyError, ValueError, EOFError, AssertionError, StructError):
+        return None
+    if scriptdata["name"] != b"onMetaData":
+        return None
+    return scriptdata["value"]
 
 def progress_update(frontend, flv, time, duration):
     size = flv.tell()
@@ -330,9 +840,12 @@ def get_manifest(url, session):
     for media in manifest.findall(F4M_NAMESPACE + "media"):
         item = dict(media.items())
         item.update(xml_text_elements(media, F4M_NAMESPACE))
-        item["bootstrapInfo"] = bootstraps[item.get("bootstrapInfoId")]
-        metadata = item["metadata"].encode("ascii")
-        item["metadata"] = b64decode(metadata, validate=True)
+        if "href" not in item:  # Not a reference to a child manifest
+            item["bootstrapInfo"] = bootstraps[item.get("bootstrapInfoId")]
+        metadata = item.get("metadata")
+        if metadata is not None:
+            metadata = metadata.encode("ascii")
+            item["metadata"] = b64decode(metadata, validate=True)
         parsed["media"].append(item)
     
     return parsed
@@ -342,66 +855,71 @@ F4M_NAMESPACE = "{http://ns.adobe.com/f4m/1.0}"
 def read_asrt(bootstrap):
     (type, size) = read_box_header(bootstrap)
     if type != b"asrt":
-        fastforward(bootstrap, size)
+        bootstrap.skip(size)
         return ((), None)
     
-    fastforward(bootstrap, 1 + 3)  # Version, flags
+    bootstrap.skip(1 + 3)  # Version, flags
     size -= 1 + 3
     
     qualities = set()
-    count = read_int(bootstrap, 1)  # Quality segment URL modifier table
+    count = bootstrap.read_int(1)  # Quality segment URL modifier table
     size -= 1
     for _ in range(count):
-        quality = read_string(bootstrap)
-        size -= len(quality)
+        quality = bootstrap.read_string()
+        size -= len(quality) + 1
         qualities.add(quality.decode("utf-8"))
     
-    seg_runs = list()
-    count = read_int(bootstrap, 4)
+    seg_runs = SegRunTable()
+    count = bootstrap.read_int(4)
     size -= 4
     for _ in range(count):
-        run = dict()
-        run["first"] = read_int(bootstrap, 4)  # First segment number in run
-        run["frags"] = read_int(bootstrap, 4)  # Fragments per segment
-        size -= 8
-        seg_runs.append(run)
+        # First segment number in run, fragments per segment
+        seg_runs.append(*bootstrap.unpack(SEG_RUN))
+        size -= SEG_RUN.size
+    seg_runs.finish()
     assert not size
     return (qualities, seg_runs)
 
+SEG_RUN = Struct(">LL")
+
 def read_afrt(bootstrap):
     (type, size) = read_box_header(bootstrap)
     if type != b"afrt":
-        fastforward(bootstrap, size)
+        bootstrap.skip(size)
         return ((), None)
     
-    fastforward(bootstrap, 1 + 3)  # Version, flags
-    timescale = read_int(bootstrap, 4)
+    bootstrap.skip(1 + 3)  # Version, flags
+    timescale = bootstrap.read_int(4)
     size -= 1 + 3 + 4
     
     qualities = set()
-    count = read_int(bootstrap, 1)  # Quality segment URL modifier table
+    count = bootstrap.read_int(1)  # Quality segment URL modifier table
     size -= 1
     for _ in range(count):
-        quality = read_string(bootstrap)
-        size -= len(quality)
+        quality = bootstrap.read_string()
+        size -= len(quality) + 1
         qualities.add(quality.decode("utf-8"))
     
-    frag_runs = list()
-    count = read_int(bootstrap, 4)
+    frag_runs = FragRunTable()
+    count = bootstrap.read_int(4)
     size -= 4
     for _ in range(count):
-        run = dict()
-        run["first"] = read_int(bootstrap, 4)  # First fragment number in run
-        run["timestamp"] = read_int(bootstrap, 8)  # Timestamp at start
-        run["duration"] = read_int(bootstrap, 4)  # Duration of each fragment
-        size -= 16
-        if not run["duration"]:
-            run["discontinuity"] = read_int(bootstrap, 1)
+        # First fragment number in run, timestamp at start, duration of
+        # each fragment
+        (first, timestamp, duration) = bootstrap.unpack(FRAG_RUN)
+        size -= FRAG_RUN.size
+        if duration:
+            discontinuity = None
+        else:
+            discontinuity = bootstrap.read_int(1)
             size -= 1
-        frag_runs.append(run)
+        frag_runs.append(first, timestamp, duration, discontinuity)
+    frag_runs.finish()
     assert not size
     return (qualities, frag_runs, timescale)
 
+FRAG_RUN = Struct(">LQL")
+
 # Discontinuity indicator values
 DISCONT_END = 0
 DISCONT_FRAG = 1
@@ -426,12 +944,11 @@ def skip_box(stream):
 
 def read_box_header(stream):
     """Returns (type, size) tuple, or (None, None) at EOF"""
-    boxsize = stream.read(4)
-    if not boxsize:
+    header = stream.read(BOX_HEADER.size)
+    if not header:
         return (None, None)
-    boxtype = stream.read(4)
-    assert len(boxsize) == 4 and len(boxtype) == 4
-    boxsize = int.from_bytes(boxsize, "big")
+    assert len(header) == BOX_HEADER.size
+    (boxsize, boxtype) = BOX_HEADER.unpack(header)
     if boxsize == 1:
         boxsize = read_int(stream, 8)
         boxsize -= 16
@@ -440,6 +957,8 @@ def read_box_header(stream):
     assert boxsize >= 0
     return (boxtype, boxsize)
 
+BOX_HEADER = Struct(">L4s")
+
 SWF_VERIFICATION_KEY = b"Genuine Adobe Flash Player 001"
 
 def swf_hash(url):
@@ -1,8 +1,13 @@
 from . import config
-from xml.etree.cElementTree import XML
+from xml.etree.cElementTree import XML, XMLPullParser
 import json
+from collections.abc import Sequence, Mapping, MutableMapping
+from functools import lru_cache
+from itertools import chain
+from codecs import getincrementaldecoder
 from datetime import datetime
 import re
+from io import StringIO
 from .utils import xml_text_elements
 import sys
 
@@ -73,38 +78,248 @@ def parse_auth(soup, iview_config):
 	})
 	return auth
 
-def parse_series_api(soup):
+def parse_series_api(soup, sort=True):
 	"""	This function parses the index, which is an overall listing
 		of all programs available in iView. The index is divided into
 		'series' and 'items'. Series are things like 'beached az', while
 		items are things like 'beached az Episode 8'.
+		
+		The series are sorted by title unless "sort" is false, in
+		which case they are in the order of the response.
 	"""
 	
-	# TODO: Check charset from HTTP response or cache
-	index_json = json.loads(soup.decode("UTF-8"))
+	index_dict = list(iter_series_api((soup,)))
 	
-	# alphabetically sort by title
-	# casefold() is new in Python 3.3
-	casefold = getattr(str, "casefold", str.lower)
-	index_json.sort(key=lambda series: casefold(series['b']))
-
-	index_dict = []
-
-	for series in index_json:
-		# https://iviewdownloaders.wikia.com/wiki/ABC_iView_Downloaders_Wiki#Series_JSON_format
-		result = api_attributes(series, (
-			('id', 'a'),
-			('title', 'b'),
-			('description', 'c'),
-			('thumb', 'd'),
-			('keywords', 'e'),
-			('category', 't'),
-		))
-		result['items'] = parse_series_items(series['f'])
-		index_dict.append(result)
+	if sort:
+		# alphabetically sort by title
+		# casefold() is new in Python 3.3
+		casefold = getattr(str, "casefold", str.lower)
+		index_dict.sort(key=lambda series: casefold(series['title']))
 
 	return index_dict
 
+def iter_series_api(chunks):
+	"""	Parses the series API response incrementally. The "chunks"
+		parameter is an iterable of byte strings making up the response,
+		such as it is received. Yields each series as soon as it has
+		arrived, in the order of the response, without holding the
+		rest of the response.
+	"""
+	
+	# TODO: Check charset from HTTP response or cache
+	decoder = getincrementaldecoder("UTF-8")()
+	for series in iter_json_array(map(decoder.decode, chunks)):
+		result = api_attributes(series, SERIES_ATTRIBUTES, Series)
+		result['items'] = SeriesItems(series['f'])
+		yield result
+	decoder.decode(b"", final=True)
+
+# https://iviewdownloaders.wikia.com/wiki/ABC_iView_Downloaders_Wiki#Series_JSON_format
+SERIES_ATTRIBUTES = (
+	('id', 'a'),
+	('title', 'b'),
+	('description', 'c'),
+	('thumb', 'd'),
+	('keywords', 'e'),
+	('category', 't'),
+)
+
+EPISODE_ATTRIBUTES = (
+	('id', 'a'),
+	('title', 'b'),
+	('description', 'd'),
+	('category', 'e'),
+	('date', 'f'),  # Date added to Iview
+	('expires', 'g'),
+	('broadcast', 'h'),
+	('size', 'i'),
+	('duration', 'j'),
+	('hyperlink', 'k'),
+	('home', 'l'), # program website
+	('url', 'n'),
+	('rating', 'm'),
+	('livestream', 'r'),
+	('thumb', 's'),
+	('series', 'u'),
+	('episode', 'v'),
+)
+
+class Record(MutableMapping):
+	"""	Base class for series and episodes, with a slot for each field
+		instead of a "dict" per object. Fields are attributes, but can
+		also be accessed like "dict" items for compatibility. Fields
+		missing from the API response are left unset.
+	"""
+	__slots__ = ()
+	
+	def __getitem__(self, key):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		try:
+			return getattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+	
+	def __setitem__(self, key, value):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		setattr(self, key, value)
+	
+	def __delitem__(self, key):
+		if key not in self.__slots__:
+			raise KeyError(key)
+		try:
+			delattr(self, key)
+		except AttributeError:
+			raise KeyError(key)
+	
+	def __iter__(self):
+		return (key for key in self.__slots__ if hasattr(self, key))
+	
+	def __len__(self):
+		return sum(1 for _ in self)
+	
+	# Not using the "items" method, which Series overrides with a field
+	def __eq__(self, other):
+		if not isinstance(other, Mapping):
+			return NotImplemented
+		return (len(self) == len(other) and
+			all(key in other and self[key] == other[key] for key in self))
+	
+	def __repr__(self):
+		fields = ('{}={!r}'.format(key, self[key]) for key in self)
+		return '{}({})'.format(type(self).__name__, ', '.join(fields))
+
+class Series(Record):
+	"""	The "items" field, holding the episodes, hides the "dict"-style
+		items() method.
+	"""
+	__slots__ = tuple(key for (key, _) in SERIES_ATTRIBUTES) + ('items',)
+
+class Episode(Record):
+	__slots__ = tuple(key for (key, _) in EPISODE_ATTRIBUTES)
+
+def iter_json_array(chunks):
+	"""	Yields each element of a JSON array, given the text of the array
+		in chunks. Each element is decoded once it has completely
+		arrived, and the text before it is discarded.
+	"""
+	decoder = json.JSONDecoder()
+	chunks = iter(chunks)
+	buffer = ''
+	pos = 0
+	eof = False
+	expect = '['  # Then 'value' (or ']' if empty), then ',' or ']'
+	while True:
+		pos = skip_json_space(buffer, pos)
+		if pos < len(buffer):
+			char = buffer[pos]
+			if expect == '[':
+				if char != '[':
+					raise ValueError("Expected a JSON array")
+				pos += 1
+				expect = 'first'
+				continue
+			if char == ']' and expect in {'first', ','}:
+				break
+			if expect == ',':
+				if char != ',':
+					raise ValueError("Expected ',' in JSON array")
+				pos += 1
+				expect = 'value'
+				continue
+			
+			# Only decode the element once its end has arrived, so that
+			# each chunk is scanned once
+			(end, state) = scan_json_value(buffer, pos, JSON_SCAN_START)
+			if end is None:
+				parts = [buffer[pos:]]
+				while end is None:
+					chunk = next(chunks, None)
+					if chunk is None:
+						eof = True
+						break
+					(end, state) = scan_json_value(chunk, 0, state)
+					parts.append(chunk)
+				buffer = ''.join(parts)
+				pos = 0
+			(value, pos) = decoder.raw_decode(buffer, pos)
+			expect = ','
+			yield value
+			continue
+		elif eof:
+			raise ValueError("Incomplete JSON array")
+		
+		chunk = next(chunks, None)
+		if chunk is None:
+			eof = True
+		else:
+			buffer = buffer[pos:] + chunk
+			pos = 0
+	
+	rest = buffer[pos + 1:] + ''.join(chunks)
+	if skip_json_space(rest, 0) < len(rest):
+		raise ValueError("Extra data after JSON array")
+
+def scan_json_value(text, pos, state):
+	"""	Looks for the end of a JSON value, continuing from "pos" in
+		"text". The "state" is JSON_SCAN_START at the start of the value,
+		or was returned by the previous call for the rest of the value.
+		Returns (end, state), where "end" is the position after the
+		value, or None if the value continues after the text. The value
+		is not validated.
+	"""
+	(depth, in_string, escape) = state
+	if escape:
+		if pos >= len(text):
+			return (None, state)
+		pos += 1
+	while True:
+		if in_string:
+			match = JSON_STRING_SPECIAL.search(text, pos)
+			if not match:
+				return (None, (depth, True, False))
+			pos = match.end()
+			if match.group() == '\\':
+				if pos >= len(text):
+					return (None, (depth, True, True))
+				pos += 1
+				continue
+			in_string = False
+			if not depth:
+				return (pos, JSON_SCAN_START)
+			continue
+		
+		if depth:
+			match = JSON_NESTED_SPECIAL.search(text, pos)
+		else:
+			match = JSON_VALUE_END.search(text, pos)
+		if not match:
+			return (None, (depth, False, False))
+		char = match.group()
+		if char == '"':
+			in_string = True
+		elif char in '[{':
+			depth += 1
+		elif depth:  # Closing bracket
+			depth -= 1
+			if not depth:
+				return (match.end(), JSON_SCAN_START)
+		else:  # Delimiter after a number or literal
+			return (match.start(), JSON_SCAN_START)
+		pos = match.end()
+
+def skip_json_space(text, pos):
+	while pos < len(text) and text[pos] in JSON_SPACE:
+		pos += 1
+	return pos
+
+JSON_SPACE = ' \t\n\r'
+JSON_SCAN_START = (0, False, False)  # (depth, in_string, escape)
+JSON_STRING_SPECIAL = re.compile(r'["\\]')
+JSON_NESTED_SPECIAL = re.compile(r'["\[\]{}]')
+JSON_VALUE_END = re.compile(r'["\[\]{},\s]')
+
 def parse_categories(soup):
 	xml = XML(soup)
 
@@ -143,33 +358,49 @@ def category_ids(categories):
 		ids.update(category_ids(cat['children']))
 	return ids
 
+class SeriesItems(Sequence):
+	"""	The episodes of a series, as returned by parse_series_items().
+		The JSON is only parsed when the episodes are first accessed,
+		so that listing series without their episodes is quick.
+	"""
+	
+	def __init__(self, series_json):
+		self._json = series_json
+		self._items = None
+	
+	def _parse(self):
+		if self._items is None:
+			self._items = parse_series_items(self._json)
+			self._json = None
+		return self._items
+	
+	def __len__(self):
+		if self._items is None:
+			return len(self._json)
+		return len(self._items)
+	
+	def __getitem__(self, index):
+		return self._parse()[index]
+	
+	def __iter__(self):
+		return iter(self._parse())
+	
+	def __eq__(self, other):
+		if not isinstance(other, Sequence):
+			return NotImplemented
+		return self._parse() == list(other)
+	
+	def __repr__(self):
+		return repr(self._parse())
+
 def parse_series_items(series_json):
 	items = []
 
 	for item in series_json:
-		# https://iviewdownloaders.wikia.com/wiki/ABC_iView_Downloaders_Wiki#Series_JSON_format
 		for optional_key in ('d', 'r', 's', 'l'):
 			item.setdefault(optional_key, '')
 		
-		result = api_attributes(item, (
-			('id', 'a'),
-			('title', 'b'),
-			('description', 'd'),
-			('category', 'e'),
-			('date', 'f'),  # Date added to Iview
-			('expires', 'g'),
-			('broadcast', 'h'),
-			('size', 'i'),
-			('duration', 'j'),
-			('hyperlink', 'k'),
-			('home', 'l'), # program website
-			('url', 'n'),
-			('rating', 'm'),
-			('livestream', 'r'),
-			('thumb', 's'),
-			('series', 'u'),
-			('episode', 'v'),
-		))
+		result = api_attributes(item, EPISODE_ATTRIBUTES, Episode)
 		
 		parse_field(result, 'duration', int)
 		parse_field(result, 'size', lambda size: float(size) * 1e6)
@@ -184,10 +415,29 @@ def parse_series_items(series_json):
 
 	return items
 
+@lru_cache(maxsize=0x1000)
 def parse_date(date):
+	"""	Parses "YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DD". Results are
+		remembered, since many items share the same dates.
+	"""
 	if date in {'0000-00-00 00:00:00', '0000-00-00'}:
 		return None
 	
+	# Slicing the fixed-width fields is much faster than strptime()
+	if len(date) in {10, 19}:
+		fields = [date[0:4], date[5:7], date[8:10]]
+		separators = date[4] + date[7]
+		expected = '--'
+		if len(date) == 19:
+			fields.extend((date[11:13], date[14:16], date[17:19]))
+			separators += date[10] + date[13] + date[16]
+			expected = '-- ::'
+		if separators == expected and DIGITS.match(''.join(fields)):
+			try:
+				return datetime(*map(int, fields))
+			except ValueError:
+				pass  # Let strptime() decide
+	
 	for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
 		try:
 			return datetime.strptime(date, fmt)
@@ -196,6 +446,9 @@ def parse_date(date):
 	else:
 		raise ValueError("Unknown format {!r}".format(date))
 
+# Only ASCII digits, unlike str.isdigit()
+DIGITS = re.compile(r'[0-9]+\Z')
+
 def parse_field(result, key, parser):
 	value = result.get(key)
 	if not value:
@@ -207,8 +460,11 @@ def parse_field(result, key, parser):
 		print(msg, file=sys.stderr)
 		del result[key]
 
-def api_attributes(input, attributes):
-	result = dict()
+def api_attributes(input, attributes, record=dict):
+	"""	Copies fields from an API JSON object into a new "record"
+		object, given (key, code) pairs.
+	"""
+	result = record()
 	for (key, code) in attributes:
 		value = input.get(code)
 		# Some queries return a limited set of fields, for example
@@ -254,26 +510,76 @@ def parse_captions(soup):
 	"""	Converts custom iView captions into SRT format, usable in most
 		decent media players.
 	"""
-	
-	# Horrible hack to escape literal ampersands, which have been seen in
-	# some captions XML. Inspired by
-	# http://stackoverflow.com/questions/6088760/fix-invalid-xml-with-ampersands-in-python
-	if b"<![CDATA[" not in soup:  # Not seen, but be future proof
-		soup = re.sub(b"&(?![#\w]+;)", b"&amp;", soup)
-	
-	xml = XML(soup)
-
-	output = ''
-
+	output = StringIO()
+	write_captions((soup,), output)
+	return output.getvalue()
+
+def write_captions(chunks, output):
+	"""	Like parse_captions(), but takes the captions XML in chunks, and
+		writes each SRT entry to the "output" text file as soon as it
+		has been parsed.
+	"""
+	parser = XMLPullParser(events=('start', 'end'))
+	parents = list()
 	i = 1
-	for title in xml.getiterator('title'):
-		start = title.get('start')
-		(start, startfract) = start.rsplit(':', 1)
-		end = title.get('end')
-		(end, endfract) = end.rsplit(':', 1)
-		output = output + '{}\n'.format(i)
-		output = output + '{},{:0<3.3} --> {},{:0<3.3}\n'.format(start, startfract, end, endfract)
-		output = output + title.text.replace('|','\n') + '\n\n'
-		i += 1
-
-	return output
+	for chunk in chain(escape_ampersands(chunks), (None,)):
+		if chunk is None:
+			parser.close()
+		else:
+			parser.feed(chunk)
+		for (event, element) in parser.read_events():
+			if event == 'start':
+				parents.append(element)
+				continue
+			parents.pop()
+			if element.tag != 'title':
+				continue
+			
+			start = element.get('start')
+			(start, startfract) = start.rsplit(':', 1)
+			end = element.get('end')
+			(end, endfract) = end.rsplit(':', 1)
+			output.write('{}\n{},{:0<3.3} --> {},{:0<3.3}\n{}\n\n'.format(
+				i, start, startfract, end, endfract,
+				element.text.replace('|', '\n')))
+			i += 1
+			
+			# Avoid building up the whole document
+			if parents:
+				parents[-1].remove(element)
+
+def escape_ampersands(chunks):
+	"""	Escapes literal ampersands, which have been seen in some captions
+		XML, in a document given in chunks. Inspired by
+		http://stackoverflow.com/questions/6088760/fix-invalid-xml-with-ampersands-in-python
+	"""
+	chunks = iter(chunks)
+	pending = b''
+	for chunk in chunks:
+		pending += chunk
+		
+		# Not seen, but be future proof
+		cdata = pending.find(CDATA_START)
+		if cdata >= 0:
+			yield AMPERSAND.sub(b'&amp;', pending[:cdata])
+			yield pending[cdata:]
+			yield from chunks
+			return
+		
+		# Hold back anything that could still turn out to be an entity
+		# reference or the start of a CDATA section
+		split = len(pending)
+		amp = pending.rfind(b'&')
+		if amp >= 0 and ENTITY_NAME.fullmatch(pending, amp + 1):
+			split = amp
+		lt = pending.rfind(b'<', max(split - len(CDATA_START), 0), split)
+		if lt >= 0 and CDATA_START.startswith(pending[lt:split]):
+			split = lt
+		
+		yield AMPERSAND.sub(b'&amp;', pending[:split])
+		pending = pending[split:]
+	yield AMPERSAND.sub(b'&amp;', pending)
+
+AMPERSAND = re.compile(br'&(?![#\w]+;)')
+ENTITY_NAME = re.compile(br'[#\w]*')
+CDATA_START = b'<![CDATA['
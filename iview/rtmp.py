@@ -0,0 +1,444 @@
+"""Minimal RTMP client for downloading streams in-process
+
+Only plain "rtmp:" connections are supported, without the encryption of
+"rtmpe:", the HTTP tunnelling of "rtmpt:", or SWF verification. The audio,
+video and script data messages of a stream are written to an FLV file as
+they arrive, so no "rtmpdump" process is needed for each download.
+"""
+
+import os
+import socket
+from io import BytesIO
+from urllib.parse import urlsplit
+from time import monotonic
+from sys import stderr
+from . import flvlib
+from .utils import BinaryReader, CounterWriter
+from .hds import progress_update
+
+DEFAULT_PORT = 1935
+
+def fetch(url, *, dest_file, playpath=None, live=False, swf_url=None,
+start=None, end=None, frontend=None, abort=None, quiet=False, timeout=30):
+    """Downloads a stream and writes it to "dest_file" in FLV format
+    
+    The "url" names the host and application, followed by the stream
+    unless "playpath" is given. Tag timestamps are shifted so that the
+    output starts at zero. A "live" stream is downloaded until the server
+    stops it, or until "end" seconds of it have been received; "start" is
+    ignored.
+    
+    Progress is written to "stderr" unless a frontend is given or "quiet"
+    is set."""
+    
+    (address, app, tc_url, path) = split_url(url)
+    if playpath is None:
+        playpath = path
+    if live:
+        start = None
+    stop = None
+    if end is not None:
+        stop = end - (start or 0)
+    
+    if start is not None:
+        play_start = start * 1000
+    elif live:
+        play_start = LIVE_START
+    else:
+        play_start = 0
+    if live or stop is None:
+        play_duration = -1  # Until the end
+    else:
+        play_duration = stop * 1000
+    
+    with socket.create_connection(address, timeout) as sock:
+        connection = Connection(sock)
+        connection.handshake()
+        connection.call("connect", connect_params(app, tc_url, swf_url))
+        (_, stream) = connection.call("createStream", None)
+        stream = int(stream)
+        messages = connection.play(stream, playpath,
+            start=play_start, duration=play_duration)
+        
+        # Track size even if piping to stdout
+        flv = CounterWriter(dest_file)
+        flvlib.write_file_header(flv, audio=True, video=True)
+        
+        duration = stop
+        time = 0
+        origin = None  # Timestamp of the first media message
+        if not quiet:
+            progress_update(frontend, flv, time, duration)
+        updated = monotonic()
+        for (type, timestamp, data) in messages:
+            if abort and abort.is_set():
+                raise SystemExit()
+            if type == flvlib.TAG_SCRIPTDATA:
+                data = script_data(data)
+                if data is None:
+                    continue
+                if duration is None and not live:
+                    duration = metadata_duration(data)
+            elif origin is None:
+                origin = timestamp
+            if origin is not None:
+                time = max(timestamp - origin, 0)
+            if stop is not None and time >= stop * 1000:
+                break
+            flvlib.write_tag(flv, type, time, data)
+            
+            if not quiet and monotonic() - updated >= PROGRESS_INTERVAL:
+                progress_update(frontend, flv, time / 1000, duration)
+                updated = monotonic()
+    
+    if not quiet:
+        progress_update(frontend, flv, time / 1000, duration)
+        if not frontend:
+            print(file=stderr)
+
+FLASH_VERSION = "LNX 11,2,202,235"
+LIVE_START = -1000  # Live stream only
+PROGRESS_INTERVAL = 0.5  # Seconds between updates
+
+def connect_params(app, tc_url, swf_url=None):
+    params = dict(app=app, flashVer=FLASH_VERSION)
+    if swf_url is not None:
+        params["swfUrl"] = swf_url
+    params.update(
+        tcUrl=tc_url,
+        fpad=False,
+        capabilities=15,
+        audioCodecs=3191,
+        videoCodecs=252,
+        videoFunction=1,
+    )
+    return params
+
+def split_url(url):
+    """Returns ((host, port), app, tcUrl, playpath) for an RTMP URL
+    
+    The application is the first path component. Any query string is
+    passed on with the play path, or with the application if there is no
+    play path in the URL."""
+    
+    split = urlsplit(url)
+    if split.scheme != "rtmp":
+        raise ValueError("Unsupported RTMP URL: {!r}".format(url))
+    (app, _, playpath) = split.path.lstrip("/").partition("/")
+    if split.query:
+        if playpath:
+            playpath += "?" + split.query
+        else:
+            app += "?" + split.query
+    port = split.port or DEFAULT_PORT
+    tc_url = "rtmp://{}:{}/{}".format(split.hostname, port, app)
+    return ((split.hostname, port), app, tc_url, playpath)
+
+def script_data(data):
+    """Returns the script data to save from a data message, or None
+    
+    The "@setDataFrame" prefix used by live encoders is removed, and
+    status messages are skipped."""
+    
+    stream = BytesIO(data)
+    name = flvlib.parse_scriptdatavalue(stream)
+    if name == b"@setDataFrame":
+        data = data[stream.tell():]
+        name = flvlib.parse_scriptdatavalue(BytesIO(data))
+    if name in SKIPPED_DATA:
+        return None
+    return data
+
+SKIPPED_DATA = {b"|RtmpSampleAccess", b"onPlayStatus", b"onStatus"}
+
+def metadata_duration(data):
+    """Returns a positive duration from "onMetaData" script data, or None"""
+    scriptdata = flvlib.parse_scriptdata(BytesIO(data))
+    if scriptdata["name"] != b"onMetaData":
+        return None
+    value = scriptdata["value"]
+    if not isinstance(value, dict):
+        return None
+    return value.get("duration") or None
+
+class RtmpError(EnvironmentError):
+    pass
+
+# Message types
+SET_CHUNK_SIZE = 1
+ABORT = 2
+ACKNOWLEDGEMENT = 3
+USER_CONTROL = 4
+WINDOW_ACK_SIZE = 5
+SET_PEER_BANDWIDTH = 6
+AUDIO = flvlib.TAG_AUDIO
+VIDEO = flvlib.TAG_VIDEO
+DATA = flvlib.TAG_SCRIPTDATA
+COMMAND = 20
+AGGREGATE = 22
+
+# User control events
+STREAM_EOF = 1
+SET_BUFFER_LENGTH = 3
+PING_REQUEST = 6
+PING_RESPONSE = 7
+
+# Chunk stream ids for messages sent
+CONTROL_CHUNKS = 2
+COMMAND_CHUNKS = 3
+STREAM_CHUNKS = 8
+
+HANDSHAKE_SIZE = 1536
+BUFFER_LENGTH = 10 * 1000  # Milliseconds
+STOP_CODES = {
+    b"NetStream.Play.Stop",
+    b"NetStream.Play.Complete",
+    b"NetStream.Play.UnpublishNotify",
+}
+
+class Connection:
+    """RTMP chunk stream over a connected socket
+    
+    The same framing is used in both directions, so this also works for
+    the server end of a connection once the handshake is done."""
+    
+    chunk_size = 128  # For messages sent
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = BinaryReader(sock.makefile("rb", buffering=0))
+        self.read_chunk_size = 128
+        self.window = None
+        self.received = 0
+        self.acknowledged = 0
+        self.transaction = 0
+        self._chunks = dict()
+    
+    def handshake(self):
+        """Does the plain client handshake, without any digest"""
+        c1 = bytes(8) + os.urandom(HANDSHAKE_SIZE - 8)
+        self.sock.sendall(b"\x03" + c1)
+        (version,) = self.read(1)
+        if version != 3:
+            raise RtmpError("Unsupported RTMP version {}".format(version))
+        s1 = self.read(HANDSHAKE_SIZE)
+        self.sock.sendall(s1)  # C2 echoes S1
+        self.read(HANDSHAKE_SIZE)  # S2
+    
+    def read(self, size):
+        data = self.reader.read(size)
+        if len(data) < size:
+            raise EOFError("RTMP connection closed")
+        self.received += size
+        if (self.window and
+        self.received - self.acknowledged >= self.window // 2):
+            self.acknowledged = self.received
+            self.send(CONTROL_CHUNKS, ACKNOWLEDGEMENT,
+                (self.received & 0xFFFFFFFF).to_bytes(4, "big"))
+        return data
+    
+    def read_message(self):
+        """Returns the next message as (type, stream, timestamp, body)"""
+        while True:
+            (first,) = self.read(1)
+            fmt = first >> 6
+            id = first & 0x3F
+            if id == 0:
+                id = 64 + self.read(1)[0]
+            elif id == 1:
+                id = 64 + int.from_bytes(self.read(2), "little")
+            chunk = self._chunks.get(id)
+            if chunk is None:
+                chunk = ChunkStream()
+                self._chunks[id] = chunk
+            
+            if fmt < 3:
+                stamp = int.from_bytes(self.read(3), "big")
+                if fmt < 2:
+                    chunk.length = int.from_bytes(self.read(3), "big")
+                    (chunk.type,) = self.read(1)
+                    if fmt < 1:
+                        chunk.stream = int.from_bytes(self.read(4),
+                            "little")
+                chunk.extended = stamp == 0xFFFFFF
+                if chunk.extended:
+                    stamp = int.from_bytes(self.read(4), "big")
+                chunk.delta = stamp
+                if fmt == 0:
+                    chunk.timestamp = stamp
+                else:
+                    chunk.timestamp += stamp
+                chunk.body = bytearray()
+            else:
+                if chunk.extended:
+                    self.read(4)
+                if chunk.body is None:  # New message with the same header
+                    chunk.timestamp += chunk.delta
+                    chunk.body = bytearray()
+            chunk.timestamp &= 0xFFFFFFFF
+            
+            size = min(self.read_chunk_size, chunk.length - len(chunk.body))
+            chunk.body += self.read(size)
+            if len(chunk.body) >= chunk.length:
+                body = bytes(chunk.body)
+                chunk.body = None
+                return (chunk.type, chunk.stream, chunk.timestamp, body)
+    
+    def receive(self):
+        """Returns the next message not handled by the connection itself
+        
+        Protocol control messages and ping requests are handled here."""
+        while True:
+            message = self.read_message()
+            (type, _, _, body) = message
+            if type == SET_CHUNK_SIZE:
+                self.read_chunk_size = int.from_bytes(body[:4], "big")
+            elif type == ABORT:
+                chunk = self._chunks.get(int.from_bytes(body[:4], "big"))
+                if chunk is not None:
+                    chunk.body = None
+            elif type == WINDOW_ACK_SIZE:
+                self.window = int.from_bytes(body[:4], "big")
+            elif type == SET_PEER_BANDWIDTH:
+                self.send(CONTROL_CHUNKS, WINDOW_ACK_SIZE, body[:4])
+            elif type == ACKNOWLEDGEMENT:
+                pass
+            elif (type == USER_CONTROL and
+            int.from_bytes(body[:2], "big") == PING_REQUEST):
+                self.send(CONTROL_CHUNKS, USER_CONTROL,
+                    PING_RESPONSE.to_bytes(2, "big") + body[2:6])
+            else:
+                return message
+    
+    def send(self, id, type, body, stream=0, timestamp=0):
+        """Sends a message on chunk stream "id", which must be below 64"""
+        chunks = [bytes((id,)),
+            (timestamp & 0xFFFFFF).to_bytes(3, "big"),
+            len(body).to_bytes(3, "big"),
+            bytes((type,)),
+            stream.to_bytes(4, "little"),
+            body[:self.chunk_size],
+        ]
+        for offset in range(self.chunk_size, len(body), self.chunk_size):
+            chunks.append(bytes((3 << 6 | id,)))
+            chunks.append(body[offset:offset + self.chunk_size])
+        self.sock.sendall(b"".join(chunks))
+    
+    def send_command(self, name, transaction, *args, stream=0):
+        body = b"".join(map(format_value, (name, transaction) + args))
+        id = STREAM_CHUNKS if stream else COMMAND_CHUNKS
+        self.send(id, COMMAND, body, stream=stream)
+    
+    def call(self, name, *args):
+        """Sends a command and returns the arguments of the "_result" reply
+        
+        Raises RtmpError for an "_error" reply."""
+        self.transaction += 1
+        self.send_command(name, self.transaction, *args)
+        while True:
+            (type, _, _, body) = self.receive()
+            if type != COMMAND:
+                continue
+            (reply, transaction, *values) = parse_command(body)
+            if transaction != self.transaction:
+                continue  # Such as "onBWDone"
+            if reply != b"_result":
+                raise RtmpError(status_message(name, values))
+            return values
+    
+    def play(self, stream, playpath, *, start, duration):
+        """Yields (type, timestamp, body) for the media and script data
+        messages of a stream until it stops
+        
+        The FLV tags in aggregate messages are yielded separately."""
+        
+        self.send(CONTROL_CHUNKS, USER_CONTROL,
+            SET_BUFFER_LENGTH.to_bytes(2, "big") +
+            stream.to_bytes(4, "big") + BUFFER_LENGTH.to_bytes(4, "big"))
+        self.send_command("play", 0, None, playpath, start, duration,
+            stream=stream)
+        while True:
+            (type, _, timestamp, body) = self.receive()
+            if type in {AUDIO, VIDEO}:
+                yield (type, timestamp, body)
+            elif type == AGGREGATE:
+                yield from iter_aggregate(timestamp, body)
+            elif type == DATA:
+                info = parse_command(body)
+                if info[:1] == [b"onPlayStatus"] and stopped(info):
+                    return
+                yield (type, timestamp, body)
+            elif type == COMMAND:
+                info = parse_command(body)
+                if info[:1] != [b"onStatus"]:
+                    continue
+                if stopped(info):
+                    return
+                status = info[-1]
+                if (isinstance(status, dict) and
+                status.get("level") == b"error"):
+                    raise RtmpError(status_message("play", info[2:]))
+            elif (type == USER_CONTROL and
+            int.from_bytes(body[:2], "big") == STREAM_EOF):
+                return
+
+class ChunkStream:
+    """State of a chunk stream being received"""
+    length = 0
+    type = None
+    stream = 0
+    timestamp = 0
+    delta = 0
+    extended = False
+    body = None  # Partial message
+
+def iter_aggregate(timestamp, body):
+    """Yields (type, timestamp, body) for the FLV tags of an aggregate
+    
+    The timestamps are made relative to that of the aggregate message."""
+    body = BytesIO(body)
+    first = None
+    while True:
+        tag = flvlib.read_tag_header(body)
+        if tag is None:
+            break
+        if first is None:
+            first = tag["timestamp"]
+        data = body.read(tag["length"])
+        body.seek(4, os.SEEK_CUR)  # Previous tag size
+        yield (tag["type"], timestamp + tag["timestamp"] - first, data)
+
+def parse_command(body):
+    """Returns the list of AMF 0 values in a command or data message"""
+    stream = BytesIO(body)
+    values = list()
+    while stream.tell() < len(body):
+        values.append(flvlib.parse_scriptdatavalue(stream))
+    return values
+
+def format_value(value):
+    """Encodes an AMF 0 value, with a dict() as an anonymous object"""
+    if not isinstance(value, dict):
+        return flvlib.format_scriptdatavalue(value)
+    items = [bytes((3,))]
+    for (name, item) in value.items():
+        items.append(flvlib.format_string(name.encode("ascii")))
+        items.append(format_value(item))
+    items.append(flvlib.format_string(b"") + bytes((9,)))  # End marker
+    return b"".join(items)
+
+def stopped(info):
+    """True if a status message reports the end of the stream"""
+    status = info[-1]
+    return isinstance(status, dict) and status.get("code") in STOP_CODES
+
+def status_message(command, values):
+    """Describes the information object from an error reply"""
+    for status in reversed(values):
+        if isinstance(status, dict):
+            break
+    else:
+        return "RTMP {} command failed".format(command)
+    return "RTMP {} command failed: {}: {}".format(command,
+        status.get("code", b"").decode("ascii", "replace"),
+        status.get("description", b"").decode("ascii", "replace"))
@@ -0,0 +1,492 @@
+"""HTTP server streaming iView programmes in FLV format
+
+Unlike "iview.cgi", which starts a new process for each request, the
+server runs in one process. It fetches the iView config once and shares
+the auth response between requests. HDS programmes are downloaded in the
+server process, over connections from the shared pool. A programme is
+requested by its file name with an ".flv" extension, for example
+"/news/730s_Tx_2611.flv" for "news/730s_Tx_2611.mp4".
+
+Each programme is only downloaded once, into a temporary spool file, even
+if several clients request it at the same time. Each client is sent the
+spool from the start, and then follows the download as it progresses. The
+spool is kept for "linger" seconds after the last client disconnects, so
+that a client reconnecting soon afterwards does not start the download
+again. At most "max_downloads" programmes are downloaded at once; requests
+for further programmes get a 503 (Service Unavailable) response. Only HDS
+programmes are supported.
+
+Byte ranges of the spool are served with 206 (Partial Content) responses.
+While the spool is incomplete, a range is limited to the part already
+downloaded, and the total length is given as unknown. A range starting
+more than "seek_ahead" seconds beyond the download is instead answered
+with a separate download, starting at the fragment containing the time
+estimated for that byte and continuing to the end of the programme. Since
+the estimate is based on the average bitrate so far, it cannot be sent
+as the requested range. Instead it is sent with a 200 (OK) response, as
+a complete FLV file with the metadata of the programme and the original
+tag timestamps, which players can seek within.
+
+Run as "python3 -m iview.server".
+"""
+
+import sys
+import os
+import threading
+import time
+import argparse
+import posixpath
+import re
+from io import BytesIO
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, unquote
+from urllib.error import HTTPError
+from tempfile import TemporaryFile
+from io import BufferedIOBase
+from . import config
+from . import comm
+from . import fetch
+from . import flvlib
+
+class Server(ThreadingMixIn, HTTPServer):
+    """Call comm.get_config() before starting the server"""
+    
+    daemon_threads = True
+    
+    def __init__(self, address, *, max_downloads=4, linger=60,
+    spool_dir=None, seek_ahead=30):
+        HTTPServer.__init__(self, address, Handler)
+        self.downloads = threading.BoundedSemaphore(max_downloads)
+        self.linger = linger
+        self.seek_ahead = seek_ahead
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._auth = None
+        self._auth_time = None
+        self._spools = dict()
+    
+    def attach(self, url):
+        """Returns the Spool for a programme, starting a download if
+        necessary, or None if too many downloads are running
+        
+        Call detach() once finished with the spool."""
+        with self._lock:
+            spool = self._spools.get(url)
+            if spool is None or spool.error is not None:
+                if not self.downloads.acquire(blocking=False):
+                    return None
+                spool = Spool(self.spool_dir)
+                self._spools[url] = spool
+                thread = threading.Thread(target=self._download,
+                    args=(url, spool), daemon=True)
+                thread.start()
+            spool.readers += 1
+            return spool
+    
+    def detach(self, url, spool):
+        with self._lock:
+            spool.readers -= 1
+            if spool.readers:
+                return
+        timer = threading.Timer(self.linger, self._expire, (url, spool))
+        timer.daemon = True
+        timer.start()
+    
+    def _expire(self, url, spool):
+        with self._lock:
+            if spool.readers:
+                return
+            if self._spools.get(url) is spool:
+                del self._spools[url]
+        spool.expire()
+    
+    def _download(self, url, spool):
+        try:
+            fetcher = self.get_fetcher(url)
+            if not isinstance(fetcher, fetch.HdsFetcher):
+                raise NotImplementedError("Only HDS programmes are supported")
+            try:
+                fetcher.stream(spool, frontend=spool, abort=spool.abort)
+            except HTTPError as error:
+                if spool.size or not fetch.auth_rejected(fetcher, error):
+                    raise
+                fetcher = self.get_fetcher(url, refresh_auth=True)
+                fetcher.stream(spool, frontend=spool, abort=spool.abort)
+        except (Exception, SystemExit) as error:  # Aborting raises SystemExit
+            spool.finish(error)
+        else:
+            spool.finish()
+        finally:
+            self.downloads.release()
+    
+    def server_close(self):
+        HTTPServer.server_close(self)
+        with self._lock:
+            spools = list(self._spools.values())
+            self._spools.clear()
+        for spool in spools:
+            spool.expire()
+    
+    def get_fetcher(self, url, refresh_auth=False):
+        """Returns a fetcher, sharing the auth response between requests
+        
+        A new auth response is fetched after "config.auth_ttl" seconds,
+        or if "refresh_auth" is set."""
+        with self._lock:
+            auth = self._auth
+            fresh = (auth is not None and
+                time.monotonic() - self._auth_time < config.auth_ttl)
+        if fresh and not refresh_auth:
+            return fetch.get_fetcher(url, auth=dict(auth, saved=True))
+        
+        # Not holding the lock while waiting for the response, so that
+        # other clients are not held up
+        now = time.monotonic()
+        auth = comm.get_auth(refresh=refresh_auth)
+        with self._lock:
+            self._auth = auth
+            self._auth_time = now
+        return fetch.get_fetcher(url, auth=auth)
+
+class Handler(BaseHTTPRequestHandler):
+    server_version = "Python-iView/" + config.version
+    
+    # Give up on clients that stop reading
+    timeout = 60
+    
+    def do_GET(self):
+        url = self.programme_url()
+        if url is None:
+            self.send_error(404)
+            return
+        byte_range = parse_range(self.headers.get("Range"))
+        spool = self.server.attach(url)
+        if spool is None:
+            self.send_error(503, "Too many downloads")
+            return
+        try:
+            self.send_spool(url, spool, byte_range)
+        except OSError as error:
+            # Probably the client went away or stopped reading, which
+            # raises ConnectionError or "socket.timeout"
+            self.log_error("Streaming stopped: %s", error)
+        finally:
+            self.server.detach(url, spool)
+    
+    def programme_url(self):
+        """Returns the programme file name from the request path, or None"""
+        path = unquote(urlsplit(self.path).path).lstrip("/")
+        (base, ext) = posixpath.splitext(path)
+        if ext != ".flv" or not base or ".." in base.split("/"):
+            return None
+        return base + ".mp4"
+    
+    def send_spool(self, url, spool, byte_range):
+        (size, done, error) = spool.wait(0)
+        if error is not None and not size:
+            self.log_error("Download failed: %r", error)
+            self.send_error(*error_status(error))
+            return
+        
+        if byte_range is not None:
+            (first, last) = byte_range
+            if first is None:  # Last "last" bytes
+                if done:
+                    first = max(size - last, 0)
+                    last = None
+                else:
+                    byte_range = None  # Length not known yet
+        if byte_range is None:
+            self.send_response(200)
+            self.send_header("Content-Type", "video/x-flv")
+            self.send_header("Accept-Ranges", "bytes")
+            if done and error is None:
+                self.send_header("Content-Length", size)
+            self.end_headers()
+            self.send_tail(spool)
+            return
+        
+        # Wait for the start of the range, unless it is far enough ahead to
+        # download separately, and for the end if given
+        while not done:
+            if first >= size:
+                seek_time = spool.estimate_seek(first,
+                    self.server.seek_ahead)
+                if seek_time is not None:
+                    self.send_seek(url, spool, seek_time)
+                    return
+            elif last is None or last < size:
+                break
+            (size, done, error) = spool.wait(size)
+        
+        if done and error is None:
+            complete = size
+        else:
+            complete = "*"
+        if first >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */{}".format(complete))
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        if last is None or last >= size:
+            last = size - 1  # Only what has been downloaded so far
+        self.send_response(206)
+        self.send_header("Content-Type", "video/x-flv")
+        self.send_header("Content-Range",
+            "bytes {}-{}/{}".format(first, last, complete))
+        self.send_header("Content-Length", last + 1 - first)
+        self.end_headers()
+        self.connection.sendfile(spool.file, first, last + 1 - first)
+    
+    def send_tail(self, spool):
+        """Sends the spool, following the download until it finishes"""
+        offset = 0
+        while True:
+            (size, done, error) = spool.wait(offset)
+            if offset < size:
+                self.connection.sendfile(spool.file, offset, size - offset)
+                offset = size
+                continue
+            if error is not None:
+                self.log_error("Download failed: %r", error)
+            return
+    
+    def send_seek(self, url, spool, seek_time):
+        """Sends a separate download starting at a time into the programme
+        
+        The response is a whole FLV file, beginning with the header and
+        metadata from the spool."""
+        if not self.server.downloads.acquire(blocking=False):
+            self.send_error(503, "Too many downloads")
+            return
+        try:
+            fetcher = self.server.get_fetcher(url)
+            output = ResponseWriter(self, 200,
+                (("Content-Type", "video/x-flv"),), spool.preamble())
+            try:
+                fetcher.stream(output, start=seek_time, tags_only=True)
+            except HTTPError as error:
+                self.log_error("Upstream error: %s", error)
+                if not output.started:
+                    self.send_error(*error_status(error))
+        finally:
+            self.server.downloads.release()
+
+class ResponseWriter(BufferedIOBase):
+    """Sends the response headers before the first data is written, so
+    that an error response can still be sent until then
+    
+    Any "prefix" is sent in front of the first data."""
+    
+    def __init__(self, handler, status, headers, prefix=b""):
+        self.handler = handler
+        self.status = status
+        self.headers = headers
+        self.prefix = prefix
+        self.started = False
+    
+    def write(self, b):
+        if not self.started:
+            self.handler.send_response(self.status)
+            for (name, value) in self.headers:
+                self.handler.send_header(name, value)
+            self.handler.end_headers()
+            self.handler.wfile.write(self.prefix)
+            self.started = True
+        return self.handler.wfile.write(b)
+    
+    def writable(self):
+        return True
+
+def parse_range(header):
+    """Parses a "Range" header with a single byte range
+    
+    Returns (first, last), where "last" may be None, or (None, length)
+    for a suffix range. Returns None if there is no header or it is not
+    understood, in which case the whole file should be sent."""
+    match = RANGE_HEADER.fullmatch((header or "").strip())
+    if not match:
+        return None
+    (first, last) = match.groups()
+    if first:
+        first = int(first)
+        if last:
+            last = int(last)
+            if last < first:
+                return None
+        else:
+            last = None
+        return (first, last)
+    if not last:
+        return None
+    return (None, int(last))
+
+RANGE_HEADER = re.compile(r"bytes=(\d*)-(\d*)")
+
+def error_status(error):
+    """Returns the (status, message) response for a failed download"""
+    if isinstance(error, HTTPError):
+        return (502, "Upstream error {}".format(error.code))
+    if isinstance(error, NotImplementedError):
+        return (501, str(error))
+    return (500, None)
+
+class Spool:
+    """Programme being downloaded to a temporary file
+    
+    The file is written by a single download, and can be read by any
+    number of clients, at their own pace."""
+    
+    def __init__(self, directory=None):
+        self.file = TemporaryFile(dir=directory, buffering=0)
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.readers = 0
+        self.abort = threading.Event()
+        self._expired = False
+        self._cond = threading.Condition()
+        self._fraction = 0
+        self._progress = (0, 0)  # (size, fraction) after the last fragment
+        self._duration = None
+    
+    def write(self, b):
+        """Appends data and wakes up any waiting readers"""
+        # Not using the file position, which is moved by sending the file
+        # to clients
+        data = memoryview(b).cast("B")
+        written = 0
+        while written < len(data):
+            written += os.pwrite(self.file.fileno(), data[written:],
+                self.size + written)
+        with self._cond:
+            self.size += written
+            self._cond.notify_all()
+        return written
+    
+    def finish(self, error=None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+            close = self._expired
+        if close:
+            self.file.close()
+    
+    def expire(self):
+        """Stops the download, and closes the file once it has stopped"""
+        self.abort.set()
+        with self._cond:
+            self._expired = True
+            close = self.done
+        if close:
+            self.file.close()
+    
+    def wait(self, offset):
+        """Waits until more than "offset" bytes have been written, or the
+        download has finished, and returns (size, done, error)"""
+        with self._cond:
+            while self.size <= offset and not self.done:
+                self._cond.wait()
+            return (self.size, self.done, self.error)
+    
+    def read(self, offset, size):
+        return os.pread(self.file.fileno(), size, offset)
+    
+    # Frontend interface for progress from hds.fetch()
+    def set_fraction(self, fraction):
+        self._fraction = fraction
+    def set_size(self, size):
+        with self._cond:
+            self._progress = (size, self._fraction)
+    
+    def estimate_seek(self, offset, ahead):
+        """Returns the time into the programme estimated for "offset",
+        or None if it is less than "ahead" seconds beyond the download,
+        or cannot be estimated"""
+        with self._cond:
+            (size, fraction) = self._progress
+        duration = self.duration()
+        if not size or not fraction or not duration:
+            return None
+        downloaded = fraction * duration
+        estimate = min(offset / size * downloaded, duration)
+        if estimate - downloaded < ahead:
+            return None
+        return estimate
+    
+    def duration(self):
+        """Returns the duration from the metadata, or None"""
+        if self._duration is None:
+            metadata = flv_metadata(self.read(0, 0x10000))
+            if metadata is not None:
+                (scriptdata, _) = metadata
+                self._duration = scriptdata["value"].get("duration")
+        return self._duration
+    
+    def preamble(self):
+        """Returns the FLV file header and any metadata tag"""
+        data = self.read(0, 0x10000)
+        metadata = flv_metadata(data)
+        if metadata is None:
+            header = BytesIO()
+            flvlib.write_file_header(header)
+            return header.getvalue()
+        (_, end) = metadata
+        return data[:end]
+
+def flv_metadata(data):
+    """Parses the metadata tag at the start of an FLV file
+    
+    Returns (scriptdata, end), where "end" is the offset following the
+    tag, or None if the tag is missing or incomplete."""
+    start = 9 + 4  # File header, previous tag size
+    end = start + flvlib.TAG_HEADER.size
+    if len(data) < end:
+        return None
+    tag = flvlib.parse_tag_header(data[start:end])
+    (start, end) = (end, end + tag["length"])
+    if tag["type"] != flvlib.TAG_SCRIPTDATA or len(data) < end + 4:
+        return None
+    scriptdata = flvlib.parse_scriptdata(BytesIO(data[start:end]))
+    if scriptdata["name"] != b"onMetaData":
+        return None
+    return (scriptdata, end + 4)  # Including the previous tag size
+
+def main():
+    params = argparse.ArgumentParser(prog="python3 -m iview.server",
+        description="Stream iView programmes over HTTP")
+    params.add_argument("--bind", metavar="<address>", default="",
+        help="address to listen on (default all)")
+    params.add_argument("--port", metavar="<n>", type=int, default=8000,
+        help="port to listen on (default 8000)")
+    params.add_argument("--max-downloads", metavar="<n>", type=int,
+        default=4, help="download up to n programmes at once (default 4)")
+    params.add_argument("-c", "--cache", metavar="<dir>",
+        help="cache iView responses in a directory")
+    params.add_argument("--spool-dir", metavar="<dir>",
+        help="directory for temporary files of programmes being served")
+    params.add_argument("--workers", metavar="<n>", type=int,
+        help="download up to n HDS fragments at once for each programme")
+    args = params.parse_args()
+    
+    if args.cache is not None:
+        config.cache = args.cache
+    if args.workers is not None:
+        config.hds_workers = args.workers
+    
+    comm.get_config()
+    server = Server((args.bind, args.port),
+        max_downloads=args.max_downloads, spool_dir=args.spool_dir)
+    print("Serving on port {}".format(server.server_port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(1)
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,15 @@ from io import BufferedIOBase
 from urllib.parse import quote_plus
 from io import SEEK_CUR
 import urllib.request
-from http.client import HTTPConnection
+from http.client import HTTPConnection, HTTPSConnection
 import http.client
+from urllib.parse import urlsplit
+import threading
+import time
+import socket
+import atexit
+import os
+import stat
 
 def xml_text_elements(parent, namespace=""):
 	"""Extracts text from Element Tree into a dict()
@@ -36,6 +43,114 @@ def read_string(stream):
             return buf
         buf.extend(b)
 
+class BinaryReader(BufferedIOBase):
+    """Buffered reader for parsing binary structures
+    
+    Reads the underlying stream in large blocks into a window, so that
+    small reads, peeking and unpacking structures do not each call into
+    the underlying stream. Large reads into a buffer are passed straight
+    through once the window is empty. The underlying stream is read ahead,
+    so it should not be used directly afterwards."""
+    
+    def __init__(self, stream, size=0x10000):
+        self._stream = stream
+        self._size = size
+        self._window = bytearray()
+        self._pos = 0
+    
+    def _fill(self, size):
+        """Tries to make "size" bytes available in the window
+        
+        Returns the number of bytes available, which is less than
+        requested at EOF."""
+        available = len(self._window) - self._pos
+        if available >= size:
+            return available
+        del self._window[:self._pos]
+        self._pos = 0
+        while available < size:
+            chunk = self._stream.read(max(self._size, size - available))
+            if not chunk:
+                break
+            self._window.extend(chunk)
+            available += len(chunk)
+        return available
+    
+    def peek(self, size=1):
+        """Returns up to "size" bytes without consuming them"""
+        available = self._fill(size)
+        return bytes(self._window[self._pos:self._pos + min(size, available)])
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = bytes(self._window[self._pos:]) + self._stream.read()
+            self._window.clear()
+            self._pos = 0
+            return data
+        available = self._fill(size)
+        size = min(size, available)
+        with memoryview(self._window) as window:
+            data = bytes(window[self._pos:self._pos + size])
+        self._pos += size
+        return data
+    
+    def readinto(self, b):
+        available = len(self._window) - self._pos
+        if not available:
+            readinto = getattr(self._stream, "readinto", None)
+            if readinto and len(b) >= self._size:
+                return readinto(b)
+            available = self._fill(len(b))
+        size = min(len(b), available)
+        with memoryview(self._window) as window:
+            b[:size] = window[self._pos:self._pos + size]
+        self._pos += size
+        return size
+    
+    def unpack(self, struct):
+        """Reads and unpacks a "struct.Struct" structure"""
+        if len(self._window) - self._pos < struct.size:
+            if self._fill(struct.size) < struct.size:
+                raise EOFError("Truncated structure")
+        values = struct.unpack_from(self._window, self._pos)
+        self._pos += struct.size
+        return values
+    
+    def read_int(self, size):
+        """Reads a big-endian unsigned integer"""
+        if self._fill(size) < size:
+            raise EOFError("Truncated integer")
+        start = self._pos
+        self._pos += size
+        return int.from_bytes(self._window[start:self._pos], "big")
+    
+    def read_string(self):
+        """Reads a null-terminated string, not including the terminator"""
+        start = self._pos
+        while True:
+            end = self._window.find(b"\x00", start)
+            if end >= 0:
+                break
+            start = len(self._window) - self._pos
+            if self._fill(start + 1) <= start:
+                raise EOFError("Unterminated string")
+            start += self._pos
+        string = bytes(self._window[self._pos:end])
+        self._pos = end + 1
+        return string
+    
+    def skip(self, size):
+        available = len(self._window) - self._pos
+        if size <= available:
+            self._pos += size
+            return
+        self._window.clear()
+        self._pos = 0
+        fastforward(self._stream, size - available)
+    
+    def readable(self):
+        return True
+
 value_unsafe = '%+&;#'
 VALUE_SAFE = ''.join(chr(c) for c in range(33, 127)
     if chr(c) not in value_unsafe)
@@ -44,8 +159,8 @@ def urlencode_param(value):
     return quote_plus(value, safe=VALUE_SAFE)
 
 class CounterWriter(BufferedIOBase):
-    def __init__(self, output):
-        self.length = 0
+    def __init__(self, output, length=0):
+        self.length = length
         self.output = output
     def write(self, b):
         self.length += len(b)
@@ -74,22 +189,94 @@ class TeeWriter(BufferedIOBase):
             output.write(b)
 
 def streamcopy(input, output, length):
+    """Copies exactly "length" bytes from one stream to another
+    
+    If both streams are backed by file descriptors and the input is a
+    regular file, the kernel copies the data with sendfile(). Otherwise
+    the data is read into a buffer that is reused for each copy."""
+    
     assert length >= 0
+    if length and sendfile(input, output, length):
+        return
+    
+    readinto = getattr(input, "readinto", None)
+    if readinto is None:
+        while length:
+            chunk = input.read(min(length, 0x10000))
+            assert chunk
+            output.write(chunk)
+            length -= len(chunk)
+        return
+    
+    buffer = copy_buffer()
     while length:
-        chunk = input.read(min(length, 0x10000))
-        assert chunk
-        output.write(chunk)
-        length -= len(chunk)
+        size = readinto(buffer[:min(length, len(buffer))])
+        assert size
+        output.write(buffer[:size])
+        length -= size
 
 def fastforward(stream, offset):
     assert offset >= 0
-    if stream.seekable():
+    if isinstance(stream, BinaryReader):
+        stream.skip(offset)
+    elif stream.seekable():
         stream.seek(offset, SEEK_CUR)
     else:
+        buffer = copy_buffer()
         while offset:
-            chunk = stream.read(min(offset, 0x10000))
-            assert chunk
-            offset -= len(chunk)
+            size = stream.readinto(buffer[:min(offset, len(buffer))])
+            assert size
+            offset -= size
+
+def copy_buffer():
+    """Returns a memoryview of a buffer reused by the current thread
+    
+    The contents are only valid until the next call from the same thread."""
+    try:
+        return _thread_buffers.buffer
+    except AttributeError:
+        buffer = memoryview(bytearray(0x10000))
+        _thread_buffers.buffer = buffer
+        return buffer
+
+_thread_buffers = threading.local()
+
+def sendfile(input, output, length):
+    """Copies from a regular file to another file descriptor in the kernel
+    
+    Returns False without copying anything if this is not possible, in
+    which case the caller should copy the data itself."""
+    
+    if not hasattr(os, "sendfile"):
+        return False
+    try:
+        infd = input.fileno()
+        outfd = output.fileno()
+    except (AttributeError, EnvironmentError, ValueError):
+        return False
+    if not stat.S_ISREG(os.fstat(infd).st_mode):
+        return False
+    
+    # The streams may have their own buffers. Use the input's logical
+    # position rather than its descriptor's position, and write out any
+    # data already buffered for the output.
+    offset = input.tell()
+    output.flush()
+    copied = 0
+    try:
+        while copied < length:
+            size = os.sendfile(outfd, infd, offset + copied, length - copied)
+            if not size:
+                break
+            copied += size
+    except EnvironmentError:
+        if not copied:
+            return False  # For example, not supported by this platform
+        raise
+    finally:
+        input.seek(offset + copied)
+    assert copied == length
+    return True
 
 class WritingReader(BufferedIOBase):
     """Filter for a reader stream that writes the data read to another stream
@@ -109,6 +296,118 @@ def setitem(dict, key):
         return func
     return decorator
 
+class ConnectionPool:
+    """Thread-safe pool of persistent HTTP and HTTPS connections
+    
+    Connections are keyed by (scheme, host, port). No more than
+    "max_per_host" connections are open to each host at once; further
+    requests wait for a connection to be released. Idle connections are
+    closed after "idle_timeout" seconds. The "opened" and "reused"
+    attributes count how many connections were opened, and how many times
+    an existing connection was used again.
+    """
+    
+    def __init__(self, max_per_host=8, idle_timeout=15):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.opened = 0
+        self.reused = 0
+        self._lock = threading.Condition()
+        self._idle = dict()  # Lists of (connection, release time) tuples
+        self._open = dict()  # Number of connections open to each host
+    
+    def acquire(self, scheme, host, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        """Returns a (connection, key, reused) tuple
+        
+        The connection must be given back by calling release() with the
+        key. The "host" parameter may include a port number."""
+        
+        split = urlsplit("//" + host)
+        key = (scheme, split.hostname, split.port or DEFAULT_PORTS[scheme])
+        with self._lock:
+            while True:
+                self._expire()
+                idle = self._idle.get(key)
+                if idle:
+                    (connection, _) = idle.pop()
+                    if connection.sock is None:
+                        self.opened += 1
+                        return (connection, key, False)
+                    self.reused += 1
+                    return (connection, key, True)
+                if self._open.get(key, 0) < self.max_per_host:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    self.opened += 1
+                    break
+                self._lock.wait()
+        
+        if scheme == "https":
+            connection = HTTPSConnection(host, timeout=timeout)
+        else:
+            connection = HTTPConnection(host, timeout=timeout)
+        connection.response_class = PooledResponse
+        return (connection, key, False)
+    
+    def release(self, connection, key, reusable=True):
+        """Returns a connection to the pool
+        
+        If "reusable" is false, the connection is closed."""
+        with self._lock:
+            if reusable:
+                idle = self._idle.setdefault(key, list())
+                idle.append((connection, time.monotonic()))
+            else:
+                connection.close()
+                self._open[key] -= 1
+            self._lock.notify_all()
+    
+    def reopened(self, connection):
+        """Closes a connection that will be opened again straight away"""
+        connection.close()
+        with self._lock:
+            self.opened += 1
+    
+    def close(self):
+        """Closes all idle connections"""
+        with self._lock:
+            for (key, idle) in self._idle.items():
+                for (connection, _) in idle:
+                    connection.close()
+                self._open[key] -= len(idle)
+            self._idle.clear()
+            self._lock.notify_all()
+    
+    def _expire(self):
+        expiry = time.monotonic() - self.idle_timeout
+        for (key, idle) in self._idle.items():
+            # The oldest connections are at the start of each list
+            while idle and idle[0][1] <= expiry:
+                (connection, _) = idle.pop(0)
+                connection.close()
+                self._open[key] -= 1
+                self._lock.notify_all()
+
+class PooledResponse(http.client.HTTPResponse):
+    """Response that records whether it was closed before the end
+    
+    The rest of the body is then left unread on the connection, so the
+    connection cannot be used for another request."""
+    
+    truncated = False
+    
+    def close(self):
+        # At the end of the body, "http.client" already drops "fp"
+        if self.fp is not None and self.length != 0:
+            self.truncated = True
+        http.client.HTTPResponse.close(self)
+
+DEFAULT_PORTS = {"http": http.client.HTTP_PORT,
+    "https": http.client.HTTPS_PORT}
+
+# Shared by all connection handlers unless they are given their own pool
+connection_pool = ConnectionPool()
+atexit.register(connection_pool.close)
+
 class PersistentConnectionHandler(urllib.request.BaseHandler):
     """URL handler for HTTP persistent connections
     
@@ -123,42 +422,45 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
     with session.open("http://localhost/two") as response:
         response.read()
     
-    # Closes old connection when new host specified
+    # Another connection used when new host specified
     with session.open("http://example/three") as response:
         response.read()
     
-    connection.close()  # Frees socket
+    connection.close()  # Returns connection to pool
+    
+    Connections come from a ConnectionPool, by default the process-wide
+    "connection_pool", so they may also be reused by other handlers. A
+    connection is returned to the pool when the next request is made, or
+    when the handler is closed. It is only kept open if the previous
+    response was read to the end, and not closed before then.
     """
     
-    def __init__(self, *pos, **kw):
-        self._type = None
-        self._host = None
-        self._pos = pos
-        self._kw = kw
+    def __init__(self, pool=None):
+        if pool is None:
+            pool = connection_pool
+        self._pool = pool
         self._connection = None
+        self._key = None
+        self._response = None
     
     def default_open(self, req):
-        if req.type != "http":
+        if req.type not in DEFAULT_PORTS:
             return None
         
-        if req.type != self._type or req.host != self._host:
-            if self._connection:
-                self._connection.close()
-            self._connection = HTTPConnection(req.host,
-                *self._pos, **self._kw)
-            self._type = req.type
-            self._host = req.host
+        self.close()
+        (self._connection, self._key, reused) = self._pool.acquire(
+            req.type, req.host, req.timeout)
         
         headers = dict(req.header_items())
         try:
             return self._openattempt(req, headers)
-        except http.client.BadStatusLine as err:
-            # If the server closed the connection before receiving this
-            # request, the "http.client" module raises an exception with the
-            # "line" attribute set to repr("")!
-            if err.line != repr(""):
+        except (http.client.BadStatusLine, ConnectionError):
+            # If the server closed an idle connection before receiving this
+            # request, the "http.client" module raises an exception when
+            # sending the request or reading the response
+            if not reused:
                 raise
-        self._connection.close()
+        self._pool.reopened(self._connection)
         return self._openattempt(req, headers)
     
     def _openattempt(self, req, headers):
@@ -166,6 +468,7 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
         self._connection.request(req.get_method(), req.selector, req.data,
             headers)
         response = self._connection.getresponse()
+        self._response = response
         
         # Odd impedance mismatch between "http.client" and "urllib.request"
         response.msg = response.reason
@@ -174,7 +477,12 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
     
     def close(self):
         if self._connection:
-            self._connection.close()
+            response = self._response
+            reusable = (response is not None and response.isclosed() and
+                not response.truncated and not response.will_close)
+            self._pool.release(self._connection, self._key, reusable)
+            self._connection = None
+            self._response = None
     
     def __enter__(self):
         return self
@@ -7,6 +7,7 @@ from contextlib import contextmanager
 from tempfile import TemporaryDirectory
 import sys
 from io import BytesIO, TextIOWrapper, StringIO
+import struct
 
 try:  # Python 3.4
     from importlib import reload
@@ -19,19 +20,72 @@ class TestCli(TestCase):
         self.iview_cli = load_script(path, "iview-cli")
     
     def test_subtitles(self):
-        class comm:
-            def get_config():
-                pass
-            def get_captions(url):
-                return "dummy captions"
+        comm = self.iview_cli.iview.comm
+        def get_config():
+            pass
+        def write_captions(url, output):
+            output.write("dummy captions")
+            if url == "broken":
+                raise ValueError("Invalid captions")
         
-        with substattr(self.iview_cli.iview, "comm", comm), \
+        with substattr(comm, get_config), substattr(comm, write_captions), \
         substattr(self.iview_cli, "stderr", StringIO()), \
         TemporaryDirectory(prefix="python-iview.") as dir:
             output = os.path.join(dir, "programme.srt")
             self.iview_cli.subtitles("programme.mp4", output)
+            with open(output, "r") as file:
+                self.assertEqual("dummy captions", file.read())
             with substattr(sys, "stdout", TextIOWrapper(BytesIO())):
                 self.iview_cli.subtitles("programme.mp4", "-")
+            
+            # No partial file is left behind
+            output = os.path.join(dir, "broken.srt")
+            with self.assertRaises(ValueError):
+                self.iview_cli.subtitles("broken.mp4", output)
+            self.assertEqual(["programme.srt"], os.listdir(dir))
+    
+    def test_range(self):
+        argv = ["iview-cli", "--download", "programme.mp4",
+            "--start", "6", "--end", "3"]
+        with substattr(sys, "argv", argv), \
+        substattr(sys, "stderr", StringIO()) as stderr, \
+        self.assertRaises(SystemExit) as context:
+            self.iview_cli.main()
+        self.assertEqual(2, context.exception.code)
+        self.assertIn("--end must be after --start", stderr.getvalue())
+    
+    def test_subtitles_output(self):
+        """Subtitles for several programmes need an output directory"""
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            output = os.path.join(dir, "file.srt")
+            open(output, "w").close()
+            argv = ["iview-cli", "-t", "one.mp4", "two.mp4", "-o", output]
+            with substattr(sys, "argv", argv), \
+            substattr(sys, "stderr", StringIO()) as stderr, \
+            self.assertRaises(SystemExit) as context:
+                self.iview_cli.main()
+        self.assertEqual(2, context.exception.code)
+        self.assertIn("-o must be a directory", stderr.getvalue())
+    
+    def test_batch_captions(self):
+        """Subtitles recorded in the index are not fetched again"""
+        import iview.batch
+        cwd = os.getcwd()
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            os.chdir(dir)
+            try:
+                with iview.batch.EpisodeIndex("state") as index:
+                    index.add("1")
+                    index.add("2")
+                    index.add_captions("2")
+                    captions = list()
+                    for id in ("1", "2"):
+                        episode = dict(id=id, url="news/{}.mp4".format(id))
+                        self.iview_cli.batch_fetch_program(None, index,
+                            episode, series=None, captions=captions)
+            finally:
+                os.chdir(cwd)
+        self.assertEqual([("news/1", "1.srt", "1")], captions)
     
     def test_proxy(self):
         class config:
@@ -50,6 +104,386 @@ class TestF4v(TestCase):
             bytes.fromhex("0000 0000 0000 0016"))
         self.assertEqual((b"mdat", 6), iview.hds.read_box_header(stream))
         self.assertEqual((None, None), iview.hds.read_box_header(BytesIO()))
+    
+    def test_run_tables(self):
+        from iview import hds
+        frag_runs = hds.FragRunTable()
+        frag_runs.append(1, 0, 4000)
+        frag_runs.append(3, 8000, 0, hds.DISCONT_TIME)
+        frag_runs.append(3, 10000, 3000)
+        frag_runs.append(5, 16000, 0, hds.DISCONT_END)
+        frag_runs.finish()
+        frags = [(1, 4000), (2, 8000), (3, 13000)]
+        self.assertEqual(frags, list(hds.iter_frags(frag_runs)))
+        self.assertEqual(frags[2:], list(hds.iter_frags(frag_runs, 2)))
+        self.assertEqual((1, 0), frag_runs.find(0))
+        self.assertEqual((2, 1), frag_runs.find(9000))
+        self.assertEqual((3, 2), frag_runs.find(12000))
+        self.assertEqual((3, 2), frag_runs.find(99000))
+        
+        seg_runs = hds.SegRunTable()
+        seg_runs.append(1, 2)
+        seg_runs.append(3, 1)
+        seg_runs.finish()
+        segs = hds.iter_segs(seg_runs, 3)
+        self.assertEqual([2, 3, 4], [next(segs) for _ in range(3)])
+        
+        # Run without any fragments at the end of the table
+        seg_runs = hds.SegRunTable()
+        seg_runs.append(1, 2)
+        seg_runs.append(3, 0)
+        seg_runs.finish()
+        self.assertEqual([1, 1, 2, 2], list(hds.iter_segs(seg_runs)))
+    
+    def test_binary_reader(self):
+        from iview.utils import BinaryReader
+        data = b"\x01\x02\x03" + b"string" * 10 + b"\x00" + bytes(range(256))
+        reader = BinaryReader(BytesIO(data), size=4)
+        self.assertEqual(b"\x01\x02", reader.peek(2))
+        self.assertEqual((0x0102,), reader.unpack(struct.Struct(">H")))
+        self.assertEqual(3, reader.read_int(1))
+        self.assertEqual(b"string" * 10, reader.read_string())
+        reader.skip(6)
+        buffer = bytearray(100)
+        self.assertEqual(100, reader.readinto(buffer))
+        self.assertEqual(bytes(range(6, 106)), buffer)
+        self.assertEqual(bytes(range(106, 256)), reader.read())
+        self.assertEqual(b"", reader.read(1))
+    
+    def test_binary_reader_eof(self):
+        from iview.utils import BinaryReader
+        reader = BinaryReader(BytesIO(b"\x01"), size=4)
+        with self.assertRaises(EOFError):
+            reader.unpack(struct.Struct(">H"))
+        reader = BinaryReader(BytesIO(b"\x01\x02\x03"), size=2)
+        with self.assertRaises(EOFError):
+            reader.read_int(4)
+        reader = BinaryReader(BytesIO(b"string"), size=4)
+        with self.assertRaises(EOFError):
+            reader.read_string()
+
+class TestStreamcopy(TestCase):
+    def test_buffer(self):
+        from iview.utils import streamcopy
+        data = bytes(range(256)) * 0x200
+        input = BytesIO(data)
+        input.read(3)
+        output = BytesIO()
+        streamcopy(input, output, 0x10010)
+        self.assertEqual(data[3:3 + 0x10010], output.getvalue())
+        self.assertEqual(3 + 0x10010, input.tell())
+    
+    def test_sendfile(self):
+        from iview.utils import streamcopy
+        data = bytes(range(256)) * 0x200
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            input = os.path.join(dir, "input")
+            output = os.path.join(dir, "output")
+            with open(input, "wb") as file:
+                file.write(data)
+            with open(input, "rb") as input, open(output, "wb") as output:
+                input.read(3)
+                output.write(b"head")
+                streamcopy(input, output, 1000)
+                self.assertEqual(data[1003:1006], input.read(3))
+            with open(output.name, "rb") as output:
+                self.assertEqual(b"head" + data[3:1003], output.read())
+
+class TestHds(TestCase):
+    def test_workers(self):
+        """Concurrent download should produce the same file"""
+        import iview.hds
+        with HdsServer(frags=7) as server:
+            sequential = server.fetch()
+            for workers in (1, 3):
+                self.assertEqual(sequential, server.fetch(workers=workers))
+        
+        # Sequence headers only written once
+        self.assertEqual(1, sequential.count(b"audio header"))
+        self.assertEqual(7, sequential.count(b"audio frame"))
+    
+    def test_range(self):
+        """Only fragments covering the range, starting from time zero"""
+        import iview.flvlib
+        import iview.hds
+        from iview.utils import BinaryReader
+        with HdsServer(frags=10) as server:
+            flv = server.fetch(start=3.5, end=6)
+        self.assertEqual(3, flv.count(b"audio frame"))
+        self.assertEqual(1, flv.count(b"audio header"))
+        
+        flv = BinaryReader(BytesIO(flv))
+        flv.skip(9 + 4)  # File header, previous tag size
+        tag = iview.flvlib.read_tag_header(flv)
+        metadata = iview.flvlib.parse_scriptdata(flv, tag)
+        self.assertEqual(3, metadata["value"]["duration"])
+        flv.skip(4)
+        timestamps = list()
+        while True:
+            tag = iview.flvlib.read_tag_header(flv)
+            if tag is None:
+                break
+            timestamps.append(tag["timestamp"])
+            flv.skip(tag["length"] + 4)
+        self.assertEqual([0] * 4 + [1000] * 2 + [2000] * 2, timestamps)
+    
+    def test_unknown_metadata(self):
+        """Metadata with unsupported types is passed through unchanged"""
+        import iview.hds
+        metadata = b"".join((b"\x02", len(b"onMetaData").to_bytes(2, "big"),
+            b"onMetaData", b"\x08", bytes(4),
+            b"\x00\x08duration\x00", struct.pack(">d", 10),
+            b"\x00\x0Ccreationdate\x0B", struct.pack(">dh", 0, 0),
+            b"\x00\x00\x09",
+        ))
+        self.assertIsNone(iview.hds.parse_metadata(metadata))
+        self.assertEqual(metadata, iview.hds.set_duration(metadata, 3))
+        self.assertEqual(metadata[:-3],
+            iview.hds.set_duration(metadata[:-3], 3))
+        
+        with self.assertRaises(ValueError):
+            iview.hds.fetch("http://localhost/", "programme",
+                dest_file=BytesIO(), start=6, end=3)
+    
+    def test_bitrate(self):
+        for children in (False, True):
+            with HdsServer(frags=2, bitrates=(800, 300, 1500),
+            children=children) as server:
+                for (bitrate, expected) in (
+                    (None, 800),
+                    ("highest", 1500),
+                    ("lowest", 300),
+                    (1000, 800),
+                    (100, 300),
+                ):
+                    flv = server.fetch(bitrate=bitrate)
+                    label = "<{}>".format(expected).encode("ascii")
+                    self.assertEqual(2, flv.count(label))
+    
+    def test_adaptive(self):
+        from iview.hds import AdaptiveBitrate
+        adaptive = AdaptiveBitrate([300, 800, 1500], margin=1.5)
+        self.assertEqual(0, adaptive.choose())
+        adaptive.record(300000, 1)  # 2400 kb/s
+        self.assertEqual(2, adaptive.choose())
+        for _ in range(5):
+            adaptive.record(150000, 1)  # 1200 kb/s
+        self.assertEqual(1, adaptive.choose())
+        
+        # Sequence headers kept after each switch
+        with HdsServer(frags=6, frag_size=0x10000,
+        bitrates=(300, 1500)) as server:
+            flv = server.fetch(bitrate="adaptive")
+        self.assertEqual(1, flv.count(b"<300>"))
+        self.assertEqual(5, flv.count(b"<1500>"))
+        self.assertEqual(2, flv.count(b"audio header"))
+    
+    def test_resume(self):
+        import iview.fetch
+        class Interrupt(Exception):
+            pass
+        class frontend:
+            def set_fraction(fraction):
+                if fraction >= 0.5:
+                    raise Interrupt()
+            def set_size(size):
+                pass
+        
+        with HdsServer(frags=6) as server, \
+        TemporaryDirectory(prefix="python-iview.") as dir:
+            complete = server.fetch()
+            output = os.path.join(dir, "programme.flv")
+            journal = iview.fetch.journal_file(output)
+            
+            with self.assertRaises(Interrupt):
+                iview.fetch.hds_open_file(server.url, "programme",
+                    dest_file=output, frontend=frontend)
+            self.assertTrue(os.path.isfile(journal))
+            with open(output, "ab") as file:
+                file.write(b"incomplete fragment")
+            
+            iview.fetch.hds_open_file(server.url, "programme",
+                dest_file=output, frontend=HdsServer.Frontend)
+            with open(output, "rb") as file:
+                self.assertEqual(complete, file.read())
+            self.assertFalse(os.path.isfile(journal))
+
+class TestConnectionPool(TestCase):
+    def test_reuse(self):
+        """Connections should be shared between handlers"""
+        import iview.utils
+        import urllib.request
+        pool = iview.utils.ConnectionPool()
+        with HdsServer(frags=2) as server:
+            for frag in (1, 2):
+                url = server.url + "programme/mediaSeg1-Frag{}".format(frag)
+                with iview.utils.PersistentConnectionHandler(pool) as handler:
+                    session = urllib.request.build_opener(handler)
+                    with session.open(url) as response:
+                        response.read()
+            self.assertEqual((1, 1), (pool.opened, pool.reused))
+            
+            pool.idle_timeout = 0
+            with iview.utils.PersistentConnectionHandler(pool) as handler:
+                session = urllib.request.build_opener(handler)
+                with session.open(url) as response:
+                    response.read()
+            self.assertEqual((2, 1), (pool.opened, pool.reused))
+            pool.close()
+    
+    def test_closed_early(self):
+        """Unread data must not be left on a connection for reuse"""
+        import iview.utils
+        import urllib.request
+        pool = iview.utils.ConnectionPool()
+        files = {"/large": bytes(0x20000), "/small": b"small"}
+        with HttpServer(files) as server, \
+        iview.utils.PersistentConnectionHandler(pool) as handler:
+            session = urllib.request.build_opener(handler)
+            with session.open(server.url + "large") as response:
+                response.read(10)
+            with session.open(server.url + "small") as response:
+                self.assertEqual(b"small", response.read())
+            with session.open(server.url + "small") as response:
+                self.assertEqual(b"small", response.read())
+        self.assertEqual((2, 1), (pool.opened, pool.reused))
+        pool.close()
+
+class TestCache(TestCase):
+    def test_http(self):
+        import iview.config
+        import gzip
+        compressed = gzip.compress(b"two")
+        files = {
+            "/api?series=1": (b"one",
+                {"ETag": '"1"', "Cache-Control": "max-age=0"}),
+            "/api?series=2": (compressed,
+                {"Content-Encoding": "gzip", "Cache-Control": "max-age=60"}),
+        }
+        iview_config = dict(headers=dict())
+        with HttpServer(files) as server, \
+        TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.config, "cache", dir), \
+        substattr(iview.comm, "iview_config", iview_config):
+            one = server.url + "api?series=1"
+            two = server.url + "api?series=2"
+            self.assertEqual(b"one", iview.comm.maybe_fetch(one))
+            self.assertEqual(b"two", iview.comm.maybe_fetch(two))
+            self.assertEqual(2, len(server.requests))
+            
+            # Fresh response is not requested again
+            self.assertEqual(b"two", iview.comm.maybe_fetch(two))
+            self.assertEqual(2, len(server.requests))
+            cache = iview.cache.HttpCache(dir)
+            self.assertEqual(compressed, cache.lookup(two).raw())
+            
+            # Stale response is revalidated
+            self.assertEqual(b"one", iview.comm.maybe_fetch(one))
+            self.assertEqual(3, len(server.requests))
+            self.assertEqual('"1"', server.requests[-1]["If-None-Match"])
+            
+            # Least recently used response is evicted
+            paths = [cache.lookup(url).path for url in (two, one)]
+            for (used, path) in enumerate(paths):
+                os.utime(path, (used, used))
+            sizes = [os.path.getsize(path) for path in paths]
+            cache.max_size = sum(sizes) - 1
+            cache.evict()
+            self.assertIsNone(cache.lookup(two))
+            self.assertIsNotNone(cache.lookup(one))
+            cache.max_size = sizes[1]
+            cache.evict()
+            self.assertIsNotNone(cache.lookup(one))
+
+class TestBatch(TestCase):
+    def test_scheduler(self):
+        import iview.batch
+        import threading
+        import time
+        lock = threading.Lock()
+        running = dict()
+        peaks = dict()
+        class Job:
+            def __init__(self, name, host, failures=0):
+                self.name = name
+                self._host = host
+                self.failures = failures
+            def host(self):
+                return self._host
+            def run(self):
+                with lock:
+                    running[self._host] = running.get(self._host, 0) + 1
+                    peaks[self._host] = max(peaks.get(self._host, 0),
+                        running[self._host])
+                time.sleep(0.01)
+                with lock:
+                    running[self._host] -= 1
+                if self.failures:
+                    self.failures -= 1
+                    raise EnvironmentError("Dummy failure")
+        
+        scheduler = iview.batch.Scheduler(max_parallel=4, max_per_host=1,
+            retries=1, backoff=0)
+        with substattr(sys, "stderr", StringIO()):
+            for i in range(4):
+                scheduler.submit(Job(i, host=i % 2))
+            scheduler.submit(Job("retried", host=2, failures=1))
+            scheduler.submit(Job("failed", host=3, failures=2))
+            results = {result.job.name: result for result in scheduler.wait()}
+        
+        self.assertEqual({0: 1, 1: 1, 2: 1, 3: 1}, peaks)
+        self.assertEqual(2, results["retried"].attempts)
+        self.assertFalse(results["retried"].failed)
+        self.assertTrue(results["failed"].failed)
+        summary = list(iview.batch.summary(results.values()))
+        self.assertEqual("5 downloaded, 1 failed", summary[0])
+    
+    def test_rtmpdump_job(self):
+        """A successful "rtmpdump" run counts as a download"""
+        import iview.batch
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            runs = os.path.join(dir, "runs")
+            rtmpdump = os.path.join(dir, "rtmpdump")
+            with open(rtmpdump, "w") as file:
+                file.write("#! /bin/sh\n"
+                    "echo run >> '{}'\n"
+                    "echo flv > \"$2\"\n".format(runs))
+            os.chmod(rtmpdump, 0o755)
+            path = dir + os.pathsep + os.environ.get("PATH", "")
+            
+            dest_file = os.path.join(dir, "news.flv")
+            with iview.batch.EpisodeIndex(os.path.join(dir, "state")) \
+            as index, substattr(os, "environ", dict(os.environ, PATH=path)), \
+            substattr(sys, "stderr", StringIO()):
+                scheduler = iview.batch.Scheduler(retries=2, backoff=0)
+                scheduler.submit(iview.batch.DownloadJob("news",
+                    "rtmp://localhost/live/news", dest_file, index,
+                    dict(id="1")))
+                (result,) = scheduler.wait()
+                self.assertFalse(result.failed)
+                self.assertEqual(1, result.attempts)
+                self.assertIn("1", index)
+            with open(runs) as file:
+                self.assertEqual("run\n", file.read())
+    
+    def test_index(self):
+        import iview.batch
+        with TemporaryDirectory(prefix="python-iview.") as dir:
+            filename = os.path.join(dir, "batch.state")
+            with iview.batch.EpisodeIndex(filename) as index:
+                self.assertNotIn("1234", index)
+                index.add("1234", size=1e6, duration=60, completed=1.5)
+            with iview.batch.EpisodeIndex(filename) as index:
+                self.assertIn("1234", index)
+                self.assertEqual(dict(size=1e6, duration=60, completed=1.5),
+                    index.get("1234"))
+                self.assertIsNone(index.get("5678"))
+                
+                self.assertFalse(index.has_captions("1234"))
+                index.add_captions("1234")
+            with iview.batch.EpisodeIndex(filename) as index:
+                self.assertTrue(index.has_captions("1234"))
+                self.assertFalse(index.has_captions("5678"))
 
 class TestGui(TestCase):
     def setUp(self):
@@ -89,6 +523,53 @@ class TestGui(TestCase):
             iter = (None, dict(id="100"))
             self.iview_gtk.load_series_items(view, iter, None)
 
+class TestRtmpdump(TestCase):
+    def test_progress(self):
+        """Progress and debug output from a stand-in "rtmpdump" process"""
+        import iview.fetch
+        output = [b"RTMPDump v2.4\r\n", b"Connecting ...\n"]
+        for i in range(1, 11):
+            output.append("{:.3F} kB / {:.2F} sec ({:.1F}%)\r".format(
+                i * 100, i, i * 10).encode("ascii"))
+        output.append(b"\nDownload complete\n")
+        script = "import sys; sys.stderr.buffer.write({!r})".format(
+            b"".join(output))
+        
+        fractions = list()
+        sizes = list()
+        done = list()
+        class Frontend:
+            def set_fraction(fraction):
+                fractions.append(fraction)
+            def set_size(size):
+                sizes.append(size)
+            def done(**kw):
+                done.append(kw)
+        
+        with substattr(sys, "stderr", StringIO()):
+            worker = iview.fetch.RtmpWorker([sys.executable, "-c", script],
+                Frontend)
+            worker.start()
+            worker.join()
+            debug = sys.stderr.getvalue()
+        self.assertEqual([dict()], done)
+        self.assertEqual(1.0, fractions[-1])
+        self.assertEqual(1000 * 1024, sizes[-1])
+        self.assertLess(len(fractions), 10)  # Updates are throttled
+        self.assertEqual(
+            "Backend debug:\tRTMPDump v2.4\n"
+            "Backend debug:\tConnecting ...\n"
+            "Backend debug:\tDownload complete\n", debug)
+    
+    def test_read_lines(self):
+        from iview.fetch import read_lines
+        class Pipe:
+            chunks = [b"first\rsec", b"ond\r\nthird\n", b"last"]
+            def read1(size):
+                return Pipe.chunks.pop(0) if Pipe.chunks else b""
+        self.assertEqual([[b"first"], [b"second", b"third"], [], [b"last"]],
+            list(read_lines(Pipe)))
+
 class TestParse(TestCase):
     def test_date(self):
         """Test various date formats that have been seen"""
@@ -99,10 +580,535 @@ class TestParse(TestCase):
             ("2014-02-07 21:00:00", datetime(2014, 2, 7, 21)),  # Normal
             ("2014-02-13", datetime(2014, 2, 13)),  # News 24
             ("0000-00-00 00:00:00", None),  # QI series 6 episode 11
+            ("0000-00-00", None),
+            ("2014-2-7", datetime(2014, 2, 7)),  # Accepted by strptime()
         ):
             self.assertEqual(expected, iview.parser.parse_date(input))
+        for input in ("2014-02-30", "2014-02-07 24:00:00", "2014/02/07",
+        "2014-02-0\u00B2"):
+            with self.assertRaises(ValueError):
+                iview.parser.parse_date(input)
+    
+    def test_series_stream(self):
+        import iview.parser
+        import json
+        series = [
+            dict(a="2", b="zebra", f=[dict(a="21", b="Zébra")]),
+            dict(a="1", b="Apple &amp; co", f=[]),
+        ]
+        data = json.dumps(series, ensure_ascii=False).encode("utf-8")
+        chunks = (data[i:i + 7] for i in range(0, len(data), 7))
+        streamed = list(iview.parser.iter_series_api(chunks))
+        self.assertEqual(["2", "1"], [item["id"] for item in streamed])
+        self.assertEqual("Zébra", streamed[0]["items"][0]["title"])
+        self.assertEqual(streamed,
+            iview.parser.parse_series_api(data, sort=False))
+        self.assertEqual(["Apple & co", "zebra"], [item["title"]
+            for item in iview.parser.parse_series_api(data)])
+    
+    def test_json_array(self):
+        """Elements split anywhere, including within strings and escapes"""
+        import iview.parser
+        import json
+        array = [{"a": ["]", "}", "\\", '\\"'], "b": {"c": [[], {}]}},
+            "x\\", '"[', 12345, -1.5e3, True, None, [], {}]
+        text = json.dumps(array)
+        for size in range(1, len(text) + 1):
+            chunks = (text[i:i + size] for i in range(0, len(text), size))
+            self.assertEqual(array,
+                list(iview.parser.iter_json_array(chunks)), size)
+        for text in ('[1, 2', '[{"a": 1]', '[1 2]', '[tru]', '[1] 2'):
+            with self.assertRaises(ValueError):
+                list(iview.parser.iter_json_array(text))
+    
+    def test_lazy_items(self):
+        """Episodes are only parsed when accessed"""
+        import iview.parser
+        import json
+        parsed = list()
+        def parse_series_items(series_json):
+            parsed.append(series_json)
+            return [dict(title=item["b"]) for item in series_json]
+        data = json.dumps([dict(a="1", b="Series", f=[dict(b="Episode")])])
+        with substattr(iview.parser, parse_series_items):
+            [series] = iview.parser.parse_series_api(data.encode("ascii"))
+            self.assertEqual("Series", series["title"])
+            self.assertEqual(1, len(series["items"]))
+            self.assertEqual([], parsed)
+            self.assertEqual("Episode", series["items"][0]["title"])
+            self.assertEqual([dict(title="Episode")], series["items"])
+        self.assertEqual(1, len(parsed))
+    
+    def test_captions(self):
+        import iview.parser
+        xml = (b'<?xml version="1.0"?>\n<xml><reel>'
+            b'<title start="00:00:01:5" end="00:00:02:25">Q&amp;A</title>'
+            b'<title start="00:00:03:125" end="00:00:04:0">'
+                b'Fish & chips|&#169; &lt;ABC&gt;</title>'
+            b'</reel></xml>')
+        srt = (
+            "1\n00:00:01,500 --> 00:00:02,250\nQ&A\n\n"
+            "2\n00:00:03,125 --> 00:00:04,000\nFish & chips\n\xA9 <ABC>\n\n"
+        )
+        self.assertEqual(srt, iview.parser.parse_captions(xml))
+        
+        # Every possible split into chunks, including within the entities
+        for split in range(len(xml) + 1):
+            output = StringIO()
+            iview.parser.write_captions((xml[:split], xml[split:]), output)
+            self.assertEqual(srt, output.getvalue(), split)
+        
+        output = StringIO()
+        chunks = (xml[i:i + 1] for i in range(len(xml)))
+        iview.parser.write_captions(chunks, output)
+        self.assertEqual(srt, output.getvalue())
+    
+    def test_records(self):
+        import iview.parser
+        import json
+        data = [dict(a="1", b="Series &amp; more", f=[
+            dict(a="10", b="Episode", n="programme.mp4", j="60"),
+        ])]
+        [series] = iview.parser.parse_series_api(json.dumps(data).encode())
+        self.assertIsInstance(series, iview.parser.Series)
+        self.assertEqual("Series & more", series["title"])
+        self.assertEqual(series["title"], series.title)
+        self.assertNotIn("thumb", series)
+        self.assertIsNone(series.get("thumb"))
+        with self.assertRaises(KeyError):
+            series["thumb"]
+        with self.assertRaises(KeyError):
+            series["undefined"] = None
+        
+        [episode] = series["items"]
+        self.assertIsInstance(episode, iview.parser.Episode)
+        self.assertEqual(60, episode["duration"])
+        self.assertFalse(hasattr(episode, "__dict__"))
+        expected = dict(id="10", title="Episode", url="programme.mp4",
+            duration=60, description="", home="", livestream="", thumb="")
+        self.assertEqual(expected, dict(episode))
+        self.assertEqual(expected, episode)
+        self.assertEqual(episode, expected)
+        self.assertEqual(
+            dict(id="1", title="Series & more", items=[expected]),
+            series)
 
 import iview.comm
+import iview.cache
+
+class TestComm(TestCase):
+    def test_series_many(self):
+        def series_api(key, value=""):
+            return [dict(id=value, items=[value + " episode"])]
+        with substattr(iview.comm, series_api):
+            result = dict(iview.comm.get_series_items_many(
+                map(str, range(10)), concurrency=3))
+        self.assertEqual(10, len(result))
+        self.assertEqual(["5 episode"], result["5"])
+    
+    def test_session(self):
+        """Config and auth responses should be saved between runs"""
+        import iview.fetch
+        from urllib.error import HTTPError
+        auth = ('<iview xmlns="http://www.abc.net.au/iView/Services/'
+            'iViewHandshaker"><server>http://streaming/z/</server>'
+            '<path>playback/</path><free>no</free><tokenhd>{}</tokenhd>'
+            '</iview>')
+        parsed = list()
+        def parse_config(soup):
+            parsed.append(soup)
+            return dict(auth_url=server.url + "auth")
+        with HttpServer({"/config": b"config"}) as server, \
+        TemporaryDirectory(prefix="python-iview.") as dir, \
+        substattr(iview.config, "cache", dir), \
+        substattr(iview.config, "config_url", server.url + "config"), \
+        substattr(iview.parser, parse_config), \
+        substattr(iview.comm, "iview_config", None):
+            for run in range(2):
+                iview.comm.get_config()
+            self.assertEqual([b"config"], parsed)
+            
+            server.files["/auth"] = auth.format("first").encode("ascii")
+            first = iview.comm.get_auth()
+            self.assertEqual(("first", False),
+                (first["tokenhd"], first["saved"]))
+            server.files["/auth"] = auth.format("second").encode("ascii")
+            saved = iview.comm.get_auth()
+            self.assertEqual(("first", True),
+                (saved["tokenhd"], saved["saved"]))
+            self.assertEqual(2, len(server.requests))
+            
+            # A rejected token should be replaced
+            fetched = list()
+            class HdsFetcher(iview.fetch.HdsFetcher):
+                def fetch(self, **kw):
+                    fetched.append(self.tokenhd)
+                    if self.tokenhd == "first":
+                        raise HTTPError(self.url, 403, "Forbidden", None,
+                            None)
+                    return True
+            with substattr(iview.fetch, HdsFetcher):
+                self.assertTrue(iview.fetch.fetch_program("programme.mp4"))
+            self.assertEqual(["first", "second"], fetched)
+            self.assertEqual("second", iview.comm.get_auth()["tokenhd"])
+            
+            with substattr(iview.config, "auth_ttl", 0):
+                self.assertFalse(iview.comm.get_auth()["saved"])
+    
+    def test_captions_many(self):
+        from urllib.error import HTTPError
+        files = dict()
+        for i in range(6):
+            files["/captions/{}.xml".format(i)] = (b'<xml><title '
+                b'start="0:0:0:0" end="0:0:1:0">Caption ' +
+                str(i).encode("ascii") + b'</title></xml>')
+        with HttpServer(files) as server, \
+        TemporaryDirectory(prefix="python-iview.") as dir:
+            iview_config = dict(headers=dict(),
+                captions_url=server.url + "captions/")
+            with substattr(iview.comm, "iview_config", iview_config), \
+            substattr(iview.config, "cache", None):
+                captions = [(str(i), os.path.join(dir, "{}.srt".format(i)))
+                    for i in range(7)]
+                results = iview.comm.write_captions_many(captions)
+                results = {url: error for (url, _, error) in results}
+            
+            self.assertEqual(7, len(results))
+            self.assertIsInstance(results.pop("6"), HTTPError)
+            self.assertEqual(dict.fromkeys(map(str, range(6))), results)
+            with open(os.path.join(dir, "4.srt"), encoding="utf-8") as file:
+                self.assertEqual("1\n0:0:0,000 --> 0:0:1,000\nCaption 4\n\n",
+                    file.read())
+            self.assertEqual(sorted("{}.srt".format(i) for i in range(6)),
+                sorted(os.listdir(dir)))
+            
+            # The original error is kept if the file cannot be opened
+            import builtins
+            def open_error(*pos, **kw):
+                raise PermissionError("Denied")
+            with substattr(builtins, "open", open_error), \
+            self.assertRaises(PermissionError):
+                iview.comm.write_captions_file("0",
+                    os.path.join(dir, "denied.srt"))
+
+class TestAio(TestCase):
+    def test_series_api(self):
+        import asyncio
+        import json
+        import gzip
+        from iview.aio import Client
+        files = dict()
+        for id in range(30):
+            series = [dict(a=str(id), b="Series {}".format(id), f=[])]
+            body = gzip.compress(json.dumps(series).encode("ascii"))
+            path = "/api?series={}".format(id)
+            files[path] = (body, {"Content-Encoding": "gzip"})
+        
+        async def run(server):
+            async with Client(max_per_host=4) as client:
+                client.iview_config["api_url"] = server.url + "api"
+                results = await asyncio.gather(*(
+                    client.get_series_items(str(id), get_meta=True)
+                    for id in range(30)))
+                return (results, client.session)
+        with HttpServer(files) as server:
+            (results, session) = run_async(run(server))
+        self.assertEqual("Series 7", results[7][1]["title"])
+        self.assertLessEqual(session.opened, 4)
+        self.assertEqual(30, session.opened + session.reused)
+    
+    def test_cache(self):
+        from iview.aio import Client
+        from urllib.error import HTTPError
+        files = {
+            "/data": (b"body", {"ETag": '"1"', "Cache-Control": "no-cache"}),
+        }
+        
+        async def run(server, dir):
+            async with Client(cache_dir=dir) as client:
+                first = await client.maybe_fetch(server.url + "data")
+                second = await client.maybe_fetch(server.url + "data")
+                with self.assertRaises(HTTPError):
+                    await client.fetch_url(server.url + "missing")
+                return (first, second)
+        with HttpServer(files) as server, \
+        TemporaryDirectory(prefix="python-iview.") as dir:
+            self.assertEqual((b"body", b"body"), run_async(run(server, dir)))
+            self.assertEqual('"1"', server.requests[1]["If-None-Match"])
+    
+    def test_timeout(self):
+        """A server that never responds"""
+        import asyncio
+        import socket
+        from iview.aio import HttpSession
+        
+        async def run(url):
+            session = HttpSession(timeout=0.1)
+            try:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await session.get(url)
+            finally:
+                await session.close()
+        with socket.socket() as server:
+            server.bind(("localhost", 0))
+            server.listen(1)
+            (host, port) = server.getsockname()[:2]
+            run_async(run("http://{}:{}/".format(host, port)))
+
+class TestServer(TestCase):
+    def test_stream(self):
+        import iview.server
+        import threading
+        import urllib.request
+        from urllib.error import HTTPError
+        with HdsServer(frags=5, latency=0.02) as upstream:
+            expected = upstream.fetch()
+            for (path, file) in list(upstream.files.items()):
+                path = path.replace("/programme/", "/news/programme.mp4/")
+                upstream.files[path] = file
+            
+            auths = list()
+            def get_auth(refresh=False):
+                auths.append(refresh)
+                return dict(server=upstream.url, path="", saved=False)
+            with substattr(iview.comm, get_auth), \
+            substattr(sys, "stderr", StringIO()):
+                server = iview.server.Server(("127.0.0.1", 0),
+                    max_downloads=1)
+                serve = threading.Thread(target=server.serve_forever)
+                serve.start()
+                try:
+                    url = "http://127.0.0.1:{}/".format(server.server_port)
+                    
+                    # Concurrent requests should share one download
+                    upstream.requests.clear()
+                    results = list()
+                    def get():
+                        with urllib.request.urlopen(
+                        url + "news/programme.flv") as response:
+                            results.append((response.info()["Content-Type"],
+                                response.read()))
+                    threads = [threading.Thread(target=get)
+                        for run in range(3)]
+                    for thread in threads:
+                        thread.start()
+                    for thread in threads:
+                        thread.join()
+                    self.assertEqual([("video/x-flv", expected)] * 3, results)
+                    requests = len(upstream.requests)
+                    self.assertEqual(1 + 5, requests)  # Manifest, fragments
+                    
+                    # The finished download should be kept for a while
+                    with urllib.request.urlopen(
+                    url + "news/programme.flv") as response:
+                        self.assertEqual(str(len(expected)),
+                            response.info()["Content-Length"])
+                        self.assertEqual(expected, response.read())
+                    self.assertEqual(requests, len(upstream.requests))
+                    
+                    size = len(expected)
+                    for (header, status, content_range, data) in (
+                        ("bytes=100-199", 206, "100-199/{}".format(size),
+                            expected[100:200]),
+                        ("bytes=-50", 206, "{}-{}/{}".format(
+                            size - 50, size - 1, size), expected[-50:]),
+                        ("bytes=100-", 206, "100-{}/{}".format(
+                            size - 1, size), expected[100:]),
+                        ("bytes=1-0", 200, None, expected),
+                    ):
+                        request = urllib.request.Request(
+                            url + "news/programme.flv",
+                            headers={"Range": header})
+                        with urllib.request.urlopen(request) as response:
+                            self.assertEqual(status, response.status)
+                            if content_range:
+                                content_range = "bytes " + content_range
+                            self.assertEqual(content_range,
+                                response.info()["Content-Range"])
+                            self.assertEqual(data, response.read())
+                    request = urllib.request.Request(
+                        url + "news/programme.flv",
+                        headers={"Range": "bytes={}-".format(size)})
+                    with self.assertRaises(HTTPError) as cm:
+                        urllib.request.urlopen(request)
+                    self.assertEqual(416, cm.exception.code)
+                    cm.exception.close()
+                    
+                    for (path, status) in (
+                        ("news/missing.flv", 502),
+                        ("news/programme.mp4", 404),
+                        ("../programme.flv", 404),
+                    ):
+                        with self.assertRaises(HTTPError) as cm:
+                            urllib.request.urlopen(url + path)
+                        self.assertEqual(status, cm.exception.code, path)
+                        cm.exception.close()
+                    
+                    with server.downloads:
+                        with self.assertRaises(HTTPError) as cm:
+                            urllib.request.urlopen(url + "news/other.flv")
+                        self.assertEqual(503, cm.exception.code)
+                        cm.exception.close()
+                finally:
+                    server.shutdown()
+                    serve.join()
+                    server.server_close()
+            self.assertEqual([False], auths)
+    
+    def test_auth(self):
+        """Other clients should not wait while the auth is requested"""
+        import iview.server
+        import threading
+        requested = threading.Event()
+        release = threading.Event()
+        def get_auth(refresh=False):
+            requested.set()
+            release.wait()
+            return dict(server="http://localhost/", path="", saved=False)
+        with substattr(iview.comm, get_auth):
+            server = iview.server.Server(("127.0.0.1", 0))
+            try:
+                thread = threading.Thread(target=server.get_fetcher,
+                    args=("programme.mp4",))
+                thread.start()
+                try:
+                    requested.wait()
+                    self.assertTrue(server._lock.acquire(timeout=1))
+                    server._lock.release()
+                finally:
+                    release.set()
+                    thread.join()
+                fetcher = server.get_fetcher("programme.mp4")
+                self.assertTrue(fetcher.saved_auth)
+            finally:
+                server.server_close()
+    
+    def test_seek(self):
+        """Seeking beyond the download should start another download"""
+        import iview.server
+        import iview.flvlib
+        import threading
+        import urllib.request
+        with HdsServer(frags=10, latency=0.1) as upstream:
+            expected = upstream.fetch()
+            for (path, file) in list(upstream.files.items()):
+                path = path.replace("/programme/", "/programme.mp4/")
+                upstream.files[path] = file
+            def get_auth(refresh=False):
+                return dict(server=upstream.url, path="", saved=False)
+            with substattr(iview.comm, get_auth), \
+            substattr(sys, "stderr", StringIO()):
+                server = iview.server.Server(("127.0.0.1", 0), seek_ahead=2)
+                serve = threading.Thread(target=server.serve_forever)
+                serve.start()
+                try:
+                    url = "http://127.0.0.1:{}/programme.flv".format(
+                        server.server_port)
+                    request = urllib.request.Request(url,
+                        headers={"Range": "bytes=0-99"})
+                    with urllib.request.urlopen(request) as response:
+                        self.assertEqual(expected[:100], response.read())
+                    
+                    first = len(expected) * 8 // 10
+                    request = urllib.request.Request(url,
+                        headers={"Range": "bytes={}-".format(first)})
+                    with urllib.request.urlopen(request) as response:
+                        # The range cannot be exact, so a whole file is sent
+                        self.assertEqual(200, response.status)
+                        self.assertIsNone(response.info()["Content-Range"])
+                        data = response.read()
+                finally:
+                    server.shutdown()
+                    serve.join()
+                    server.server_close()
+        
+        # The header and metadata of the programme, then whole tags from a
+        # later fragment, with the original timestamps, and sequence
+        # headers for the decoder
+        (_, end) = iview.server.flv_metadata(expected)
+        self.assertEqual(expected[:end], data[:end])
+        data = data[end:]
+        tag = iview.flvlib.parse_tag_header(data)
+        self.assertGreaterEqual(tag["timestamp"], 5000)
+        self.assertEqual(1, data.count(b"audio header"))
+        self.assertEqual(10 - tag["timestamp"] // 1000,
+            data.count(b"audio frame"))
+        self.assertTrue(expected.endswith(data[data.index(b"audio frame"):]))
+
+class TestRtmp(TestCase):
+    def test_live(self):
+        import iview.rtmp
+        import iview.fetch
+        from iview import flvlib
+        from iview.rtmp import AUDIO, VIDEO, DATA, AGGREGATE
+        
+        metadata = flvlib.format_scriptdata("onMetaData", dict(width=640))
+        video = b"\x17\x01" + bytes(5000)  # Spans several chunks
+        aggregate = (flv_tag(VIDEO, 100, b"\x27\x01aggregate") +
+            flv_tag(AUDIO, 130, b"\xAF\x01aggregate"))
+        def play(connection):
+            connection.send(4, DATA,
+                flvlib.format_scriptdatavalue("@setDataFrame") + metadata,
+                stream=1)
+            connection.send(4, DATA,
+                flvlib.format_scriptdata("|RtmpSampleAccess", False),
+                stream=1)
+            connection.send(6, VIDEO, video, stream=1, timestamp=5000)
+            connection.send(4, AUDIO, b"\xAF\x01first", stream=1,
+                timestamp=5000)
+            connection.sock.sendall(b"".join((
+                bytes((1 << 6 | 4,)),  # Type 1 header, with a delta
+                (20).to_bytes(3, "big"), (6).to_bytes(3, "big"),
+                bytes((AUDIO,)), b"\xAF\x01next",
+                bytes((3 << 6 | 4,)),  # New message with the same header
+                b"\xAF\x01last",
+            )))
+            connection.send(6, AGGREGATE, aggregate, stream=1,
+                timestamp=5060)
+        
+        tags = (
+            flv_tag(DATA, 0, metadata),
+            flv_tag(VIDEO, 0, video),
+            flv_tag(AUDIO, 0, b"\xAF\x01first"),
+            flv_tag(AUDIO, 20, b"\xAF\x01next"),
+            flv_tag(AUDIO, 40, b"\xAF\x01last"),
+            flv_tag(VIDEO, 60, b"\x27\x01aggregate"),
+            flv_tag(AUDIO, 90, b"\xAF\x01aggregate"),
+        )
+        header = b"FLV\x01\x05" + (9).to_bytes(4, "big") + bytes(4)
+        
+        with RtmpServer(play) as server, TemporaryDirectory() as dir, \
+        substattr(iview.config, "live_rtmp_backend", "builtin"):
+            fetcher = iview.fetch.RtmpFetcher(server.url + "/news24",
+                live=True)
+            self.assertTrue(fetcher.builtin())
+            dest_file = os.path.join(dir, "news24.flv")
+            fetcher.fetch(dest_file=dest_file, execvp=False, quiet=True,
+                frontend=None)
+            with open(dest_file, "rb") as file:
+                self.assertEqual(header + b"".join(tags), file.read())
+        self.assertEqual([b"connect", b"createStream", b"play"],
+            [command[0] for command in server.commands])
+        (connect,) = server.commands[0][1:]
+        self.assertEqual(b"live", connect["app"])
+        self.assertEqual(server.url.encode("ascii"), connect["tcUrl"])
+        self.assertEqual([None, b"news24", -1000, -1],
+            server.commands[2][1:])
+        
+        # Stopping early and reporting progress
+        sizes = list()
+        class Frontend:
+            def set_fraction(fraction):
+                pass
+            def set_size(size):
+                sizes.append(size)
+        with RtmpServer(play) as server:
+            flv = BytesIO()
+            iview.rtmp.fetch(server.url, playpath="news24", live=True,
+                end=0.03, dest_file=flv, frontend=Frontend)
+        expected = header + b"".join(tags[:4])
+        self.assertEqual(expected, flv.getvalue())
+        self.assertEqual(len(expected), sizes[-1])
 
 class TestProxy(TestCase):
     class DirectSocket(Exception):
@@ -160,6 +1166,271 @@ class TestProxy(TestCase):
         self.assertRaises(exception, hds.fetch,
             "http://localhost/", "media path", "hdnea", dest_file=None)
 
+class HttpServer:
+    """Local HTTP server for testing
+    
+    The "files" dictionary maps each path, with or without the query
+    string, to either a response body, or a (body, headers) tuple. A 304
+    response is sent if "If-None-Match" matches the "ETag" header. Each
+    response is delayed by "latency" seconds to simulate a distant server.
+    The headers of each request are appended to the "requests" list."""
+    
+    def __init__(self, files=(), latency=0):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from socketserver import ThreadingMixIn
+        from urllib.parse import urlsplit
+        import time
+        
+        self.files = dict(files)
+        self.requests = list()
+        
+        server = self
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            def do_GET(self):
+                time.sleep(latency)
+                server.requests.append(self.headers)
+                body = server.files.get(self.path)
+                if body is None:
+                    body = server.files.get(urlsplit(self.path).path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                if isinstance(body, tuple):
+                    (body, headers) = body
+                else:
+                    headers = dict()
+                etag = headers.get("ETag")
+                if etag and self.headers["If-None-Match"] == etag:
+                    self.send_response(304)
+                    body = b""
+                else:
+                    self.send_response(200)
+                for (name, value) in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", len(body))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *pos):
+                pass
+        
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+    
+    def __enter__(self):
+        import threading
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+class HdsServer(HttpServer):
+    """Local HTTP server for a synthetic HDS programme
+    
+    The programme is made up of "frags" fragments, available at each of
+    the listed "bitrates". If "children" is set, each bitrate is listed
+    in a separate child manifest."""
+    
+    def __init__(self, frags=10, frag_size=0x1000, bitrates=(None,),
+    children=False, **kw):
+        HttpServer.__init__(self, **kw)
+        bootstrap = hds_bootstrap(frags)
+        if children:
+            manifest = ['<manifest xmlns="{}">'.format(F4M_NAMESPACE)]
+            for bitrate in bitrates:
+                child = "child{}.f4m".format(bitrate)
+                manifest.append('<media href="{}" bitrate="{}"/>'.format(
+                    child, bitrate))
+                self.files["/programme/" + child] = hds_manifest(bootstrap,
+                    duration=frags, media=(bitrate,))
+            manifest.append("</manifest>")
+            manifest = "".join(manifest).encode("ascii")
+        else:
+            manifest = hds_manifest(bootstrap, duration=frags,
+                media=bitrates)
+        self.files["/programme/manifest.f4m"] = manifest
+        for bitrate in bitrates:
+            for frag in range(frags):
+                path = "/programme/media{}Seg1-Frag{}".format(
+                    "" if bitrate is None else bitrate, 1 + frag)
+                self.files[path] = hds_fragment(frag, frag_size, bitrate)
+    
+    class Frontend:
+        def set_fraction(fraction):
+            pass
+        def set_size(size):
+            pass
+    
+    def fetch(self, **kw):
+        """Downloads the programme and returns the FLV file contents"""
+        import iview.hds
+        flv = BytesIO()
+        iview.hds.fetch(self.url, "programme", dest_file=flv,
+            frontend=self.Frontend, **kw)
+        return flv.getvalue()
+
+F4M_NAMESPACE = "http://ns.adobe.com/f4m/1.0"
+
+class RtmpServer:
+    """Local RTMP server for a single connection to a live stream
+    
+    Once the client asks to play the stream, the "play" function is
+    called with the "iview.rtmp.Connection" object to send the stream
+    messages. Each command received is appended to the "commands" list,
+    as a list of the command name and its arguments."""
+    
+    def __init__(self, play, chunk_size=0x1000, window=0x1000):
+        import socket
+        self.play = play
+        self.chunk_size = chunk_size
+        self.window = window
+        self.commands = list()
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(1)
+        self.url = "rtmp://127.0.0.1:{}/live".format(
+            self.listener.getsockname()[1])
+    
+    def __enter__(self):
+        import threading
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self.thread.join()
+        self.listener.close()
+    
+    def serve(self):
+        import iview.rtmp as rtmp
+        (sock, _) = self.listener.accept()
+        with sock:
+            connection = rtmp.Connection(sock)
+            c1 = connection.read(1 + rtmp.HANDSHAKE_SIZE)[1:]
+            sock.sendall(b"\x03" + bytes(rtmp.HANDSHAKE_SIZE) + c1)
+            connection.read(rtmp.HANDSHAKE_SIZE)  # C2
+            
+            while True:
+                (type, _, _, body) = connection.receive()
+                if type != rtmp.COMMAND:
+                    continue
+                (name, transaction, *args) = rtmp.parse_command(body)
+                self.commands.append([name] + args)
+                if name == b"connect":
+                    connection.send(rtmp.CONTROL_CHUNKS,
+                        rtmp.WINDOW_ACK_SIZE, self.window.to_bytes(4, "big"))
+                    connection.send(rtmp.CONTROL_CHUNKS,
+                        rtmp.SET_CHUNK_SIZE,
+                        self.chunk_size.to_bytes(4, "big"))
+                    connection.chunk_size = self.chunk_size
+                    connection.send_command("_result", transaction, None,
+                        dict(level="status",
+                            code="NetConnection.Connect.Success"))
+                elif name == b"createStream":
+                    connection.send_command("_result", transaction, None, 1)
+                elif name == b"play":
+                    break
+            
+            try:
+                connection.send_command("onStatus", 0, None,
+                    dict(level="status", code="NetStream.Play.Start"),
+                    stream=1)
+                self.play(connection)
+                connection.send_command("onStatus", 0, None,
+                    dict(level="status",
+                        code="NetStream.Play.UnpublishNotify"),
+                    stream=1)
+            except ConnectionError:
+                pass  # Client stopped early
+
+def hds_box(type, *data):
+    data = b"".join(data)
+    return (8 + len(data)).to_bytes(4, "big") + type + data
+
+def hds_bootstrap(frags, timescale=1000, duration=1000):
+    """Bootstrap with one segment of equally long fragments"""
+    asrt = hds_box(b"asrt", bytes(4),  # Version, flags
+        bytes(1),  # Quality table
+        (1).to_bytes(4, "big"),  # Segment runs
+        (1).to_bytes(4, "big"), frags.to_bytes(4, "big"),
+    )
+    afrt = hds_box(b"afrt", bytes(4),  # Version, flags
+        timescale.to_bytes(4, "big"),
+        bytes(1),  # Quality table
+        (2).to_bytes(4, "big"),  # Fragment runs
+        (1).to_bytes(4, "big"), bytes(8), duration.to_bytes(4, "big"),
+        frags.to_bytes(4, "big"),
+        ((frags - 1) * duration).to_bytes(8, "big"),
+        duration.to_bytes(4, "big"),
+    )
+    return hds_box(b"abst", bytes(4 + 4 + 1),
+        timescale.to_bytes(4, "big"),
+        (frags * duration).to_bytes(8, "big"),
+        bytes(8),  # SMPTE offset
+        b"\x00",  # Movie identifier
+        bytes(2),  # Server and quality tables
+        b"\x00\x00",  # DRM data, metadata
+        b"\x01", asrt, b"\x01", afrt,
+    )
+
+def hds_manifest(bootstrap, duration, media=(None,)):
+    """F4M manifest; "media" is a sequence of bitrates"""
+    from base64 import b64encode
+    metadata = b"".join((b"\x02", len(b"onMetaData").to_bytes(2, "big"),
+        b"onMetaData", b"\x08", bytes(4),
+        b"\x00\x08duration\x00", struct.pack(">d", duration),
+        b"\x00\x00\x09",
+    ))
+    manifest = ['<manifest xmlns="{}">'.format(F4M_NAMESPACE)]
+    manifest.append('<bootstrapInfo id="bootstrap">{}</bootstrapInfo>'.
+        format(b64encode(bootstrap).decode("ascii")))
+    for bitrate in media:
+        if bitrate is None:
+            attrs = 'url="media"'
+        else:
+            attrs = 'url="media{0}" bitrate="{0}"'.format(bitrate)
+        manifest.append('<media {} bootstrapInfoId="bootstrap">'
+            '<metadata>{}</metadata></media>'.format(attrs,
+            b64encode(metadata).decode("ascii")))
+    manifest.append("</manifest>")
+    return "".join(manifest).encode("ascii")
+
+def hds_fragment(frag, size, bitrate=None):
+    """Fragment with sequence headers and some frames
+    
+    The video frame is labelled with the bitrate."""
+    timestamp = frag * 1000
+    label = "<{}>".format(bitrate).encode("ascii")
+    tags = (
+        flv_tag(8, timestamp, b"\xAF\x00audio header"),
+        flv_tag(9, timestamp, b"\x17\x00\x00\x00\x00video header"),
+        flv_tag(9, timestamp, b"\x17\x01\x00\x00\x00" + label +
+            bytes(size)),
+        flv_tag(8, timestamp, b"\xAF\x01audio frame"),
+    )
+    return hds_box(b"afra", bytes(9)) + hds_box(b"mdat", *tags)
+
+def flv_tag(type, timestamp, data):
+    header = bytes((type,)) + len(data).to_bytes(3, "big")
+    header += (timestamp & 0xFFFFFF).to_bytes(3, "big")
+    header += bytes((timestamp >> 24,)) + bytes(3)
+    return header + data + (len(header) + len(data)).to_bytes(4, "big")
+
+def run_async(coroutine):
+    """Like "asyncio.run()", which needs Python 3.7"""
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
 @contextmanager
 def substattr(obj, attr, *value):
     if value: